@@ -0,0 +1,163 @@
+"""
+balance_utils.py
+
+Utilities for building, loading, and querying a local snapshot of address balances, so salvaged key candidates can be
+    checked offline - in microseconds, rather than ~0.2 seconds per network call, and on machines with no network.
+
+Built from a dump of addresses with balances (e.g. an address / UTXO dump exported from a full node or a block
+    explorer), as a (3, n) uint64 .npy file sorted by address, in the same layout as the known hashes database
+    (see known_utils), so it's memory-mapped and searched the same way:
+
+    snapshot[0] = top 8 bytes of the md5 of every address (big-endian, so numeric order == byte order)
+    snapshot[1] = bottom 8 bytes of the md5 of every address
+    snapshot[2] = balance of every address, in satoshis
+
+Addresses are stored by the md5 of the address string rather than decoded, so every kind of address (legacy, P2SH,
+    bech32) fits in the same fixed 16 bytes, and they're spread evenly for the prefix table, which is built and
+    stored next to it (snapshot.prefix.npy) exactly like the known hashes one.
+
+Also here is the ledger of every key we've already checked (salvage.ledger, a sqlite database), with its addresses
+    and balances when checked, so candidates that turn up again in later tombs aren't derived and checked again.
+"""
+import os
+import time
+import hashlib
+import sqlite3
+import numpy as np
+from tqdm import tqdm
+from known_utils import split_digests, save_known_prefix, load_known_prefix, find_digest, PREFIX_BITS
+
+# Number of dump lines we parse before converting them to arrays, keeps memory use bounded for huge dumps.
+BUILD_CHUNK_SIZE = 2**20
+
+SATOSHIS_PER_BTC = 10**8
+
+# Default ledger of checked keys, shared between every salvage run from the same directory.
+LEDGER_FNAME = "salvage.ledger"
+
+# Number of checked keys we record in the ledger at once
+LEDGER_COMMIT_INTERVAL = 256
+
+# Max number of keys per query when checking the ledger, under sqlite's limit on query parameters.
+LEDGER_QUERY_SIZE = 500
+
+
+def address_digest(address):
+    # Raw 16-byte digest an address is stored under in the snapshot.
+    return hashlib.md5(address.strip().encode()).digest()
+
+
+def parse_dump_line(line):
+    # Parse "address<tab / comma / space>balance in satoshis" from a dump line, or None if it isn't one (e.g. a header).
+    parts = line.replace(",", " ").replace(";", " ").split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1])
+
+
+def build_balance_snapshot(dump_fname, dst_fname):
+    """
+    Build a balance snapshot from a text dump of addresses and balances, one per line.
+
+    Lines are "address balance", separated by tabs, commas, semicolons, or spaces, with the balance in satoshis.
+        Anything else (headers, blank lines) is skipped. If an address is in the dump more than once, as it is in
+        a UTXO dump with a line per unspent output, its balances are added up.
+
+    :param dump_fname: Text dump of addresses and balances
+    :param dst_fname: Destination file for the snapshot, e.g. balances.npy
+    :return: Number of addresses written
+    """
+    his, los, balances = [], [], []
+    def convert(chunk):
+        hi, lo = split_digests(address_digest(address) for address, _ in chunk)
+        his.append(hi)
+        los.append(lo)
+        balances.append(np.array([balance for _, balance in chunk], dtype=np.uint64))
+
+    print(f"Reading address dump {dump_fname}...")
+    chunk = []
+    with open(dump_fname, "r", errors="ignore") as f:
+        for line in tqdm(f, unit=" lines"):
+            entry = parse_dump_line(line)
+            if entry is None:
+                continue
+            chunk.append(entry)
+            if len(chunk) == BUILD_CHUNK_SIZE:
+                convert(chunk)
+                chunk = []
+    if len(chunk) > 0:
+        convert(chunk)
+    if len(his) == 0:
+        his, los, balances = [np.empty(0, dtype=np.uint64)], [np.empty(0, dtype=np.uint64)], [np.empty(0, dtype=np.uint64)]
+    hi, lo, balance = np.concatenate(his), np.concatenate(los), np.concatenate(balances)
+    del his, los, balances
+
+    print("Sorting...")
+    order = np.lexsort((lo, hi))
+    hi, lo, balance = hi[order], lo[order], balance[order]
+
+    # Add up the balances of any address listed more than once
+    first = np.ones(len(hi), dtype=bool)
+    first[1:] = (hi[1:] != hi[:-1]) | (lo[1:] != lo[:-1])
+    starts = np.flatnonzero(first)
+    if len(starts) > 0:
+        balance = np.add.reduceat(balance, starts)
+    hi, lo = hi[starts], lo[starts]
+    n = len(hi)
+
+    print(f"Writing balance snapshot of {n:,} addresses to {dst_fname}")
+    out = np.lib.format.open_memmap(dst_fname, mode="w+", dtype=np.uint64, shape=(3, n))
+    out[0], out[1], out[2] = hi, lo, balance
+    out.flush()
+    del out
+    return n
+
+
+def load_balance_snapshot(fname):
+    """
+    Open the balance snapshot at fname for use with address_balance. Memory-mapped, so this is near-instant.
+
+    :param fname: Snapshot from build_balance_snapshot
+    :return: (snapshot, prefix), with snapshot the (3, n) uint64 array, and prefix its prefix table or None if
+        there isn't one.
+    """
+    snapshot = np.load(fname, mmap_mode="r")
+    return snapshot, load_known_prefix(fname, snapshot)
+
+
+def address_balance(balances, address):
+    # Balance of address in satoshis according to the snapshot, 0 if it isn't in it.
+    # Looked up exactly like the known hashes, see known_utils.find_digest
+    snapshot, prefix = balances
+    i = find_digest(snapshot, prefix, address_digest(address))
+    return int(snapshot[2][i]) if i != -1 else 0
+
+
+def open_ledger(fname=LEDGER_FNAME):
+    # Open (creating if needed) the ledger of checked keys at fname.
+    conn = sqlite3.connect(fname)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS checked (key TEXT PRIMARY KEY, address_compressed TEXT, "
+                 "balance_compressed REAL, address_uncompressed TEXT, balance_uncompressed REAL, "
+                 "source TEXT, checked_at REAL)")
+    conn.commit()
+    return conn
+
+
+def ledger_checked(conn, keys):
+    # Return the set of keys (hex) which are already in the ledger.
+    keys = list(keys)
+    checked = set()
+    for i in range(0, len(keys), LEDGER_QUERY_SIZE):
+        chunk = keys[i:i + LEDGER_QUERY_SIZE]
+        query = f"SELECT key FROM checked WHERE key IN ({','.join('?' * len(chunk))})"
+        checked.update(row[0] for row in conn.execute(query, chunk))
+    return checked
+
+
+def add_to_ledger(conn, results, source):
+    # Record a batch of (key, address_compressed, balance_compressed, address_uncompressed, balance_uncompressed)
+    # as checked, with where the balances came from ("snapshot" or "api"). Addresses are None for invalid keys.
+    now = time.time()
+    conn.executemany("INSERT OR REPLACE INTO checked VALUES (?, ?, ?, ?, ?, ?, ?)", [result + (source, now) for result in results])
+    conn.commit()
@@ -0,0 +1,118 @@
+"""
+Benchmark of matching the crypto_salvager content rules - the old way of decoding every line and checking each
+    variant of each rule against it, against the compiled matcher (compile_content_matcher), both with and without
+    pyahocorasick installed, line by line and on the whole windows the salvager now scans files in.
+
+The corpus is synthetic recovered-file contents: mostly binary noise and text lines, with the occasional rule pattern
+    (in random case) planted in them, split into lines the same way the salvager does. With --dir, the lines are
+    instead taken from the files in a real directory (e.g. a tomb).
+
+The compiled matcher is case-insensitive where the old checks weren't, so it should find everything the old one did
+    plus some - this checks that first, and fails rather than reporting a speedup if it ever finds less.
+
+run (with TombRaider's root, containing utils/, on the path):
+python3 bench_content_rules.py [--mb N] [--dir DIR]
+"""
+import os
+import sys
+import time
+import random
+import crypto_salvager
+from crypto_salvager import *
+
+DEFAULT_MB = 64
+PLANT_RATE = 0.001 # Fraction of lines with a rule pattern planted in them
+
+
+def old_match_ruleset_line(line):
+    # The old per-line rule check, returning the indices of the rules that matched.
+    line = line.decode("ascii", "ignore")
+    matched = []
+    for i, (label, is_regex, pattern, context_pattern) in enumerate(ruleset):
+        if is_regex:
+            if pattern.search(line):
+                matched.append(i)
+        else:
+            pattern, pattern_lower, pattern_sanitize = pattern
+            if pattern in line or pattern_lower in line or pattern_sanitize in line:
+                matched.append(i)
+    return matched
+
+
+def random_case(s):
+    return "".join(c.upper() if random.random() < 0.5 else c for c in s)
+
+
+def synthetic_lines(mb):
+    random.seed(0)
+    words = [b"the", b"data", b"file", b"program", b"settings", b"window", b"user", b"0x0040", b"error", b"path"]
+    examples = [rule[2][0] if not rule[1] else "electrum-4.1.5-portable.exe" for rule in ruleset]
+    lines = []
+    size = 0
+    while size < mb * MB:
+        if random.random() < 0.5:
+            line = os.urandom(random.randint(20, 400)).replace(b"\n", b" ")
+        else:
+            line = b" ".join(random.choice(words) for _ in range(random.randint(3, 30)))
+        if random.random() < PLANT_RATE:
+            # Half as they are, so the old checks have something to find too
+            example = random.choice(examples)
+            line += b" " + (random_case(example) if random.random() < 0.5 else example).encode() + b" "
+        lines.append(line)
+        size += len(line) + 1
+    return lines
+
+
+def timed(label, match, buffers, baseline=None):
+    start = time.perf_counter()
+    for buf in buffers:
+        match(buf)
+    elapsed = time.perf_counter() - start
+    size = sum(len(buf) + 1 for buf in buffers)
+    speedup = f"{baseline / elapsed:6.2f}x" if baseline else "   1.00x"
+    print(f"{label.ljust(30)} | {elapsed:8.3f}s | {size / MB / elapsed:>9,.1f} MB/s | {speedup}")
+    return elapsed
+
+
+if __name__ == "__main__":
+    mb = DEFAULT_MB
+    if "--mb" in sys.argv:
+        mb = int(sys.argv[sys.argv.index("--mb") + 1])
+    if "--dir" in sys.argv:
+        lines = []
+        for entry in fs.scan_files(sys.argv[sys.argv.index("--dir") + 1], filter=fs.isregular):
+            with open(entry.path, "rb") as f:
+                lines.extend(f.read().split(b"\n"))
+    else:
+        lines = synthetic_lines(mb)
+
+    if crypto_salvager.ahocorasick is not None:
+        matchers = [("compiled (pyahocorasick)", content_matches)]
+        # And again without it
+        crypto_salvager.ahocorasick = None
+        matchers.append(("compiled (regex prefilter)", compile_content_matcher(ruleset)[0]))
+    else:
+        print("pyahocorasick isn't installed, only timing the regex prefilter version.")
+        matchers = [("compiled (regex prefilter)", content_matches)]
+
+    # Everything the old checks found, and how much more (case-insensitively) the compiled ones find
+    old_found = sum(len(old_match_ruleset_line(line)) for line in lines)
+    for label, match in matchers:
+        found = 0
+        for line in lines:
+            old = set(old_match_ruleset_line(line))
+            new = set(i for i, _, _ in match(line))
+            assert old <= new, (label, line, old - new)
+            found += len(new)
+        print(f"{label}: {found:,} rule matches, the old checks found {old_found:,} of them.")
+
+    print(f"{len(lines):,} lines")
+    baseline = timed("old (3 checks x rule x line)", old_match_ruleset_line, lines)
+    for label, match in matchers:
+        timed(label, match, lines, baseline)
+
+    # And how the salvager actually uses it now, on whole windows of the file rather than line by line
+    contents = b"\n".join(lines)
+    windows = [contents[start:start + scan_utils.WINDOW_SIZE + WINDOW_OVERLAP] for start in range(0, len(contents), scan_utils.WINDOW_SIZE)]
+    for label, match in matchers:
+        timed(label.replace("compiled", "windowed"), match, windows, baseline)
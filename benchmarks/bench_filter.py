@@ -0,0 +1,153 @@
+"""
+Benchmark of classifying files by libmagic info string and extension - the old loops over every ext and tag of
+    every group in filters.py, against the precomputed token_labels / ext_labels lookups in filter_utils.
+
+The corpus is a set of info strings libmagic really gives for the kinds of files we find in tombs, and filenames
+    with a spread of known, unsupported, and missing extensions, repeated out to --n of each.
+    With --dir, the info strings and filenames are instead taken from the files in a real directory (e.g. a tomb),
+    running libmagic on them once up front so only the classification itself is timed.
+
+Every label is checked against the old implementation first, so this fails rather than reporting a speedup if
+    the lookups would ever sort a file differently.
+
+run:
+python3 bench_filter.py [--n N] [--dir DIR]
+"""
+import os
+import sys
+import time
+from filter_utils import *
+from filesystem_utils import *
+
+DEFAULT_N = 200_000
+
+INFO_STRINGS = [
+    "JPEG image data, JFIF standard 1.01, aspect ratio, density 1x1, segment length 16, baseline, precision 8, 640x480, components 3",
+    "PNG image data, 16 x 16, 8-bit/color RGBA, non-interlaced",
+    "GIF image data, version 89a, 1 x 1",
+    "PC bitmap, Windows 3.x format, 32 x 32 x 24, image size 3072, resolution 2834 x 2834 px/m",
+    "MS Windows icon resource - 3 icons, 16x16, 32 bits/pixel",
+    "ISO Media, MP4 v2 [ISO 14496-14]",
+    "RIFF (little-endian) data, AVI, 640 x 480, 25.00 fps, video: XviD, audio: MPEG-1 Layer 3 (stereo, 44100 Hz)",
+    "Matroska data",
+    "Audio file with ID3 version 2.3.0, contains:MPEG ADTS, layer III, v1, 128 kbps, 44.1 kHz, JntStereo",
+    "RIFF (little-endian) data, WAVE audio, Microsoft PCM, 16 bit, stereo 44100 Hz",
+    "FLAC audio bitstream data, 16 bit, stereo, 44.1 kHz, 10584000 samples",
+    "Zip archive data, at least v2.0 to extract",
+    "gzip compressed data, was \"backup.tar\", last modified: Mon Jun  1 12:00:00 2015, from Unix",
+    "7-zip archive data, version 0.4",
+    "RAR archive data, v5",
+    "POSIX tar archive (GNU)",
+    "PGP symmetric key encrypted data - AES with 256-bit key salted & iterated - SHA256 .",
+    "GPG encrypted data",
+    "Microsoft Word 2007+",
+    "Microsoft Excel 2007+",
+    "Composite Document File V2 Document, Little Endian, Os: Windows, Version 6.1, Code page: 1252",
+    "PDF document, version 1.4",
+    "OpenDocument Text",
+    "Rich Text Format data, version 1, ANSI",
+    "HTML document, ASCII text, with very long lines",
+    "XML 1.0 document, UTF-8 Unicode text",
+    "Python script, ASCII text executable",
+    "C source, ASCII text",
+    "ELF 64-bit LSB shared object, x86-64, version 1 (SYSV), dynamically linked, stripped",
+    "PE32 executable (GUI) Intel 80386, for MS Windows",
+    "PE32+ executable (DLL) (console) x86-64, for MS Windows",
+    "SQLite 3.x database, last written using SQLite version 3022000",
+    "Berkeley DB (Hash, version 9, native byte-order)",
+    "MS Windows shortcut, Item id list present, Points to a file or directory",
+    "MS Windows registry file, NT/2000 or above",
+    "Windows Prefetch file",
+    "ASCII text",
+    "UTF-8 Unicode text, with CRLF line terminators",
+    "ISO-8859 text, with no line terminators",
+    "empty",
+    "data",
+    "very short file (no magic)",
+    "Non-ISO extended-ASCII text",
+    "TrueType Font data, 18 tables, 1st \"DSIG\", 14 names, Microsoft, language 0x409",
+    "Apple binary property list",
+    "Mach-O 64-bit x86_64 executable",
+    "Java archive data (JAR)",
+    "compiled Java class data, version 52.0 (Java 1.8)",
+    "Macromedia Flash data (compressed), version 10",
+    "SVG Scalable Vector Graphics image",
+]
+
+FNAMES = [
+    "IMG_0001.JPG", "photo.jpeg", "icon.png", "animation.gif", "scan.tiff", "holiday.mp4", "clip.avi", "song.mp3",
+    "track.flac", "backup.zip", "backup.tar.gz", "archive.7z", "secret.gpg", "wallet.dat", "report.docx",
+    "budget.xlsx", "slides.pptx", "paper.pdf", "notes.txt", "index.html", "style.css", "main.py", "lib.so",
+    "setup.exe", "driver.dll", "cache.db", "thumbs.db", "desktop.ini", "shortcut.lnk", "f0012345", "README",
+    "data.bin", "page.xhtml", "unknown.xyz", "weird.q7r", "trailing.", ".bashrc", "movie.mkv",
+]
+
+
+def old_filetype_from_infostr(info):
+    # filetype_from_info as it was, checking every ext and then every tag of each group in turn.
+    info = info.lower()
+    infotags = set(info.split(" "))
+    if info == "data":
+        return "Unknown"
+    for i, grp in enumerate(exts):
+        for ext in grp:
+            if ext in infotags:
+                return labels[i]
+    for i, grp in enumerate(tags):
+        for tag in grp:
+            if tag in infotags:
+                return labels[i]
+    return "Unsupported"
+
+
+def old_filetype_from_ext(fname):
+    ext = os.path.splitext(fname)[-1].lower()
+    if len(ext) <= 1:
+        return "Unknown"
+    ext = ext[1:]
+    for i, grp in enumerate(exts):
+        if ext in grp:
+            return labels[i]
+    return "Unsupported"
+
+
+def corpus_from_dir(dir):
+    fnames = [entry.path for entry in scan_files(dir, filter=isregular)]
+    return [safe_magic(fname) for fname in tqdm(fnames, desc="Running libmagic")], fnames
+
+
+def timed(label, classify, inputs, baseline=None):
+    start = time.perf_counter()
+    for x in inputs:
+        classify(x)
+    elapsed = time.perf_counter() - start
+    speedup = f"{baseline / elapsed:6.2f}x" if baseline else "   1.00x"
+    print(f"{label.ljust(26)} | {len(inputs):>10,} | {elapsed:8.3f}s | {len(inputs) / elapsed:>12,.0f} /s | {speedup}")
+    return elapsed
+
+
+if __name__ == "__main__":
+    n = DEFAULT_N
+    if "--n" in sys.argv:
+        n = int(sys.argv[sys.argv.index("--n") + 1])
+    if "--dir" in sys.argv:
+        infos, fnames = corpus_from_dir(sys.argv[sys.argv.index("--dir") + 1])
+    else:
+        infos, fnames = INFO_STRINGS, FNAMES
+    if len(infos) == 0:
+        print("No files to classify.")
+        sys.exit(1)
+
+    # Same labels or it doesn't count
+    for info in set(infos):
+        assert filetype_from_infostr(info) == old_filetype_from_infostr(info), info
+    for fname in set(fnames):
+        assert filetype_from_ext(fname) == old_filetype_from_ext(fname), fname
+    print(f"Labels identical for {len(set(infos)):,} info strings and {len(set(fnames)):,} filenames.")
+
+    infos = (infos * (n // len(infos) + 1))[:n]
+    fnames = (fnames * (n // len(fnames) + 1))[:n]
+    baseline = timed("info, loops", old_filetype_from_infostr, infos)
+    timed("info, token_labels", filetype_from_infostr, infos, baseline)
+    baseline = timed("ext, loops", old_filetype_from_ext, fnames)
+    timed("ext, ext_labels", filetype_from_ext, fnames, baseline)
@@ -0,0 +1,106 @@
+"""
+Benchmark of matching filepaths against the crypto_salvager rules - the old way of checking each path against each
+    rule in turn (re.search on three variants of the path for the regex ones, sanitizing it again each time), against
+    the compiled path matcher (compile_path_matcher), one path at a time and in batches over the whole index,
+    both with and without pyahocorasick installed.
+
+The corpus is synthetic tomb paths: mostly the kind of filesystem and recovered file paths a raid leaves, with the
+    occasional wallet / crypto program path (in random case, with spaces or sanitized) mixed in. With --tomb, the
+    paths are instead read from a real tomb's index.
+
+Every path's matches are checked against the old implementation first, so this fails rather than reporting a speedup
+    if the compiled matcher would ever match differently.
+
+run (with TombRaider's root, containing utils/, on the path):
+python3 bench_path_rules.py [--n N] [--tomb TOMB]
+"""
+import sys
+import time
+import random
+import crypto_salvager
+from crypto_salvager import *
+
+DEFAULT_N = 200_000
+PLANT_RATE = 0.005 # Fraction of paths with a rule pattern in them
+
+
+def old_path_matches(fpath):
+    # path_matches as it was, every rule against every path.
+    matches = []
+    for label, is_regex, pattern, _ in ruleset:
+        if is_regex:
+            if bool(re.search(pattern, fpath)) or bool(re.search(pattern, fpath.lower())) or bool(re.search(pattern, fs.sanitize(fpath))):
+                matches.append((label, pattern))
+        else:
+            pattern, pattern_lower, pattern_sanitize = pattern
+            if pattern in fpath or pattern_lower in fpath or pattern_sanitize in fpath:
+                matches.append((label, pattern))
+    return matches
+
+
+def random_case(s):
+    return "".join(c.upper() if random.random() < 0.5 else c for c in s)
+
+
+def synthetic_paths(n):
+    random.seed(0)
+    dirs = ["Filesystem/Windows/System32", "Filesystem/Users/user/AppData/Roaming", "Filesystem/Program Files (x86)",
+            "Filesystem/home/user/.cache/mozilla/firefox", "Recovered_Files/Images", "Recovered_Files/Unsupported_Text",
+            "Filesystem/Users/user/Documents/My Pictures/2014 - Holiday", "Recovered_Files/Small_Images"]
+    names = ["f{:07d}.jpg", "IMG_{:04d}.JPG", "thumbcache_{}.db", "file {}.txt", "setup-{}.exe", "lib{}.so.1", "{}.dll"]
+    examples = [rule[2][0] if not rule[1] else "electrum-4.1.5-portable.exe" for rule in ruleset]
+    paths = []
+    for i in range(n):
+        fpath = f"{random.choice(dirs)}/{random.choice(names).format(i)}"
+        if random.random() < PLANT_RATE:
+            example = random.choice(examples)
+            example = random.choice([example, random_case(example), fs.sanitize(example)])
+            fpath = f"{random.choice(dirs)}/{example}"
+        paths.append(fpath)
+    return paths
+
+
+def timed(label, match, fpaths, baseline=None):
+    start = time.perf_counter()
+    match(fpaths)
+    elapsed = time.perf_counter() - start
+    speedup = f"{baseline / elapsed:6.2f}x" if baseline else "   1.00x"
+    print(f"{label.ljust(34)} | {elapsed:8.3f}s | {len(fpaths) / elapsed:>12,.0f} paths/s | {speedup}")
+    return elapsed
+
+
+if __name__ == "__main__":
+    n = DEFAULT_N
+    if "--n" in sys.argv:
+        n = int(sys.argv[sys.argv.index("--n") + 1])
+    if "--tomb" in sys.argv:
+        fpaths = [fpath for fpath, _ in index_utils.read_index(sys.argv[sys.argv.index("--tomb") + 1])]
+    else:
+        fpaths = synthetic_paths(n)
+
+    matchers = [("compiled", (path_matches, paths_matches))]
+    if crypto_salvager.ahocorasick is not None:
+        matchers[0] = ("compiled (pyahocorasick)", matchers[0][1])
+        # And again without it
+        crypto_salvager.ahocorasick = None
+        matchers.append(("compiled (regex)", compile_path_matcher(ruleset)))
+
+    # Same matches or it doesn't count
+    old = {fpath: old_path_matches(fpath) for fpath in fpaths}
+    old_matched = {fpath: matches for fpath, matches in old.items() if len(matches) > 0}
+    for label, (match_one, match_batch) in matchers:
+        for fpath in fpaths:
+            assert match_one(fpath) == old[fpath], (label, fpath)
+        batched = {}
+        for i in range(0, len(fpaths), PATH_BATCH_SIZE):
+            batched.update(match_batch(fpaths[i:i + PATH_BATCH_SIZE]))
+        assert batched == old_matched, label
+    print(f"Matches identical for {len(fpaths):,} paths, {len(old_matched):,} of which match a rule.")
+
+    baseline = timed("old (every rule x path)", lambda fpaths: [old_path_matches(fpath) for fpath in fpaths], fpaths)
+    for label, (match_one, match_batch) in matchers:
+        timed(f"{label}, per path", lambda fpaths: [match_one(fpath) for fpath in fpaths], fpaths, baseline)
+        def batches(fpaths):
+            for i in range(0, len(fpaths), PATH_BATCH_SIZE):
+                match_batch(fpaths[i:i + PATH_BATCH_SIZE])
+        timed(f"{label}, batches of {PATH_BATCH_SIZE}", batches, fpaths, baseline)
@@ -0,0 +1,93 @@
+"""
+Benchmark of directory walking methods on a synthetic tree shaped like the ones we raid - a deep testdisk-style
+    filesystem and a wide photorec-style set of recup_dir.N directories - comparing os.walk, scan_files,
+    and parallel_scan_files with different numbers of threads.
+
+By default the tree is walked with a warm page cache, which mostly measures CPU overhead. If run as root with --cold,
+    caches are dropped before each walk, which is much closer to walking a real tomb on a spinning disk.
+    Use --root to put the tree on the volume you actually want to measure (e.g. a network mount).
+
+Expect the threaded walks to lose on a warm cache or fast local SSD, where listing a directory is a few microseconds
+    of CPU and the threads just contend for the GIL (~0.5x os.walk on a 40k file tree in tmpfs). They only win when
+    each listing has to wait on the device, which is exactly the slow / network-backed tomb volume case.
+
+run:
+python3 bench_walk.py [--root DIR] [--files N] [--cold]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+from filesystem_utils import *
+
+# Shape of the synthetic tree
+DEFAULT_FILES = 200_000
+RECUP_DIR_FILES = 500 # photorec puts 500 files in each recup_dir.N
+TESTDISK_DEPTH = 8
+TESTDISK_FANOUT = 4
+
+
+def make_tree(root, n_files):
+    # Half of the files go in a testdisk-style tree TESTDISK_DEPTH deep, half in photorec-style recup_dirs.
+    # Files are empty, since we're only measuring the walk.
+    testdisk_dirs = [os.path.join(root, "testdisk")]
+    for depth in range(TESTDISK_DEPTH):
+        testdisk_dirs = [os.path.join(d, f"dir{i}") for d in testdisk_dirs for i in range(TESTDISK_FANOUT)][:n_files // 20 or 1]
+    for d in testdisk_dirs:
+        os.makedirs(d, exist_ok=True)
+    for i in range(n_files // 2):
+        open(os.path.join(testdisk_dirs[i % len(testdisk_dirs)], f"file{i}.txt"), "w").close()
+
+    for i in range(n_files - n_files // 2):
+        d = os.path.join(root, "photorec", f"recup_dir.{i // RECUP_DIR_FILES + 1}")
+        if i % RECUP_DIR_FILES == 0:
+            os.makedirs(d)
+        open(os.path.join(d, f"f{i:08d}.jpg"), "w").close()
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def os_walk(root):
+    return sum(len(files) for _, _, files in os.walk(root))
+
+
+def timed(label, walk, root, cold, baseline=None):
+    if cold:
+        drop_caches()
+    start = time.perf_counter()
+    n = walk(root)
+    elapsed = time.perf_counter() - start
+    speedup = f"{baseline / elapsed:6.2f}x" if baseline else "   1.00x"
+    print(f"{label.ljust(34)} | {n:>10,} files | {elapsed:8.3f}s | {n / elapsed:>12,.0f} files/s | {speedup}")
+    return elapsed
+
+
+if __name__ == "__main__":
+    root = None
+    n_files = DEFAULT_FILES
+    cold = "--cold" in sys.argv
+    if "--root" in sys.argv:
+        root = sys.argv[sys.argv.index("--root") + 1]
+    if "--files" in sys.argv:
+        n_files = int(sys.argv[sys.argv.index("--files") + 1])
+    if cold and os.geteuid() != 0:
+        print("--cold requires root to drop the page cache.")
+        sys.exit(1)
+
+    tree = tempfile.mkdtemp(prefix="bench_walk_", dir=root)
+    try:
+        print(f"Creating synthetic tree of {n_files:,} files in {tree}...")
+        make_tree(tree, n_files)
+
+        baseline = timed("os.walk", os_walk, tree, cold)
+        timed("scan_files", lambda r: sum(1 for _ in scan_files(r)), tree, cold, baseline)
+        for workers in [2, 4, 8, 16, 32]:
+            timed(f"parallel_scan_files ({workers} threads)", lambda r: sum(1 for _ in parallel_scan_files(r, workers)), tree, cold, baseline)
+        timed(f"parallel_scan_files (16, ordered)", lambda r: sum(1 for _ in parallel_scan_files(r, 16, ordered=True)), tree, cold, baseline)
+    finally:
+        shutil.rmtree(tree)
@@ -0,0 +1,245 @@
+"""
+Deterministic synthetic tomb generator, for benchmarking raid_filesystem, deduplicate, crypto_salvager and
+    analyse_tombs (see run_benchmarks.py) on the same tomb every time rather than whatever drive is lying around.
+
+Makes the same layout tomb_raider.sh leaves for raiding:
+    root/tomb/testdisk/      - testdisk-style filesystem trees, with real-looking directories and filenames
+    root/tomb/photorec/      - photorec-style photorec.N directories (photorec's recup_dir.N, under the prefix
+                               tomb_raider.sh gives it) of RECUP_DIR_FILES f<offset>.<ext> files each
+    root/known.u128.npy      - known hashes database (see known_utils), with the md5s of a fraction of the files,
+                               as if they were NSRL-known system files, plus filler digests
+    root/balances.npy        - small balance snapshot (see balance_utils), so salvaging never calls an API
+    root/manifest.json       - the parameters the tomb was made with, and what ended up in it
+
+Everything is controllable - number of files, size distribution (log-normal), duplicate and known ratios,
+    the mix of file types, and how often crypto strings are planted - and the same parameters and seed always give
+    byte-identical trees. Files have real headers for their type so libmagic sorts them like the real thing.
+
+run:
+python3 make_tomb.py root/ [--files N] [--seed S] [--median-kb KB] [--sigma S] [--max-mb MB] [--dup-ratio R]
+    [--known-ratio R] [--plant-rate R] [--testdisk-ratio R] [--types jpg=30,txt=20,...]
+"""
+import io
+import os
+import sys
+import json
+import math
+import zlib
+import random
+import shutil
+import hashlib
+import zipfile
+import numpy as np
+from tqdm import tqdm
+from known_utils import *
+from balance_utils import *
+
+# photorec puts 500 files in each recup_dir.N
+RECUP_DIR_FILES = 500
+
+# Max depth of the generated testdisk directory trees
+TESTDISK_DEPTH = 6
+
+# Filler digests in the known hashes database, so lookups aren't against a trivially tiny one
+KNOWN_FILLER = 100_000
+
+# Prefix table bits for the generated known hashes database, much smaller than the NSRL default
+KNOWN_PREFIX_BITS = 16
+
+DEFAULT_PARAMS = {
+    "files": 20_000,
+    "seed": 0,
+    "median_kb": 16, # Median file size, sizes are log-normal around it
+    "sigma": 1.5, # Spread of file sizes, in log space
+    "max_mb": 64, # No file bigger than this
+    "dup_ratio": 0.2, # Fraction of files that are copies of an earlier file
+    "known_ratio": 0.1, # Fraction of files whose md5s go in the known hashes database
+    "plant_rate": 0.01, # Fraction of files with a crypto string planted in their contents (or name, for testdisk)
+    "testdisk_ratio": 0.5, # Fraction of files in testdisk rather than photorec
+    "types": "jpg=25,png=10,gif=3,pdf=5,zip=5,txt=15,html=10,exe=5,dll=7,mp3=5,bin=10",
+}
+
+WORDS = ["the", "data", "file", "program", "settings", "window", "user", "error", "path", "backup", "report", "photo",
+         "system", "config", "update", "music", "video", "notes", "invoice", "draft", "final", "copy", "old", "new"]
+
+DIR_NAMES = ["Users", "user", "Documents", "Desktop", "Downloads", "Pictures", "My Music", "AppData", "Roaming",
+             "Local", "Program Files", "Program Files (x86)", "Windows", "System32", "Temp", "Projects", "2014",
+             "Holiday - Spain", "cache", "lib", "share", "home", "backup old", "Drivers", "Fonts"]
+
+# Planted in file contents - program names and words the salvager rules look for
+CRYPTO_STRINGS = [b"wallet.dat", b"bitcoin", b"Bitcoin Core", b"electrum-4.1.5-portable.exe", b"Ledger Live.exe",
+                  b"exodus.exe", b"Ethereum", b"dogecoin-qt.exe", b"Cryptocurrency"]
+
+# Planted as testdisk filenames
+CRYPTO_FNAMES = ["wallet.dat", "electrum-4.1.5-portable.exe", "Exodus.exe", "bitcoin-qt.exe", "monero-wallet-gui.exe"]
+
+
+def text_bytes(rng, size):
+    # Lines of random words, size bytes of them.
+    out = []
+    n = 0
+    while n < size:
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 16))) + "\n"
+        out.append(line)
+        n += len(line)
+    return "".join(out).encode()[:size]
+
+
+def png_chunk(kind, data):
+    return len(data).to_bytes(4, "big") + kind + data + zlib.crc32(kind + data).to_bytes(4, "big")
+
+
+def zip_bytes(rng, size):
+    # A real zip, with one stored text member, so it's the size we asked for.
+    # Fixed timestamp, otherwise it'd be now and the tomb would differ every run.
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as z:
+        z.writestr(zipfile.ZipInfo(f"{rng.choice(WORDS)}.txt", date_time=(2014, 1, 1, 0, 0, 0)), text_bytes(rng, max(size - 128, 0)))
+    return buf.getvalue()
+
+
+# Contents of each type, as a function of (rng, size). Real headers (and trailers) where libmagic looks for them.
+CONTENTS = {
+    "jpg": lambda rng, size: b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00" + rng.randbytes(max(size - 22, 0)) + b"\xff\xd9",
+    "png": lambda rng, size: b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", (640).to_bytes(4, "big") + (480).to_bytes(4, "big") + b"\x08\x02\x00\x00\x00") + rng.randbytes(max(size - 33, 0)),
+    "gif": lambda rng, size: b"GIF89a\x80\x02\xe0\x01\x00\x00\x00" + rng.randbytes(max(size - 13, 0)),
+    "pdf": lambda rng, size: b"%PDF-1.4\n" + text_bytes(rng, max(size - 15, 0)) + b"\n%%EOF",
+    "zip": zip_bytes,
+    "txt": text_bytes,
+    "html": lambda rng, size: b"<!DOCTYPE html>\n<html><body>\n" + text_bytes(rng, max(size - 45, 0)) + b"\n</body></html>\n",
+    "exe": lambda rng, size: b"MZ\x90\x00\x03\x00\x00\x00\x04\x00\x00\x00\xff\xff\x00\x00" + rng.randbytes(max(size - 16, 0)),
+    "dll": lambda rng, size: b"MZ\x90\x00\x03\x00\x00\x00\x04\x00\x00\x00\xff\xff\x00\x00" + rng.randbytes(max(size - 16, 0)),
+    "mp3": lambda rng, size: b"ID3\x03\x00\x00\x00\x00\x00\x00" + b"\xff\xfb\x90\x64" * 64 + rng.randbytes(max(size - 266, 0)),
+    "bin": lambda rng, size: rng.randbytes(size),
+}
+
+
+def parse_params(argv):
+    """
+    Parse the generator's --flags out of argv (removing them), on top of DEFAULT_PARAMS.
+        Shared with run_benchmarks.py, so it takes the same flags.
+
+    :param argv: Argument list, e.g. sys.argv, modified in place
+    :return: Dict of parameters
+    """
+    params = dict(DEFAULT_PARAMS)
+    for key, default in DEFAULT_PARAMS.items():
+        flag = "--" + key.replace("_", "-")
+        if flag in argv:
+            i = argv.index(flag)
+            params[key] = type(default)(argv[i+1])
+            del argv[i:i+2]
+    return params
+
+
+def parse_types(types):
+    # "jpg=25,png=10" -> (["jpg", "png"], [25.0, 10.0])
+    exts, weights = [], []
+    for entry in types.split(","):
+        ext, weight = entry.split("=")
+        if ext not in CONTENTS:
+            raise ValueError(f"Unknown file type {ext}, can be any of {', '.join(CONTENTS)}")
+        exts.append(ext)
+        weights.append(float(weight))
+    return exts, weights
+
+
+def testdisk_dir(rng):
+    # A random directory in one of a few partitions, as testdisk recovers them
+    parts = [f"partition{rng.randint(1, 2)}"] + [rng.choice(DIR_NAMES) for _ in range(rng.randint(1, TESTDISK_DEPTH))]
+    return os.path.join(*parts)
+
+
+def make_tomb(root, params):
+    """
+    Generate a synthetic tomb at root (see the top of this file for the layout). root/tomb must not exist yet.
+
+    :param root: Directory to make the tomb in
+    :param params: Parameters, as from parse_params
+    :return: Manifest dict, also written to root/manifest.json
+    """
+    rng = random.Random(params["seed"])
+    exts, weights = parse_types(params["types"])
+    median = params["median_kb"] * 1024
+    max_size = params["max_mb"] * 2**20
+    tomb = os.path.join(root, "tomb")
+    os.makedirs(tomb)
+
+    written = [] # Paths of every file so far, for duplicates to copy
+    known = []
+    counts = {"files": 0, "bytes": 0, "duplicates": 0, "known": 0, "planted": 0, "testdisk": 0, "photorec": 0}
+    photorec_i = 0
+    for i in tqdm(range(params["files"]), desc="Generating tomb", unit=" files"):
+        ext = rng.choices(exts, weights)[0]
+        if rng.random() < params["testdisk_ratio"]:
+            fname = f"{rng.choice(WORDS)}{rng.choice(['_', ' ', '-', ''])}{i}.{ext}"
+            if rng.random() < params["plant_rate"]:
+                fname = rng.choice(CRYPTO_FNAMES)
+                counts["planted"] += 1
+            fpath = os.path.join(tomb, "testdisk", testdisk_dir(rng), fname)
+            counts["testdisk"] += 1
+        else:
+            fpath = os.path.join(tomb, "photorec", f"photorec.{photorec_i // RECUP_DIR_FILES + 1}", f"f{photorec_i * 8:07d}.{ext}")
+            photorec_i += 1
+            counts["photorec"] += 1
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        fpath = fpath if not os.path.exists(fpath) else f"{fpath}.{i}"
+
+        if len(written) > 0 and rng.random() < params["dup_ratio"]:
+            # Byte-identical copy of an earlier file, under this one's name
+            shutil.copyfile(rng.choice(written), fpath)
+            counts["duplicates"] += 1
+        else:
+            size = min(int(rng.lognormvariate(math.log(median), params["sigma"])), max_size)
+            data = CONTENTS[ext](rng, size)
+            if rng.random() < params["plant_rate"]:
+                # Somewhere after the header, sometimes with a private key candidate (64 hex chars) next to it
+                planted = b" " + rng.choice(CRYPTO_STRINGS) + b" "
+                if rng.random() < 0.5:
+                    planted += rng.randbytes(32).hex().encode() + b"\n"
+                at = rng.randint(min(64, len(data)), len(data))
+                data = data[:at] + planted + data[at:]
+                counts["planted"] += 1
+            with open(fpath, "wb") as f:
+                f.write(data)
+            if rng.random() < params["known_ratio"]:
+                known.append(hashlib.md5(data).digest())
+                counts["known"] += 1
+        written.append(fpath)
+        counts["files"] += 1
+        counts["bytes"] += os.path.getsize(fpath)
+
+    # Known hashes database, the same packed format as build_known_md5s makes
+    known.extend(rng.randbytes(16) for _ in range(KNOWN_FILLER))
+    hi, lo = split_digests(known)
+    order = np.lexsort((lo, hi))
+    known_fname = os.path.join(root, "known" + KNOWN_MD5S_SUFFIX)
+    np.save(known_fname, np.stack((hi[order], lo[order])))
+    np.save(prefix_fname(known_fname), build_known_prefix(np.load(known_fname, mmap_mode="r"), KNOWN_PREFIX_BITS))
+
+    # Balance snapshot, of made up addresses - none of the planted keys are worth anything
+    dump_fname = os.path.join(root, "balances.tsv")
+    with open(dump_fname, "w") as f:
+        for j in range(1000):
+            f.write(f"1Bench{rng.randbytes(12).hex()}\t{rng.randint(1, SATOSHIS_PER_BTC)}\n")
+    build_balance_snapshot(dump_fname, os.path.join(root, "balances.npy"))
+    os.remove(dump_fname)
+
+    manifest = {"params": params, "counts": counts}
+    with open(os.path.join(root, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+if __name__ == "__main__":
+    params = parse_params(sys.argv)
+    if len(sys.argv) != 2:
+        print("Usage: python3 make_tomb.py root/ [--files N] [--seed S] [--median-kb KB] [--sigma S] [--max-mb MB] "
+              "[--dup-ratio R] [--known-ratio R] [--plant-rate R] [--testdisk-ratio R] [--types jpg=30,txt=20,...]")
+        sys.exit(1)
+
+    manifest = make_tomb(sys.argv[1], params)
+    counts = manifest["counts"]
+    print(f"Made tomb of {counts['files']:,} files ({counts['bytes']/2**20:,.1f}MB) at {sys.argv[1]}: "
+          f"{counts['testdisk']:,} testdisk, {counts['photorec']:,} photorec, {counts['duplicates']:,} duplicates, "
+          f"{counts['known']:,} known, {counts['planted']:,} with crypto strings planted.")
@@ -0,0 +1,231 @@
+"""
+Benchmark runner for the whole pipeline - raid_filesystem, deduplicate, crypto_salvager and analyse_tombs - on a
+    synthetic tomb from make_tomb.py, so there are actual numbers to compare rather than anecdotes in comments.
+
+The tomb is generated once, and each stage is run as its own process (the same way tomb_raider.sh runs them) on a
+    fresh copy of it, except salvaging and analysing, which run on the raided tomb as they would for real.
+    For each stage we record the wall time, files/s and MB/s over the files the stage was given, and the peak RSS
+    of the stage's biggest process (including its workers). Stage output goes to logs/<stage>.log in the work dir.
+
+Results are written as JSON, and compared against a stored baseline (baseline.json next to this file, written with
+    --save-baseline) - any stage more than --tolerance slower, or using that much more memory, is a regression, and
+    we exit with 1. Baselines only mean anything on the same machine with the same tomb parameters, so we warn if
+    the parameters differ.
+
+With --metrics, the stages also record their own per-stage metrics (see metrics_utils), written to their work dirs,
+    for where the time went inside each of them. Use with --keep to look at them afterwards.
+
+run (with TombRaider's root, containing utils/, on the path):
+python3 run_benchmarks.py [--stages raid,deduplicate,salvage,analyse] [-w workers] [--dir DIR] [--keep]
+    [--out results.json] [--baseline FILE] [--save-baseline] [--tolerance T] [--metrics] [any make_tomb.py flags]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+from make_tomb import *
+from filesystem_utils import *
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR) # TombRaider's root
+
+STAGES = ["raid", "deduplicate", "salvage", "analyse"]
+
+BASELINE_FNAME = os.path.join(BENCH_DIR, "baseline.json")
+RESULTS_FNAME = "bench_results.json"
+
+# How much slower (or bigger) than the baseline a stage can be before it's a regression, as a fraction
+DEFAULT_TOLERANCE = 0.15
+
+
+def stage_command(stage, root, workers, metrics=False):
+    # Command to run stage from its work dir, which has the tomb in it at tomb/.
+    # With metrics, stages that have them write their per-stage metrics (see metrics_utils) into the work dir too.
+    python = sys.executable
+    flags = ["--metrics"] if metrics else []
+    if stage == "raid":
+        return [python, os.path.join(ROOT, "raid_filesystem.py"), "tomb/testdisk", "tomb/photorec", "tomb",
+                os.path.join(root, "known" + KNOWN_MD5S_SUFFIX), "-w", str(workers)] + flags
+    if stage == "deduplicate":
+        return [python, os.path.join(ROOT, "deduplicate.py"), "tomb"] + flags
+    if stage == "salvage":
+        return [python, os.path.join(ROOT, "crypto_salvager.py"), "tomb", "-w", str(workers),
+                "--balances", os.path.join(root, "balances.npy"), "--ledger", "salvage.ledger"] + flags
+    if stage == "analyse":
+        return [python, os.path.join(ROOT, "scripts", "analyse_tombs.py"), "."]
+    raise ValueError(f"Unknown stage {stage}, can be any of {', '.join(STAGES)}")
+
+
+def tree_size(dir):
+    # (files, bytes) of everything under dir
+    files, size = 0, 0
+    for entry in scan_files(dir, filter=isregular):
+        files += 1
+        size += entry.stat(follow_symlinks=False).st_size
+    return files, size
+
+
+def run_stage(stage, root, workdir, workers, metrics=False):
+    """
+    Run one stage as a subprocess in workdir, timing it and getting its peak memory use.
+
+    :return: Dict of the stage's results
+    """
+    files, size = tree_size(os.path.join(workdir, "tomb"))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ROOT, os.path.join(ROOT, "utils")] + [env["PYTHONPATH"]] * ("PYTHONPATH" in env))
+    os.makedirs(os.path.join(root, "logs"), exist_ok=True)
+    log_fname = os.path.join(root, "logs", f"{stage}.log")
+
+    with open(log_fname, "w") as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(stage_command(stage, root, workers, metrics), cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 rather than wait, for the resource usage of this stage alone. ru_maxrss covers its workers too,
+        # as the biggest of them, and is in KB on Linux.
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    if proc.returncode != 0:
+        print(f"{stage} failed with exit code {proc.returncode}, see {log_fname}")
+    return {
+        "seconds": elapsed,
+        "files": files,
+        "mb": size / 2**20,
+        "files_per_s": files / elapsed,
+        "mb_per_s": size / 2**20 / elapsed,
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "returncode": proc.returncode,
+    }
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(), "commit": commit}
+
+
+def run_benchmarks(root, params, stages, workers, metrics=False):
+    """
+    Generate the tomb at root and run each of stages on it.
+
+    :return: Results dict, with the parameters, machine, tomb manifest, and each stage's results
+    """
+    manifest = make_tomb(root, params)
+    pristine = os.path.join(root, "tomb")
+    results = {"params": params, "workers": workers, "machine": machine_info(), "tomb": manifest["counts"], "stages": {}}
+
+    for stage in stages:
+        # Salvaging and analysing run on the raided tomb, if we raided it, everything else on a fresh copy
+        workdir = os.path.join(root, "runs", stage)
+        if stage in ("salvage", "analyse") and "raid" in stages:
+            workdir = os.path.join(root, "runs", "raid")
+        else:
+            shutil.copytree(pristine, os.path.join(workdir, "tomb"), symlinks=True)
+        print(f"Running {stage}...")
+        results["stages"][stage] = run_stage(stage, root, workdir, workers, metrics)
+    return results
+
+
+def print_results(results, baseline=None, tolerance=DEFAULT_TOLERANCE):
+    """
+    Print each stage's results, and how they compare to baseline if given.
+
+    :return: List of stages that regressed against the baseline
+    """
+    regressions = []
+    print(f"{'STAGE'.ljust(12)} | {'FILES':>9} | {'SECONDS':>9} | {'FILES/S':>10} | {'MB/S':>8} | {'PEAK RSS':>10} | VS BASELINE")
+    for stage, r in results["stages"].items():
+        row = f"{stage.ljust(12)} | {r['files']:>9,} | {r['seconds']:>9.2f} | {r['files_per_s']:>10,.1f} | {r['mb_per_s']:>8,.1f} | {r['peak_rss_mb']:>8,.1f}MB |"
+        if r["returncode"] != 0:
+            row += " FAILED"
+        elif baseline is not None and stage in baseline["stages"]:
+            b = baseline["stages"][stage]
+            speed = r["files_per_s"] / b["files_per_s"]
+            memory = r["peak_rss_mb"] / b["peak_rss_mb"]
+            row += f" {speed:.2f}x speed, {memory:.2f}x memory"
+            if speed < 1 - tolerance or memory > 1 + tolerance:
+                row += " REGRESSION"
+                regressions.append(stage)
+        print(row)
+    return regressions
+
+
+if __name__ == "__main__":
+    params = parse_params(sys.argv)
+
+    stages = STAGES
+    if "--stages" in sys.argv:
+        i = sys.argv.index("--stages")
+        stages = sys.argv[i+1].split(",")
+        del sys.argv[i:i+2]
+    workers = os.cpu_count()
+    for flag in ["-w", "--workers"]:
+        if flag in sys.argv:
+            i = sys.argv.index(flag)
+            workers = int(sys.argv[i+1])
+            del sys.argv[i:i+2]
+    dir = None
+    if "--dir" in sys.argv:
+        i = sys.argv.index("--dir")
+        dir = sys.argv[i+1]
+        del sys.argv[i:i+2]
+    out_fname = RESULTS_FNAME
+    if "--out" in sys.argv:
+        i = sys.argv.index("--out")
+        out_fname = sys.argv[i+1]
+        del sys.argv[i:i+2]
+    baseline_fname = BASELINE_FNAME
+    if "--baseline" in sys.argv:
+        i = sys.argv.index("--baseline")
+        baseline_fname = sys.argv[i+1]
+        del sys.argv[i:i+2]
+    tolerance = DEFAULT_TOLERANCE
+    if "--tolerance" in sys.argv:
+        i = sys.argv.index("--tolerance")
+        tolerance = float(sys.argv[i+1])
+        del sys.argv[i:i+2]
+    keep = "--keep" in sys.argv
+    save_baseline = "--save-baseline" in sys.argv
+    metrics = "--metrics" in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg not in ("--keep", "--save-baseline", "--metrics")]
+    if len(sys.argv) != 1 or any(stage not in STAGES for stage in stages):
+        print("Usage: python3 run_benchmarks.py [--stages raid,deduplicate,salvage,analyse] [-w workers] [--dir DIR] [--keep] "
+              "[--out results.json] [--baseline FILE] [--save-baseline] [--tolerance T] [--metrics] [any make_tomb.py flags]")
+        sys.exit(1)
+
+    # Stages are run in pipeline order, whatever order they're given in
+    stages = [stage for stage in STAGES if stage in stages]
+    root = tempfile.mkdtemp(prefix="tomb_bench_", dir=dir)
+    try:
+        results = run_benchmarks(root, params, stages, workers, metrics)
+    finally:
+        if keep:
+            print(f"Kept the benchmark tomb and logs at {root}")
+        else:
+            shutil.rmtree(root)
+
+    with open(out_fname, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Wrote results to {out_fname}")
+
+    baseline = None
+    if os.path.exists(baseline_fname) and not save_baseline:
+        with open(baseline_fname) as f:
+            baseline = json.load(f)
+        if baseline["params"] != results["params"]:
+            print(f"Warning: baseline {baseline_fname} was made with different tomb parameters, so isn't comparable.")
+    regressions = print_results(results, baseline, tolerance)
+
+    if save_baseline:
+        with open(baseline_fname, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Saved as the baseline at {baseline_fname}")
+    if any(r["returncode"] != 0 for r in results["stages"].values()) or len(regressions) > 0:
+        sys.exit(1)
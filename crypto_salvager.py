@@ -7,12 +7,33 @@ from tqdm import tqdm
 # from filesystem_utils import sanitize
 
 from utils import filesystem_utils as fs
+from utils import index_utils
+from utils import scan_utils
+from utils import balance_utils
+from utils.findings_utils import *
+from utils.metrics_utils import *
 
 from bit import Key
 from bit.format import bytes_to_wif
 import mmap
 import traceback
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse # Before Python 3.11
 from termcolor import colored
+import time
+import multiprocessing
+import itertools
+import bisect
+from collections import Counter
+
+# Optional - if pyahocorasick is installed the literal rules are matched with a real Aho-Corasick automaton,
+# otherwise with one combined regex, see compile_content_matcher.
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 # Format is ["Label", True/False (if regex), "Rule"]
 # NOTE: ALMOST ALL OF THESE ARE FROM AUTOPSY
@@ -100,19 +121,17 @@ for i,rule in enumerate(ruleset):
 # def to_ascii(text):
 #     # Normalize to Unicode NFC form and remove non-ASCII characters
 #     return ''.join(char for char in unicodedata.normalize('NFC', text) if ord(char) < 128)
-def filter_to_ordinal_range(text, min_ord, max_ord):
-    return ''.join(char for char in text if min_ord <= ord(char) <= max_ord)
+# Every byte outside of the printable range (32-128), which we strip before checking for noise, since yes,
+# i've had ones filled with control codes. bytes.translate deletes them all in one go.
+UNPRINTABLE_BYTES = bytes(b for b in range(256) if not 32 <= b <= 128)
 
-
-def is_known_noise(line, idx, pattern):
-    # Returns true if the pattern is a noise pattern
-    # We don't want to match on these
-    # We have some hardcoded checks to reduce these for saving time looking through results
-
-    # skip this whole thing if it's not in the checks
-    if pattern.lower() not in ["neon.exe", "bitcoin"]: return False
-
-    BITCOIN_NOISE_CONTEXTS = [
+# Contexts a pattern is found in which we know are noise - we don't want to match on these.
+NOISE_CONTEXTS = {
+    # check if neon rather than edge-neon
+    "neon.exe": [
+        "edge-neon.exe",
+    ],
+    "bitcoin": [
         "blog.bitcoin.cz",
         ".fa-bitcoin",
         ".glyphicon-bitcoin",
@@ -136,30 +155,25 @@ def is_known_noise(line, idx, pattern):
         "bitcoin_64.png",
         "bitcoin-qt.svg",
         "bitcoin.svg",
+    ],
+}
 
-    ]
-
-    # check if neon rather than edge-neon
-    pattern = pattern.lower()
 
-    # because yes, i've had ones filled with control codes.
-    # we redo the index after converting to readable chars.
-    line = filter_to_ordinal_range(line, 32, 128).lower()
-    idx = line.index(pattern)
-    prefix = line[max(idx - 80,0):idx]
-    suffix = line[idx + len(pattern):min(idx + len(pattern) + 80, len(line))]
-    context = prefix + pattern + suffix
-    context = filter_to_ordinal_range(context, 32, 128).lower()
-    if "neon.exe" == pattern and "edge-neon.exe" in context:
-        return True
+def is_known_noise(prefix, match, suffix):
+    # Returns true if the match, with the bytes either side of it, is a noise pattern
+    # We don't want to match on these
+    # We have some hardcoded checks to reduce these for saving time looking through results
+    # Each pattern's noise contexts are a single compiled matcher (see noise_matchers, below).
+    pattern = match.lower()
 
-    if "bitcoin" == pattern:
-        for noise_context in BITCOIN_NOISE_CONTEXTS:
-            if noise_context in context: return True
+    # skip this whole thing if it's not in the checks
+    if pattern not in noise_matchers: return False
 
-    with open("crypto_matches.log", "a") as f:
-        f.write(f"{pattern}+{suffix}\n")
-    return False
+    # we redo the index after stripping the unreadable bytes.
+    line = (prefix + match + suffix).translate(None, UNPRINTABLE_BYTES).lower()
+    idx = line.find(pattern)
+    context = line[max(idx - 80,0):idx + len(pattern) + 80]
+    return noise_matchers[pattern].search(context) is not None
 
 
 # Preprocess these string ops so we don't repeat them a million times
@@ -170,128 +184,227 @@ for i,rule in enumerate(ruleset):
         pattern_sanitize = fs.sanitize(pattern)
         ruleset[i][2] = [pattern, pattern_lower, pattern_sanitize]
 
-def apply_ruleset(fpath):
-    # Given a fpath, check it against all of our rules, and print any matches.
-    matches = []
-    for rule in ruleset:
-        label,is_regex,pattern,_ = rule
-        if is_regex:
-            # Rule is Regex, apply and check
-            # No need to modify pattern since we already did that in the ruleset, plus if we did then we'd have
-            # to recompile. This just runs variants on the fpath instead. This will run all combinations as a result.
-            if bool(re.search(pattern, fpath)) or bool(re.search(pattern, fpath.lower())) or bool(re.search(pattern, fs.sanitize(fpath))):
-                # pattern match, save this
-                matches.append((label, pattern))
-
-
-        else:
-            # Rule is simple substring check, check lowercase and sanitized versions as well
-            pattern, pattern_lower, pattern_sanitize = pattern
-            if pattern in fpath or pattern_lower in fpath or pattern_sanitize in fpath:
-                matches.append((label, pattern))
-
-    # Print any matches
-    for label, pattern in matches:
-        print(f"MATCH FOUND: '{label}' with pattern '{pattern}' matched for filepath '{fpath}'")
-
 GB = 1024*1024*1024
 MB = 1024*1024
 KB = 1024
-def file_chunked_lines(fpath, large_file_size=GB, chunk_size=MB):
+def trie_pattern(words):
+    # Regex pattern matching any of words, factored into a trie - e.g. b"electrum", b"electron" become
+    # b"electr(?:on|um)" - since Python's re tries each branch of a plain alternation one by one at every position,
+    # which gets slow with a hundred-odd branches. Same matches, about twice as fast here.
+    # Bytes or str, the same as words.
+    trie = {}
+    empty = b""
+    for word in words:
+        empty = word[:0]
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[None] = None
+    is_bytes = isinstance(empty, bytes)
+    syntax = lambda s: s.encode() if is_bytes else s
+
+    def build(node):
+        alts = [re.escape(bytes([c]) if is_bytes else c) + build(child) for c, child in sorted((k, v) for k, v in node.items() if k is not None)]
+        if len(alts) == 0:
+            return empty
+        body = syntax("(?:") + syntax("|").join(alts) + syntax(")") if len(alts) > 1 else alts[0]
+        return syntax("(?:") + body + syntax(")?") if None in node else body
+    return build(trie)
+
+def compile_content_matcher(ruleset):
     """
-    Given a file, read the file in chunks, and yield the lines separated by \n in each chunk,
-        so that we are iterating over lines in the file, but not loading the whole file into memory,
-        instead reading it in chunks of size chunk_size, then separating it into lines,
-        and keeping the last line of each chunk so that we do not miss any matches that may be split across chunks.
-
-    :param fpath: The file to read
-    :param large_file_size: If the file is larger than this, we will use a progress bar (Bytes)
-    :param chunk_size: The size of each chunk to read  (Bytes)
-    :return: Yields lines from the file
+    Compile the whole ruleset into one matcher for file contents, so each buffer is scanned once for every rule,
+        rather than once per variant of every rule (that was ~60 rules x 3 substring checks per line).
+
+    Literal rules - every variant (original, lower, sanitized) - are matched case-insensitively in one pass over the
+        lowercased raw bytes. With pyahocorasick, that's an Aho-Corasick automaton which finds every variant at once.
+        Without it, it's one regex of all of them (see trie_pattern), which finds if any rule matches at all - almost
+        no buffers match anything, so only the rare ones that do are checked variant by variant.
+    Regex rules are one combined alternation the same way, and only run individually on buffers it matches.
+
+    The matcher works on a window of a buffer - buf[start:end], which can be a memory-mapped file - and only reports
+        matches starting before limit, since with mmap_windows those after it are found again in the next window.
+        Regexes search the window in place, only the literal matching needs a (lowercased) copy of it.
+
+    :param ruleset: Ruleset as preprocessed above, literal patterns as [pattern, pattern_lower, pattern_sanitize]
+    :return: (content_matches, max_length) - content_matches being a function of (buf, start=0, end=None, limit=None)
+        returning [(rule index, offset in buf, length), ...] for every match of every rule in the window,
+        sorted by rule index then offset, and max_length the longest any match can be, for how much windows need
+        to overlap.
     """
-    if not fs.is_regular_file(fpath): return
-
-    # Check if file is large
-    file_size = os.path.getsize(fpath)
-    large_file = file_size > large_file_size
-
-    # If not large, skip all this and read it all into memory
-    # if not large_file:
-    #     with open(fpath, 'rb') as f:
-    #         for line in f:
-    #             yield line
-    #     return
-    #
-    # If large, read in chunks with progress bar
-
-    # If large, use a progress bar
-    if large_file:
-        pbar = tqdm(total=file_size/MB, unit="MB")
-
-    with open(fpath, 'rb') as f:
-        overlap = b""
-        while True:
-            chunk = f.read(chunk_size)
-            if large_file:
-                pbar.update(chunk_size/MB)
-            if not chunk and not overlap:
-                break
-            chunk = overlap + chunk
-            lines = chunk.split(b'\n')
-
-            # If there's more data, keep the last line as overlap into next chunk
-            if len(lines) > 1:
-                overlap = lines.pop()
-            else:
-                overlap = b""
-
-            for line in lines:
-                yield line
-    if large_file:
-        pbar.close()
-    return
-
-def apply_ruleset_in_file(fpath):
-    matches = []
-    #candidates = re.findall(b'\x01\x01\x04\x20(.{32})', f.read())
-    for line_i, line in enumerate(file_chunked_lines(fpath)):
-        line = line.decode("ascii", "ignore")
-        for rule in ruleset:
-            label, is_regex, pattern, context_pattern = rule
-            #if not is_regex:
-            #line = line.decode("ascii", "ignore")
+    literals = {}
+    for i, (label, is_regex, pattern, _) in enumerate(ruleset):
+        if not is_regex:
+            for variant in pattern:
+                literals.setdefault(variant.lower().encode(), set()).add(i)
+    regexes = [(i, re.compile(rule[2].pattern.encode())) for i, rule in enumerate(ruleset) if rule[1]]
+    regex_any = re.compile(b"|".join(b"(?:" + regex.pattern + b")" for _, regex in regexes))
+    max_length = max([len(variant) for variant in literals] + [sre_parse.parse(regex.pattern).getwidth()[1] for _, regex in regexes])
+
+    if ahocorasick is not None:
+        # Keys as latin-1 strs, since that maps each byte to exactly one character.
+        automaton = ahocorasick.Automaton()
+        for variant, rules in literals.items():
+            automaton.add_word(variant.decode("latin-1"), (len(variant), rules))
+        automaton.make_automaton()
+
+        def literal_matches(lowered, found):
+            for end, (length, rules) in automaton.iter(lowered.decode("latin-1")):
+                for i in rules:
+                    found.setdefault((i, end - length + 1), length)
+    else:
+        literal_any = re.compile(trie_pattern(literals))
+
+        def literal_matches(lowered, found):
+            if not literal_any.search(lowered):
+                return
+            for variant, rules in literals.items():
+                idx = lowered.find(variant)
+                while idx != -1:
+                    for i in rules:
+                        found.setdefault((i, idx), len(variant))
+                    idx = lowered.find(variant, idx + 1)
+
+    def content_matches(buf, start=0, end=None, limit=None):
+        end = len(buf) if end is None else end
+        limit = end if limit is None else limit
+        found = {}
+        literal_matches(buf[start:end].lower(), found)
+        found = {(i, start + idx): length for (i, idx), length in found.items()}
+        if regex_any.search(buf, start, end):
+            for i, regex in regexes:
+                for match in regex.finditer(buf, start, end):
+                    found.setdefault((i, match.start()), match.end() - match.start())
+        return sorted((i, idx, length) for (i, idx), length in found.items() if idx < limit)
+
+    return content_matches, max_length
+
+content_matches, content_max_length = compile_content_matcher(ruleset)
+noise_matchers = {pattern.encode(): re.compile(trie_pattern(context.encode() for context in contexts))
+                  for pattern, contexts in NOISE_CONTEXTS.items()}
+
+# Number of paths matched against the rules at once by paths_matches
+PATH_BATCH_SIZE = 4096
+
+def compile_path_matcher(ruleset):
+    """
+    Compile the whole ruleset into a matcher for filepaths, rather than checking every path against every rule
+        (and for the regex ones, re.search on three variants of the path, sanitizing it again each time).
+
+    Paths are matched in batches. Each path's variants - as it is, lowercase, and sanitized - are computed once, and
+        all of a batch's paths are joined into one string, newline separated so nothing matches across two of them,
+        since neither the literals nor . match a newline. Literal rules only ever matched the path as it is, so they're
+        found in the joined paths in one pass (Aho-Corasick if pyahocorasick is installed, otherwise one combined regex,
+        same as compile_content_matcher). Regex rules are each run over the joined variants of the whole batch, rather
+        than once per variant per path - on their own rather than combined, since each starts with a literal prefix
+        that re can skip ahead to, which it can't once they're all in one alternation.
+    Almost no paths match anything, so only the rare ones that do are checked rule by rule, exactly as before, so the
+        matches are the same.
+
+    :param ruleset: Ruleset as preprocessed above, literal patterns as [pattern, pattern_lower, pattern_sanitize]
+    :return: (path_matches, paths_matches) - path_matches a function of a fpath returning [(label, pattern), ...]
+        for every rule it matches, and paths_matches a function of a list of fpaths returning
+        {fpath: [(label, pattern), ...]} for only the fpaths that match anything.
+    """
+    literals = {variant for _, is_regex, pattern, _ in ruleset if not is_regex for variant in pattern}
+    # Same pattern can be in more than one rule, only need to find it once
+    regexes = list({pattern.pattern: pattern for _, is_regex, pattern, _ in ruleset if is_regex}.values())
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for literal in literals:
+            automaton.add_word(literal, len(literal))
+        automaton.make_automaton()
+        literal_starts = lambda joined: (end - length + 1 for end, length in automaton.iter(joined))
+    else:
+        literal_any = re.compile(trie_pattern(sorted(literals)))
+        literal_starts = lambda joined: (match.start() for match in literal_any.finditer(joined))
 
+    def rule_matches(fpath, fpath_lower, fpath_sanitize):
+        matches = []
+        for label, is_regex, pattern, _ in ruleset:
             if is_regex:
-                if pattern.search(line):
-                    matches.append((line_i, line, rule))
-
+                # No need to modify pattern since we already did that in the ruleset, plus if we did then we'd have
+                # to recompile. This just runs variants on the fpath instead.
+                if pattern.search(fpath) or pattern.search(fpath_lower) or pattern.search(fpath_sanitize):
+                    matches.append((label, pattern))
             else:
-                pattern, pattern_lower, pattern_sanitize = pattern
-                if pattern in line or pattern_lower in line or pattern_sanitize in line:
-                    matches.append((line_i, line, rule))
-        line_i+=1
+                # Rule is simple substring check, check lowercase and sanitized versions as well
+                if pattern[0] in fpath or pattern[1] in fpath or pattern[2] in fpath:
+                    matches.append((label, pattern[0]))
+        return matches
+
+    def paths_matches(fpaths):
+        variants = [(fpath, fpath.lower(), fs.sanitize(fpath)) for fpath in fpaths]
+        # Where each path (and its variants) starts in the joined strings, to find which path each match is in
+        starts = list(itertools.accumulate((len(fpath) + 1 for fpath in fpaths[:-1]), initial=0))
+        variant_starts = list(itertools.accumulate((sum(len(variant) + 1 for variant in v) for v in variants[:-1]), initial=0))
+
+        hits = set()
+        for idx in literal_starts("\n".join(fpaths)):
+            hits.add(bisect.bisect_right(starts, idx) - 1)
+        joined_variants = "\n".join("\n".join(v) for v in variants)
+        for regex in regexes:
+            for match in regex.finditer(joined_variants):
+                hits.add(bisect.bisect_right(variant_starts, match.start()) - 1)
+
+        matched = {}
+        for i in sorted(hits):
+            matches = rule_matches(*variants[i])
+            if len(matches) > 0:
+                matched[fpaths[i]] = matches
+        return matched
+
+    def path_matches(fpath):
+        return paths_matches([fpath]).get(fpath, [])
+
+    return path_matches, paths_matches
+
+path_matches, paths_matches = compile_path_matcher(ruleset)
+
+def print_path_matches(fpath, matches):
+    # Print any matches
+    for label, pattern in matches:
+        write_finding(kind="path", fpath=fpath, label=label, pattern=pattern if isinstance(pattern, str) else pattern.pattern)
+        print(f"MATCH FOUND: '{label}' with pattern '{pattern}' matched for filepath '{fpath}'")
 
+def apply_ruleset(fpath):
+    # Given a fpath, check it against all of our rules, and print any matches.
+    print_path_matches(fpath, path_matches(fpath))
+
+def match_paths(fpaths, batch_size=PATH_BATCH_SIZE):
+    # Match every one of fpaths against the rules, in batches of batch_size, returning {fpath: matches} for only
+    # the ones that match anything. The index itself is skipped, since it lists every path we've already matched.
+    fpaths = [fpath for fpath in fpaths if "filesystem.index" not in fpath]
+    matched = {}
+    for i in tqdm(range(0, len(fpaths), batch_size), desc="Matching filepaths", unit=" batches"):
+        with timed("paths", n=len(fpaths[i:i + batch_size])):
+            matched.update(paths_matches(fpaths[i:i + batch_size]))
+    return matched
+
+
+def match_context(buf, rule, idx, length):
+    # A match of rule at buf[idx:idx + length], with up to 80 bytes of context either side (but not past a newline),
+    # as (rule, offset, prefix, match, suffix). Copied out of buf, so it can be kept after buf is gone.
+    prefix = buf[max(idx - 80,0):idx]
+    prefix = prefix[prefix.rfind(b"\n") + 1:]
+    suffix = buf[idx + length:idx + length + 80].split(b"\n", 1)[0]
+    return rule, idx, bytes(prefix), bytes(buf[idx:idx + length]), bytes(suffix)
+
+def print_ruleset_matches(fpath, matches):
     # Print any matches with context, if there are any.
 
     print_strs = []
-    for line_i, line, (label, is_regex, pattern,context_pattern) in matches:
+    for (label, is_regex, pattern, context_pattern), offset, prefix, match, suffix in matches:
+        write_finding(kind="content", fpath=fpath, label=label, offset=offset, match=match, context=prefix + match + suffix)
+        prefix, p, suffix = [b.decode("ascii", "ignore") for b in (prefix, match, suffix)]
         if is_regex:
-            print_strs.append(f"\t{pattern} match:{colored(re.findall(pattern, line), 'red')}")
+            print_strs.append(f"\t{pattern} match:{colored(re.findall(pattern, p), 'red')}")
         else:
-            pattern, pattern_lower, pattern_sanitize = pattern
-            s = ""
-            if pattern in line:
-                p = pattern
-            elif pattern_lower in line:
-                p = pattern_lower
-            elif pattern_sanitize in line:
-                p = pattern_sanitize
-            idx = line.index(p)
-            if not is_known_noise(line, idx, p):
-                #s = f"\t{p} match:" + lines[idx - 80:idx] + colored(lines[idx:idx + len(p)], 'red') + lines[idx + len(p):idx + 80 + len(p)]
-                s = f"\t{p} match:" + line[max(idx - 80,0):idx] + colored(line[idx:(idx + len(p))], 'red') + line[(idx + len(p)):idx + 80 + len(p)]
-                s = s.replace('\r', ' ').replace('\n', ' ')
-                print_strs.append(s)
+            # Matched case-insensitively, so show it as it actually is in the file
+            s = f"\t{p} match:" + prefix + colored(p, 'red') + suffix
+            s = s.replace('\r', ' ').replace('\n', ' ')
+            print_strs.append(s)
         #print(f"MATCH FOUND: '{label}' with pattern '{pattern}' matched for filepath '{fpath}' on line {i}")
 
     if len(print_strs) > 0:
@@ -300,24 +413,152 @@ def apply_ruleset_in_file(fpath):
         for print_str in print_strs:
             print(print_str)
 
+# Windows overlap by the longest anything we're looking for could be, so nothing is missed across them
+candidate_pattern = re.compile(b'\x01\x01\x04\x20(.{32})')
+WINDOW_OVERLAP = max(content_max_length, 4 + 32)
 
+# Default number of worker processes for scanning file contents, one per core.
+SALVAGE_WORKERS = os.cpu_count()
 
-candidate_pattern = re.compile(b'\x01\x01\x04\x20(.{32})')
-def key_hex_candidates(fpath):
+def contents_matches(fpath, rules=True, keys=True, large_file_size=GB):
+    """
+    Check the contents of a file against our rules, and get any private key candidates in it, in one pass.
+
+    The file is memory-mapped and scanned in windows (see scan_utils.mmap_windows) rather than split into lines,
+        so memory is bounded no matter the file - a multi-GB disk image or video with no newlines in it is scanned
+        in 4MB windows just like anything else, rather than being read into memory whole.
+        Patterns still match within lines as they did, since none of them can match a newline.
+
+    :param fpath: The file to check
+    :param rules: If we should check it against the rules
+    :param keys: If we should get key candidates from it
+    :param large_file_size: Show a progress bar for files larger than this (Bytes), None for never
+    :return: (matches, candidates) - matches as (rule, offset, prefix, match, suffix) for print_ruleset_matches,
+        known noise already left out, and candidates the raw 32 bytes of each key candidate found, if keys.
+    """
+    matches = []
     candidates = []
-    for line_i, line in enumerate(file_chunked_lines(fpath)):
-        candidates.extend(re.findall(candidate_pattern, line))
+    matched_lines = set()
+    if not fs.is_regular_file(fpath): return matches, candidates
+
+    # Offset of the last newline before pos (-1 if none), and pos - lines are identified by the newline they start
+    # after. Found for each match in order of offset, so each search only covers the bytes since the last one rather
+    # than going all the way back, and a file with no newlines is still only searched once overall.
+    newline, pos = -1, 0
+    for mm, start, end, limit in scan_utils.mmap_windows(fpath, overlap=WINDOW_OVERLAP, large_file_size=large_file_size):
+        if rules:
+            found = content_matches(mm, start, end, limit)
+            newlines = {}
+            for idx in sorted(set(idx for _, idx, _ in found)):
+                nl = mm.rfind(b"\n", pos, idx)
+                newline, pos = (nl if nl != -1 else newline), idx
+                newlines[idx] = newline
+            for i, idx, length in found:
+                # One match per rule per line, like we used to report them, but skipping any known noise,
+                # so noise earlier in a line can't hide a real match after it.
+                line = (i, newlines[idx])
+                if line in matched_lines:
+                    continue
+                context = match_context(mm, ruleset[i], idx, length)
+                if not ruleset[i][1] and is_known_noise(*context[2:]):
+                    continue
+                matched_lines.add(line)
+                matches.append(context)
+        if keys:
+            candidates.extend(match.group(1) for match in candidate_pattern.finditer(mm, start, end) if match.start() < limit)
+    return matches, candidates
+
+def scan_contents(fpath, rules=True, keys=True):
+    # contents_matches, printing any rule matches and returning the key candidates.
+    matches, candidates = contents_matches(fpath, rules, keys)
+    print_ruleset_matches(fpath, matches)
     return candidates
 
+def apply_ruleset_in_file(fpath):
+    scan_contents(fpath, keys=False)
 
-def salvage(priv):
-    # Given private key string candidate, mutate it and try different permutations to try and obtain a possible original key.
+def key_hex_candidates(fpath):
+    return scan_contents(fpath, rules=False)
+
+def salvage_file(fpath):
+    # Worker for salvaging files in parallel - its contents against the rules and for key candidates, in one read.
+    # Returns (fpath, size, content matches, candidates, metrics) to be printed in order, metrics being what this
+    # worker recorded (see metrics_utils), if enabled.
+    # No progress bars for large files here, since they'd print over each other.
+    # Files we can't read anymore have no content matches, rather than stopping the whole scan.
+    size = fs.safesize(fpath)
+    try:
+        with timed("contents", nbytes=size):
+            matches, candidates = contents_matches(fpath, large_file_size=None)
+        return fpath, size, matches, candidates, take_metrics()
+    except OSError:
+        return fpath, 0, [], [], take_metrics()
+
+def salvage_files(fpaths, workers=SALVAGE_WORKERS):
+    """
+    Salvage every file in fpaths with a pool of workers, in a single pass - printing the matches of each file's path
+        and contents against the rules, and returning the key candidates found in all of them.
+
+    Paths are all matched up front in bulk (see match_paths), which is quick, so the workers only read contents.
+
+    Files are handed out largest first, so no worker is left with a huge disk image at the very end while the others
+        sit idle. Results are printed in that same order (by size, then path) no matter which worker finishes first,
+        so the output is the same every run, and each file's matches are printed together.
+    At the end, the number of matches of each rule is printed, by label.
+
+    :param fpaths: Files to scan
+    :param workers: Number of worker processes, 1 to scan in this process
+    :return: Set of key candidates, as hex
+    """
+    path_matched = match_paths(fpaths)
+    sizes = {fpath: fs.safesize(fpath) for fpath in fpaths}
+    fpaths = sorted(sizes, key=lambda fpath: (-sizes[fpath], fpath))
+
+    keys = set({})
+    label_counts = Counter()
+    scanned = 0
+    start = time.perf_counter()
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    results = map(salvage_file, fpaths) if pool is None else pool.imap(salvage_file, fpaths)
+    pbar = tqdm(results, total=len(fpaths), unit=" files")
+    for fpath, size, matches, candidates, worker_metrics in pbar:
+        merge_metrics(worker_metrics)
+        scanned += size
+        pbar.set_description(fpath[-100:])
+        paths = path_matched.get(fpath, [])
+        print_path_matches(fpath, paths)
+        print_ruleset_matches(fpath, matches)
+        label_counts.update(f"{label} (path)" for label, _ in paths)
+        label_counts.update(f"{rule[0]} (contents)" for rule, *_ in matches)
+        for priv in candidates:
+            keys.add(priv.hex())
+    pbar.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if len(label_counts) > 0:
+        print("Matches by rule:")
+        for label, n in label_counts.most_common():
+            print(f"\t{label.ljust(40)} {n:>10,}")
+
+    elapsed = time.perf_counter() - start
+    print(f"Scanned {len(fpaths):,} files ({scanned/MB:,.1f}MB) in {elapsed:.1f}s with {workers} workers: "
+          f"{len(fpaths)/elapsed:,.1f} files/s, {scanned/MB/elapsed:,.1f} MB/s.")
+    return keys
+
+
+def key_balance(key, balances=None):
+    # Balance of a bit Key's address in BTC - from the local snapshot if we have one, otherwise from the network.
+    if balances is not None:
+        return balance_utils.address_balance(balances, key.address) / balance_utils.SATOSHIS_PER_BTC
+    return float(key.get_balance('btc'))
+
+def key_cuts(priv):
+    # Given private key string candidate, the possible original keys it could be cut from.
     # priv: near-64 character string. (62, 63, or 64)
     #
     # Private key size can be either 32 or 31 bytes, end result. This means 62,63,or 64 characters in total - 3 possibilities
-    # each time they can also be either in wif compressed, wif uncompressed, or hex format, so that's 3 more possibilities.
-    #
-    # So for a given key we will make 9 api calls, and each takes at most .2seconds, meaning that you can expect a runtime of 1.8s/key.
 
     # Start with cuts, pad it with zeros to give len 64 if needed
     assert len(priv) in [62, 63, 64]
@@ -328,28 +569,110 @@ def salvage(priv):
     # cuts = [priv[:64-i] for i in range(3):]
 
     # 3 possible cutoffs.
-    cuts = [priv[:62], priv[:63], priv[:64]]
+    return [priv[:62], priv[:63], priv[:64]]
+
+def check_cut(priv, balances=None):
+    # Derive the compressed and uncompressed keys for one cut and get their balances.
+    # Returns (priv, address_compressed, balance_compressed, address_uncompressed, balance_uncompressed),
+    # with addresses None and balances 0 if it's not a valid key.
+    try:
+        key = Key.from_hex(priv).to_bytes()
+    except ValueError:
+        # Invalid Key, skip.
+        return priv, None, 0.0, None, 0.0
+    key_compressed = Key(bytes_to_wif(key, compressed=True))
+    key_uncompressed = Key(bytes_to_wif(key, compressed=False))
+
+    key_compressed_bal = key_balance(key_compressed, balances)
+    key_uncompressed_bal = key_balance(key_uncompressed, balances)
+    # tqdm.write(f"Key: {priv} Address: {key_compressed.address} Balance: {key_compressed_bal}")
+    # tqdm.write(f"Key: {priv} Address: {key_uncompressed.address} Balance: {key_uncompressed_bal}")
+    return priv, key_compressed.address, key_compressed_bal, key_uncompressed.address, key_uncompressed_bal
+
+def print_if_jackpot(priv, address_compressed, balance_compressed, address_uncompressed, balance_uncompressed):
+    if balance_compressed != 0.0 or balance_uncompressed != 0.0:
+        print("#" * 100)
+        print(f"Key: {priv} Address: {address_compressed} Balance: {balance_compressed}")
+        print(f"Key: {priv} Address: {address_uncompressed} Balance: {balance_uncompressed}")
+        print("#" * 100)
+        print("JACKPOT! VALID PRIVATE KEY WITH BALANCE FOUND!")
+
+def salvage(priv, balances=None):
+    # Given private key string candidate, mutate it and try different permutations to try and obtain a possible original key.
+    #
+    # Each cut can be either in wif compressed, wif uncompressed, or hex format, so that's 3 more possibilities.
+    #
+    # So for a given key we will make 9 api calls, and each takes at most .2seconds, meaning that you can expect a runtime of 1.8s/key.
+    # Unless we're given a local balance snapshot (see balance_utils), in which case it's all offline and microseconds.
+    # For more than a few candidates, use salvage_keys.
 
     # Try each one on all parse methods
-    for priv in cuts:
-        try:
-            key = Key.from_hex(priv).to_bytes()
-        except ValueError:
-            # Invalid Key, skip.
-            continue
-        key_compressed = Key(bytes_to_wif(key, compressed=True))
-        key_uncompressed = Key(bytes_to_wif(key, compressed=False))
-
-        key_compressed_bal = float(key_compressed.get_balance('btc'))
-        key_uncompressed_bal = float(key_uncompressed.get_balance('btc'))
-        # tqdm.write(f"Key: {priv} Address: {key_compressed.address} Balance: {key_compressed_bal}")
-        # tqdm.write(f"Key: {priv} Address: {key_uncompressed.address} Balance: {key_uncompressed_bal}")
-        if key_compressed_bal != 0.0 or key_uncompressed_bal != 0.0:
-            print("#" * 100)
-            print(f"Key: {priv} Address: {key_compressed.address} Balance: {key_compressed_bal}")
-            print(f"Key: {priv} Address: {key_uncompressed.address} Balance: {key_uncompressed_bal}")
-            print("#" * 100)
-            print("JACKPOT! VALID PRIVATE KEY WITH BALANCE FOUND!")
+    for priv in key_cuts(priv):
+        print_if_jackpot(*check_cut(priv, balances))
+
+# Balance snapshot for worker processes checking keys, handed to each by init_check_worker when the pool starts -
+# when forked (the default on Linux) that's without copying it, and it's memory-mapped, so they all share the same
+# pages rather than each getting a copy.
+BALANCES = None
+
+def init_check_worker(balances):
+    # Pool initializer, so workers get the snapshot however they're started - with spawn or forkserver they don't
+    # inherit the parent's globals, and would check every key with BALANCES=None.
+    global BALANCES
+    BALANCES = balances
+
+def check_cut_worker(priv):
+    return check_cut(priv, BALANCES)
+
+def salvage_keys(keys, balances=None, ledger_fname=balance_utils.LEDGER_FNAME, workers=SALVAGE_WORKERS):
+    """
+    salvage, for a whole set of key candidates at once.
+
+    Every cut of every candidate is gathered first, so cuts shared between candidates are only checked once,
+        and any already in the ledger of checked keys (from previous salvages, of this tomb or others) are skipped.
+        The rest are derived and checked by a pool of workers, and recorded in the ledger in batches as they come
+        back, so stopping partway only loses the last batch.
+
+    :param keys: Key candidates, as hex strings
+    :param balances: Local balance snapshot from balance_utils.load_balance_snapshot, or None to use the API
+    :param ledger_fname: Ledger of checked keys to use, None to not use one
+    :param workers: Number of worker processes, 1 to check them in this process
+    :return: Number of keys checked (those not skipped)
+    """
+    cuts = sorted(set(cut for priv in keys for cut in key_cuts(priv)))
+
+    # Hitting the API from every core at once would just get us rate limited, so only parallel when offline.
+    # Started before the ledger is opened, so no worker inherits an open sqlite connection.
+    pool = None
+    if workers > 1 and balances is not None:
+        pool = multiprocessing.Pool(workers, initializer=init_check_worker, initargs=(balances,))
+    init_check_worker(balances)
+
+    ledger = None
+    if ledger_fname is not None:
+        ledger = balance_utils.open_ledger(ledger_fname)
+        checked = balance_utils.ledger_checked(ledger, cuts)
+        print(f"{len(cuts)} Possible Keys from {len(keys)} Candidates, {len(checked)} already checked previously.")
+        cuts = [cut for cut in cuts if cut not in checked]
+
+    results = map(check_cut_worker, cuts) if pool is None else pool.imap(check_cut_worker, cuts, chunksize=64)
+    source = "snapshot" if balances is not None else "api"
+    checked = []
+    # Timed here as they come back, so with a pool that's our wait for each rather than the worker's time on it.
+    for result in tqdm(timed_iter(results, "check_key"), total=len(cuts), desc="Checking keys"):
+        print_if_jackpot(*result)
+        checked.append(result)
+        if ledger is not None and len(checked) == balance_utils.LEDGER_COMMIT_INTERVAL:
+            with timed("ledger", n=len(checked)):
+                balance_utils.add_to_ledger(ledger, checked, source)
+            checked = []
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if ledger is not None:
+        balance_utils.add_to_ledger(ledger, checked, source)
+        ledger.close()
+    return len(cuts)
 
 
 if __name__ == "__main__":
@@ -359,54 +682,59 @@ if __name__ == "__main__":
     # then manually try those against the bitcoin API. This was very costly and didn't produce any results,
     # so we're going with the much faster, flag-if-anything-comes-up (since this is rare) approach.
 
+    # Optional number of workers, anywhere in the args
+    workers = SALVAGE_WORKERS
+    for flag in ["-w", "--workers"]:
+        if flag in sys.argv:
+            i = sys.argv.index(flag)
+            workers = int(sys.argv[i+1])
+            del sys.argv[i:i+2]
+
+    # Optional local balance snapshot, to check candidates offline rather than with the API
+    balances = None
+    if "--balances" in sys.argv:
+        i = sys.argv.index("--balances")
+        print(f"Loading balance snapshot {sys.argv[i+1]}.")
+        balances = balance_utils.load_balance_snapshot(sys.argv[i+1])
+        del sys.argv[i:i+2]
+
+    # Optional per-stage metrics (see metrics_utils), enabled before the pools start so the workers record them too
+    if "--metrics" in sys.argv:
+        sys.argv.remove("--metrics")
+        enable_metrics()
+
+    # Ledger of keys already checked, by this and previous salvages
+    ledger_fname = balance_utils.LEDGER_FNAME
+    if "--ledger" in sys.argv:
+        i = sys.argv.index("--ledger")
+        ledger_fname = sys.argv[i+1]
+        del sys.argv[i:i+2]
+
+    if len(sys.argv) != 2:
+        print("Usage: python3 crypto_salvager.py tomb_root/ [-w workers] [--balances balances.npy] [--ledger salvage.ledger] [--metrics]")
+        sys.exit(1)
+
     output_dir = sys.argv[1]
     index_fpath = os.path.join(output_dir, "filesystem.index")
     keys = set({})
 
-    print("Checking Index Filepaths against Rulesets...")
     print(index_fpath)
 
     try:
-        with open(index_fpath, "r") as f:
-            # Iterate directly through it and check filenames line by line.
-            fpaths = [line.strip() for line in f.readlines()]
+        fpaths = [fpath for fpath, _ in index_utils.read_index(output_dir)]
     except FileNotFoundError:
         print("No index found, creating one...")
         print("Creating new index...")
         fpaths = fs.fpaths(output_dir)
 
-    for line in tqdm(fpaths):
-        if "filesystem.index" in line: continue
-        fpath = line.split(", ")[0]
-
-        # Check filepath against our rules
-        apply_ruleset(fpath)
-
-    print("Checking Index Filepath Contents against Rulesets...")
-    with tqdm(bar_format='{desc}', position=0) as desc_pbar:
-        for line in tqdm(fpaths):
-            fpath = line.split(", ")[0]
-            desc_pbar.set_description(fpath[-100:])
-
-            # Check file contents against our rules
-            #print(fpath)
-            apply_ruleset_in_file(fpath)
-
-    keys = set({})
-    # Do manual wallet key checking
-    print("Checking for any wallet files / keys...")
-    for line in tqdm(fpaths):
-        fpath = line.split(", ")[0]
-        # Get candidates
-        candidates = key_hex_candidates(fpath)
-        for priv in candidates:
-            keys.add(priv.hex())
+    # Check filepaths and file contents against our rules, and do manual wallet key checking, all in one pass
+    # over the files, reading each only once.
+    print(f"Checking Index Filepaths and Contents against Rulesets and for any wallet files / keys with {workers} workers...")
+    keys = salvage_files(fpaths, workers)
 
+    flush_findings()
     print(f"{len(keys)} Candidates Obtained. Testing...")
-    pbar = tqdm(keys)
-    for key in pbar:
-        pbar.set_description("Candidate: " + key)
-        salvage(key)
+    salvage_keys(keys, balances, ledger_fname, workers)
 
 
 
@@ -2,7 +2,7 @@
 To run only the portion of TombRaider that removes duplicates of files and known files.
 Also makes an index of files.
 run:
-python3 deduplicate.py filesystem_root/ sorted_known.md5s
+python3 deduplicate.py filesystem_root/ [filesystem_root2/ ...] [--hash algorithm] [--metrics]
 """
 
 import sys
@@ -11,9 +11,10 @@ import re
 from utils.filesystem_utils import *
 #from tqdm import tqdm
 from utils.hash_utils import *
+from utils.index_utils import *
+from utils.metrics_utils import *
 import numpy as np
 from collections import defaultdict
-from bloom_filter2 import BloomFilter
 
 """
 I have done. So many tests. To see what's fastest here.
@@ -37,95 +38,153 @@ We tried applying it to a larger set and found a surprising result, the index ge
     
 Additionally reducing the error rate for the bloom filter helps too. 
 FUTURE IDEA is to incorporate a fixed size of index, and if it gets too big, we just start a new one.
-"""
 
-def process(filesystem_roots):
-    # list of roots, may be one or more.
+UPDATE 2
+
+The lossy md5 was fast, but it would delete distinct files that happened to share their first and last chunks,
+    which is not something a deduplicator should ever do. So now it works in stages, like fdupes:
+    1. Group every file by size. Files with a size no other file has can't have duplicates, so they're never hashed.
+    2. Hash the remaining files with a sampled md5 (first, middle, and last chunk + size), and regroup by that.
+    3. Only files still sharing a sampled md5 get a full md5, and only those that match on it are duplicates.
+    
+Most files drop out at stage 1 or 2, so this is exact at close to the speed of the lossy version. And since the
+    groups are dicts of small lists rather than one giant index, there's no slowdown cliff and no bloom filter needed.
 
-    # Get optimal hashing buffer size to maximize speed for it
-    #get_optimal_md5_buffer_size()
+UPDATE 3
 
-    # Load bloom filter
-    # bloom_filter = BloomFilter(max_elements=150_000_000, error_rate=0.001, filename=('known.bloom',-1), start_fresh=False) # 132 mil known hashes
-    print("Initialising Bloom Filter...")
-    fpath_iter = []
-    for fs in filesystem_roots:
-        fpath_iter.extend(fpaths(fs))
-    bloom_filter = BloomFilter(max_elements=len(fpath_iter), error_rate=1e-9)
-
-    # Load all hashes
-    # print(f"Loading known hashes file {known_md5s_fname}. This may take a moment...")
-    # known_md5s = np.load(known_md5s_fname, allow_pickle=True)
-
-    # Populate Bloom Filter with knowns
-    #print(f"Populating Bloom Filter...")
-    # for digest in tqdm(known_md5s):
-    #     bloom_filter.add(digest)
-    # print(bloom_filter)
-    # print(known_md5s[0] in bloom_filter)
-
-    # print("Saving Bloom Filter...")
-    # bloom_filter.save("bloom_filter.bf")
-
-    # Definitive checks
-    # n = len(known_md5s)
-    # def isknown(digest):
-    #     # Wish they could just have a contains method but oh heckin well
-    #     i = np.searchsorted(known_md5s, digest)
-    #     return i != 0 and i != n and known_md5s[i] == digest
-    total = 0
-    total_size = 0
+Nothing here checks known hashes, so nothing here needs md5 - the sampled and full digests are now the content hash
+    (hash_utils.CONTENT_HASH, xxh128 if xxhash is installed), which is several times faster on a fast disk.
+"""
 
+def regroup(groups, key, digests, desc, stage):
+    # Split each group of possibly identical files into smaller groups by key(fpath, size), dropping
+    # any groups left with only one file, since that file can't have a duplicate.
+    # Every key computed is kept in digests, so we know the most exact digest we have for each file - keys are
+    # (digest, algorithm), which is fine to group by since a stage uses the same algorithm for every file of a size.
+    # Files we can't read anymore are dropped too.
+    # Each key is timed as stage, with the bytes of the file it's for (see metrics_utils).
+    regrouped = []
+    for size, group in tqdm(groups, desc=desc):
+        by_key = defaultdict(list)
+        for fpath in group:
+            try:
+                with timed(stage, nbytes=size):
+                    digest = key(fpath, size)
+            except OSError:
+                continue
+            digests[fpath] = digest
+            by_key[digest].append(fpath)
+        regrouped.extend((size, g) for g in by_key.values() if len(g) > 1)
+    return regrouped
+
+
+def duplicate_groups(entries, algorithm=CONTENT_HASH):
+    """
+    Find all groups of identical files in entries, hashing as little as possible to do so.
+
+    Files are grouped by size, then by sampled digest, and only then by full digest, with each stage only run on groups
+        which still have more than one file in them. Files small enough that their sampled digest already covers the
+        whole file skip the full digest, since it would be the same.
+
+    :param entries: os.DirEntry for each regular file to check, from scan_files
+    :param algorithm: Hash algorithm to digest files with, any of HASH_ALGORITHMS
+    :return: (groups, sizes, digests), groups being a list of (size, [fpath, ...]) for each set of identical files,
+        in the order the files were given, so the first of each is the one to keep,
+        sizes being a dict of fpath: size for every regular file checked,
+        and digests being a dict of fpath: (the most exact hex digest computed for it, what algorithm it's from),
+        for those that were hashed.
+    """
+    sizes = {}
+    digests = {}
+    by_size = defaultdict(list)
+    for entry in tqdm(entries, desc="Grouping by size"):
+        # Stat is cached from the walk, so this doesn't touch the disk again.
+        try:
+            size = entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+        fpath = entry.path
+        sizes[fpath] = size
+        by_size[size].append(fpath)
+    groups = [(size, g) for size, g in by_size.items() if len(g) > 1]
+
+    sampled = lambda fpath, size: (sampled_digest(fpath, size, algorithm), sampled_algorithm(size, algorithm))
+    full = lambda fpath, size: (hash_digest(fpath, algorithm).hex(), algorithm) if size > 3*SAMPLE_SIZE else digests[fpath]
+    groups = regroup(groups, sampled, digests, "Sampled hashing", "sampled_hash")
+    groups = regroup(groups, full, digests, "Full hashing", "full_hash")
+    return groups, sizes, digests
+
+
+def process(filesystem_roots, algorithm=CONTENT_HASH):
+    # list of roots, may be one or more. algorithm is the hash to find duplicates with, and index them by.
+
+    # Hashing uses whatever buffer size was tuned for this device (scripts/tune_hashing.py), if it's been tuned
+
+    # Reuse any digests from previous runs (or from raiding) on files which haven't changed since.
+    open_hash_cache(filesystem_roots[0] + "/" + HASH_CACHE_FNAME)
+
+    # Only regular files, and don't touch the hash cache or index themselves (or their sqlite journal files)
+    keep = lambda entry: isregular(entry) and not entry.name.startswith((HASH_CACHE_FNAME, INDEX_FNAME))
+    entries = [(fs, entry) for fs in filesystem_roots for entry in timed_iter(scan_files(fs, filter=keep), "walk")]
+    roots = {entry.path: fs for fs, entry in entries}
+
+    print(f"Finding Duplicates...")
+    groups, sizes, digests = duplicate_groups((entry for _, entry in entries), algorithm)
+    total = len(sizes)
+    total_size = sum(sizes.values())
+
+    # Keep the first of each group, remove the rest.
+    print(f"Removing Duplicates...")
     removed = 0
     removed_size = 0
-    hits = 0
-    index = {}
-    def isfound(digest):
-        return digest in index
-
-    # Do one pass, eliminating as many files as possible if we don't need them as we go.
-    # This, I've found, is the best way to maximize speed and minimize disk space used.
-    print(f"Removing Duplicates and Known Files...")
-    for fpath in tqdm(fpath_iter):
-        # HASH CHECKS
-        # First check if we can delete it based on the bloom filter
-        # Most of the time we will not delete it since they're often not in the bloom filter
-        if not is_regular_file(fpath):continue
-        #if os.path.getsize(fpath) > 1e8: continue
-        digest = fast_lossy_md5(fpath)
-        size = os.path.getsize(fpath)
-        total += 1
-        total_size += size
-        # digest = md5(fpath)
-        if digest in bloom_filter:
-            # Might be in the bloom filter, so we have to check the definitive checks
-            # this is costly part, try to make it as fast as possible
-            # Fast certainty check first
-            # have to do full md5 for the known ones
-            # hits += 1
-            if isfound(digest):
-                #if isknown(digest) or isfound(digest):
-                # If it's in there, delete it
-                removed += 1
-                removed_size += size
+    for size, group in groups:
+        for fpath in group[1:]:
+            with timed("remove", nbytes=size):
                 os.remove(fpath)
-                continue
-        # Otherwise it's not in the bloom filter, so we have to add it to the bloom filter and index
-        # clever conditionals so that this will only happen if it's not in either
-        bloom_filter.add(digest)
-        index[digest] = fpath
+            del sizes[fpath]
+            removed += 1
+            removed_size += size
 
+    # Index every file we kept, by the most exact digest we have for it, and which algorithm that is. Files we never had
+    # to hash get their sampled digest (a full digest for small files), the same lossy digest the index has always had
+    # here, since it only costs a few small reads and can't collide with another file's, as the sizes were unique.
     print("Writing index to disk...")
+    indexed = []
+    for fpath, size in tqdm(sizes.items()):
+        try:
+            digest, digest_algorithm = digests[fpath] if fpath in digests else (sampled_digest(fpath, size, algorithm), sampled_algorithm(size, algorithm))
+        except OSError:
+            continue
+        indexed.append((fpath, digest, tomb_subdir(fpath, roots[fpath]), digest_algorithm))
+    close_hash_cache()
     for fs in filesystem_roots:
-        write_index(index, fs + "/" + "filesystem.index")
+        index = open_index(fs)
+        clear_index(index)
+        with timed("index", n=len(indexed)):
+            add_to_index(index, indexed)
+        export_index(index, fs + "/" + INDEX_FNAME)
+        index.close()
     print(f"Removed {removed}/{total} files ({(removed/total)*100:.2f}%) totalling {removed_size/1e9:.2f}GB/{total_size/1e9:.2f}GB ({((removed_size/total_size))*100:.2f}% of total).")
 
 if __name__ == "__main__":
+    # Optional hash algorithm to find duplicates with, any of HASH_ALGORITHMS
+    algorithm = CONTENT_HASH
+    if "--hash" in sys.argv:
+        i = sys.argv.index("--hash")
+        algorithm = sys.argv[i+1]
+        del sys.argv[i:i+2]
+        new_hasher(algorithm)
+
+    # Optional per-stage metrics (see metrics_utils)
+    if "--metrics" in sys.argv:
+        sys.argv.remove("--metrics")
+        enable_metrics()
+
     if len(sys.argv) < 2:
-        print("Usage: python3 deduplicate.py filesystem_root [optional]filesystem_root2/ ...")
+        print("Usage: python3 deduplicate.py filesystem_root [optional]filesystem_root2/ ... [--hash algorithm] [--metrics]")
 
     # Handle multiple possible directories
     filesystem_roots = [addslash(f) for f in sys.argv[1:]]
-    process(filesystem_roots)
+    process(filesystem_roots, algorithm)
 
 
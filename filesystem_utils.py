@@ -8,28 +8,174 @@ import os
 import re
 from tqdm import tqdm
 import shutil
+import stat
 import traceback
 import sys
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 # Number of characters to limit our filenames to. We keep it at 240 so we still have some room for renaming
 # before reaching 255 characters, when we later sort into subdirectories.
 FPATH_TRIM_LENGTH = 240
 
+# Minimum number of seconds between updates of the "files iterated" progress line, since writing it for every
+# file is measurable overhead when there are tens of millions of them.
+PROGRESS_INTERVAL = 0.5
+
+# Default number of threads for parallel_scan_files. Listing directories is waiting on the disk rather than the CPU,
+# so this can be well over the number of cores.
+WALK_WORKERS = 16
+
+# sanitize's substitutions, compiled once since it runs on every path we raid or salvage
+SANITIZE_SEPARATORS = re.compile(r'[-\s]', flags=re.UNICODE)
+SANITIZE_SLASHES = re.compile(r'/', flags=re.UNICODE)
+SANITIZE_OTHERS = re.compile(r'[^a-zA-Z0-9._|]', flags=re.UNICODE)
+
 addslash = lambda root: root[:-1] if root[-1] == "/" else root
 
-def fpaths(dir):
-    # Return a list of all filepaths in directory - not a generator.
-    l = []
-    #print("Getting list of all filepaths...")
+def scan_dir(dir, filter=None, sort=False):
+    # List a single directory with os.scandir, returning (files, subdirs) - the DirEntry of every file in it
+    # (that passes filter, if given) and the paths of its subdirectories, optionally sorted by name.
+    # Symlinks to directories are neither, same as os.walk. Unreadable directories are treated as empty.
+    files, subdirs = [], []
+    try:
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                        continue
+                except OSError:
+                    pass
+                if filter is None or filter(entry):
+                    files.append(entry)
+    except OSError:
+        pass
+    if sort:
+        files.sort(key=lambda entry: entry.name)
+        subdirs.sort()
+    return files, subdirs
+
+def counted(entries, progress=False):
+    # Pass through entries, printing a "files iterated" line updated at most every PROGRESS_INTERVAL seconds.
+    if not progress:
+        yield from entries
+        return
     n = 0
-    for root,_,files in os.walk(dir):
-        for f in files:
-            l.append(os.path.join(root,f))
-            n += 1
+    last_update = 0
+    for entry in entries:
+        n += 1
+        if time.monotonic() - last_update > PROGRESS_INTERVAL:
+            last_update = time.monotonic()
             sys.stdout.write(f"\r{str(f'{n:,}').rjust(13)} files iterated")
+        yield entry
+    sys.stdout.write(f"\r{str(f'{n:,}').rjust(13)} files iterated")
     sys.stdout.flush()
     print()
-    return l
+
+def scan_files(dir, filter=None, progress=False):
+    """
+    Generator of every file in directory, recursively, as os.DirEntry objects rather than paths.
+
+    Built on os.scandir, so processing can start on the first file rather than waiting for the whole walk,
+        and the entries carry what the directory listing already told us - entry.path, entry.inode(),
+        entry.is_file(), and entry.stat() is cached after the first call - so callers don't need to stat again.
+
+    Yields the same files os.walk would: everything that isn't a directory, in the same order (files of a directory
+        before any of its subdirectories). Symlinks to directories aren't followed, same as os.walk.
+
+    :param dir: Directory to walk
+    :param filter: Optional function of a DirEntry, only entries it returns True for are yielded (and counted)
+    :param progress: If we should print a "files iterated" line, updated at most every PROGRESS_INTERVAL seconds
+    :return: Yields os.DirEntry for each file
+    """
+    def walk():
+        stack = [dir]
+        while len(stack) > 0:
+            files, subdirs = scan_dir(stack.pop(), filter)
+            yield from files
+            # Reversed so we pop them in listing order
+            stack.extend(reversed(subdirs))
+    return counted(walk(), progress)
+
+def parallel_scan_files(dir, workers=WALK_WORKERS, ordered=False, filter=None, progress=False):
+    """
+    Multi-threaded version of scan_files, for very large trees (thousands of recup_dir.N directories, deep testdisk
+        trees) or slow / network-backed volumes, where a single thread waiting on one directory listing at a time
+        is the bottleneck. Threads are fine here since scandir releases the GIL while it waits on the disk.
+
+    Each directory is listed by a thread in the pool, which then queues up its subdirectories to be listed as well,
+        so the pool stays busy while we yield files.
+
+    :param dir: Directory to walk
+    :param workers: Number of threads listing directories at once
+    :param ordered: If True, yield files in a deterministic order - the same depth-first order as scan_files,
+        with each directory sorted by name - no matter which threads finish first. Otherwise files are yielded
+        as soon as their directory is listed, which is faster to start but differs run to run.
+    :param filter: Optional function of a DirEntry, only entries it returns True for are yielded (and counted)
+    :param progress: If we should print a "files iterated" line, updated at most every PROGRESS_INTERVAL seconds
+    :return: Yields os.DirEntry for each file
+    """
+    def walk_ordered(pool):
+        # Each task lists its dir and submits its subdirs, returning (files, futures of subdirs).
+        def task(d):
+            files, subdirs = scan_dir(d, filter, sort=True)
+            return files, [pool.submit(task, subdir) for subdir in subdirs]
+
+        stack = [pool.submit(task, dir)]
+        while len(stack) > 0:
+            files, children = stack.pop().result()
+            yield from files
+            stack.extend(reversed(children))
+
+    def walk_unordered(pool):
+        # Each task puts its files on the results queue before submitting its subdirs, so we always get a dir's
+        # results before any of its subdirs', and can track how many dirs are still to come from that alone.
+        results = queue.Queue()
+        def task(d):
+            files, subdirs = [], []
+            try:
+                files, subdirs = scan_dir(d, filter)
+            finally:
+                results.put((files, len(subdirs)))
+            for subdir in subdirs:
+                pool.submit(task, subdir)
+
+        pool.submit(task, dir)
+        remaining = 1
+        while remaining > 0:
+            files, n_subdirs = results.get()
+            remaining += n_subdirs - 1
+            yield from files
+
+    def walk():
+        pool = ThreadPoolExecutor(workers)
+        try:
+            yield from (walk_ordered(pool) if ordered else walk_unordered(pool))
+        finally:
+            # If we're stopped early, don't keep listing the rest of the tree.
+            pool.shutdown(wait=True, cancel_futures=True)
+    return counted(walk(), progress)
+
+def fpaths(dir, workers=1, ordered=False):
+    # Return a list of all filepaths in directory - not a generator. Use scan_files for that.
+    # With more than one worker, uses parallel_scan_files to list them.
+    if workers > 1:
+        return [entry.path for entry in parallel_scan_files(dir, workers, ordered, progress=True)]
+    return [entry.path for entry in scan_files(dir, progress=True)]
+
+def isregular(entry):
+    # Filter for scan_files, for only regular files (not symlinks, devices, fifos, etc.)
+    try:
+        return entry.is_file(follow_symlinks=False)
+    except OSError:
+        return False
+
+def has_files(dir):
+    # Check if there's at least one file anywhere under dir, without walking any further than we need to.
+    return next(scan_files(dir), None) is not None
 
 def localize(fpath, root, tombroot=False):
     # Given we are operating inside of the root filepath, return the localised version of fpath.
@@ -67,22 +213,29 @@ def write_index(index, index_fname):
 def remove_leftover_dirs(root):
     for dir in os.listdir(root):
         dir = root + "/" + dir
-        if os.path.isdir(dir) and len(fpaths(dir)) == 0:
+        if os.path.isdir(dir) and not has_files(dir):
             shutil.rmtree(dir)
     shutil.rmtree(root) # close by removing the dir
 
+def available_path(dst, reserved=()):
+    # Return dst if nothing is there, otherwise the first of dst.1, dst.2, dst.3, etc. that's free.
+    # Paths in reserved are treated as taken too, for when we've decided to move things there but haven't yet.
+    if not os.path.exists(dst) and dst not in reserved:
+        return dst
+    dst_copy = dst + ".{}"
+    i = 1
+    while os.path.exists(dst_copy.format(i)) or dst_copy.format(i) in reserved:
+        i += 1
+
+    # Found a value not taken, format
+    return dst_copy.format(i)
+
 def safemv(src, dst):
     # Move file at location src to location dst, renaming it if needed to avoid any destruction of data.
-    if os.path.exists(dst) and src != dst:
+    if src != dst:
         # If a copy exists, instead rename to filename.txt.1, filename.txt.2, filename.txt.3,
         # etc. until we have a unique filename
-        dst_copy = dst + ".{}"
-        i = 1
-        while os.path.exists(dst_copy.format(i)):
-            i += 1
-
-        # Found a value not taken, format
-        dst = dst_copy.format(i)
+        dst = available_path(dst)
 
     # Move now that we have no replacement of data (despite the name) guaranteed
     # We return dst filename in case we want to use that later. And b/c it might be changed.
@@ -96,17 +249,30 @@ def safemv(src, dst):
               f"A NON-EXT4 FORMATTED FILESYSTEM, CAUSING AN ERROR DUE TO FILE NAMING.")
         print(traceback.format_exc())
 
+def is_regular_file(fpath):
+    # Check if fpath is a regular file (not a directory, symlink, device, fifo, etc.) without following symlinks,
+    # since those are the only things we want to read. Returns False if it doesn't exist anymore.
+    try:
+        return stat.S_ISREG(os.lstat(fpath).st_mode)
+    except OSError:
+        return False
+
 def safesize(fpath):
     try:
         return os.path.getsize(fpath)
     except OSError:
         return 0
 
-def sanitize(fpath):
+def sanitize(fpath, sanitize_dirs=True):
     # Given a filepath with any possible characters, sanitize and return the sanitized filepath.
     # Any possible characters does include unicode (hence regex for simple replaces)
-    fpath = re.sub(r'[-\s]', '_', fpath, flags=re.UNICODE)
-    fpath = re.sub(r'/', '|', fpath, flags=re.UNICODE)
-    fpath = re.sub(r'[^a-zA-Z0-9._|]', '?', fpath, flags=re.UNICODE)
+    # With sanitize_dirs=False only the filename is sanitized, and the directories it's in are left as they are,
+    # for paths we keep the structure of (e.g. testdisk's).
+    if not sanitize_dirs:
+        head, tail = os.path.split(fpath)
+        return os.path.join(head, sanitize(tail))
+    fpath = SANITIZE_SEPARATORS.sub('_', fpath)
+    fpath = SANITIZE_SLASHES.sub('|', fpath)
+    fpath = SANITIZE_OTHERS.sub('?', fpath)
     fpath = fpath[:FPATH_TRIM_LENGTH]
     return fpath
@@ -15,6 +15,22 @@ exts = [ENCRYPTION_EXTS, ARCHIVE_EXTS, VIDEO_EXTS, AUDIO_EXTS, IMAGE_EXTS, PROGR
 tags = [ENCRYPTION_TAGS, ARCHIVE_TAGS, VIDEO_TAGS, AUDIO_TAGS, IMAGE_TAGS, PROGRAM_TAGS, DOCUMENT_TAGS, IRRELEVANT_TAGS, MISC_TAGS]
 labels = ["Encrypted",   "Archives",    "Videos",    "Audio",    "Images",    "Programs",    "Documents",    "Irrelevant",    "Misc"]
 
+# Every ext and tag from the groupings above, compiled once into token: (priority, label), so classifying a file
+# is a dict lookup per word rather than checking every ext of every group against it.
+# Priority is (0 for exts / 1 for tags, group index), so the lowest priority of any matching word is exactly the
+# group the ordered loops of filetype_from_info used to find first - exts before tags, then groups in the order above.
+# Groups never share exts, but in case a token is both, the first (lowest) priority wins.
+ext_labels = {}
+token_priorities = {}
+for priority, groupings in enumerate([exts, tags]):
+    for i, grp in enumerate(groupings):
+        for token in grp:
+            if priority == 0:
+                ext_labels.setdefault(token, labels[i])
+            if (priority, i) < token_priorities.get(token, (2, 0)):
+                token_priorities[token] = (priority, i)
+token_labels = {token: (priority, labels[i]) for token, (priority, i) in token_priorities.items()}
+
 # get extension, check if extension in groupings
 
 # primary tags are the extension name - if one of the tags is an extension, then that takes precedence over other tags.
@@ -29,7 +45,6 @@ SMALL_IMG_THRESHOLD = 50000 #50kb
 DEBUG = False # TODO add this for print statements later, possibly rename to VERBOSE, possibly put in config file
 
 # Pymagic to determine info from file contents (and magic numbers hence the name)
-#get_info = magic.Magic(keep_going=False, uncompress=False, extension=False)
 get_info = magic.Magic(keep_going=False, uncompress=False, extension=False)
 
 known = lambda c: c != "Unknown" and c != "Unsupported"
@@ -43,12 +58,8 @@ def filetype_from_ext(fname):
         return "Unknown"
 
     ext = ext[1:] # remove the dot
-    for i, grp in enumerate(exts):
-        if ext in grp:
-            return labels[i]
-
     # Has an extension but it's not in any of our lists, unsupported
-    return "Unsupported"
+    return ext_labels.get(ext, "Unsupported")
 
 def safe_magic(fname):
     """
@@ -81,6 +92,16 @@ def safe_magic(fname):
             print(f"Encountered error in LibMagic C library for file {fname}: {repr(e)}. This file will be categorized as Unknown.")
         return "data"
 
+def safe_magic_buffer(buffer):
+    # safe_magic, for when we already have the start of the file (e.g. the header from a scan_utils scan) rather than
+    # reading it again.
+    try:
+        return get_info.from_buffer(buffer)
+    except magic.MagicException as e:
+        if DEBUG:
+            print(f"Encountered error in LibMagic C library for buffer: {repr(e)}. This file will be categorized as Unknown.")
+        return "data"
+
 
 def filetype_from_info(fname):
     """
@@ -105,35 +126,33 @@ def filetype_from_info(fname):
         "Subtitle Audio Track" -> Should be audio, not irrelevant.
         "Compressed Heavy Documentation" -> Should be archive, not document.
         "Encrypted Archive" -> Should be encrypted, not archive.
+
+    These loops are precomputed into token_labels, so this is just a lookup of each tag in the info string,
+        keeping whichever matching tag comes first in that order. See filetype_from_infostr.
     """
-    info = safe_magic(fname)
+    return filetype_from_infostr(safe_magic(fname))
+
+def filetype_from_infostr(info):
+    # Grouping for a libmagic info string, as described in filetype_from_info.
     info = info.lower()
-    infotags = set(info.split(" "))
 
     # Check if we have the ["data"] case, where we couldn't get any info from the file, which is unknown.
     if info == "data":
         return "Unknown"
 
-    # First check if any tags match extensions
-    for i,grp in enumerate(exts):
-        for ext in grp:
-            if ext in infotags:
-                return labels[i]
+    matches = [token_labels[tag] for tag in set(info.split(" ")) if tag in token_labels]
+    if len(matches) == 0:
+        # Has info but it's not in any of our lists, unsupported
+        return "Unsupported"
+    return min(matches)[1]
 
-    # Then check if any tags match our tags
-    for i,grp in enumerate(tags): #Iterate through groups first
-        for tag in grp:
-            if tag in infotags:
-                # Found matching tag
-                return labels[i]
-
-    # Has info but it's not in any of our lists, unsupported
-    return "Unsupported"
+def plaintext_info(info):
+    # Check if an info string from libmagic is plaintext. Helpful for sorting out the plaintext ones.
+    return "ASCII text" in info
 
 def plaintext(fname):
-    # Check if plaintext. Helpful for sorting out the plaintext ones.
-    info = get_info.from_file(fname)
-    return "ASCII text" in info
+    # Check if plaintext, probing the file. If you already have its info, use plaintext_info instead.
+    return plaintext_info(safe_magic(fname))
 
 # def less_than(fname, bytes):
 #     # Check if smaller than 50kb in size
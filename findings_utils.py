@@ -0,0 +1,49 @@
+"""
+findings_utils.py
+
+Buffered writer for findings - anything worth a human looking at later, like crypto rule matches - as JSON lines,
+    one object per finding, so they can be filtered and counted with jq or loaded with pandas rather than grepped.
+
+Findings are buffered and only written every FINDINGS_FLUSH_INTERVAL findings or FINDINGS_FLUSH_SECONDS seconds
+    (and at exit), rather than opening and appending to the file on every single one, which added up on tombs with
+    millions of matches.
+"""
+import json
+import time
+import atexit
+
+# Default findings file, in the directory we're run from
+FINDINGS_FNAME = "crypto_matches.jsonl"
+
+# Write buffered findings to disk after this many, or this many seconds since the last write, whichever comes first
+FINDINGS_FLUSH_INTERVAL = 1024
+FINDINGS_FLUSH_SECONDS = 5
+
+findings = {"fname": FINDINGS_FNAME, "pending": [], "last_flush": time.monotonic()}
+
+
+def open_findings(fname=FINDINGS_FNAME):
+    # Write findings to fname from now on, appending to it if it already exists.
+    flush_findings()
+    findings["fname"] = fname
+
+
+def write_finding(**finding):
+    # Record a finding, e.g. write_finding(kind="content", fpath=fpath, label=label, match=match).
+    # Bytes values are decoded, since JSON can't hold them.
+    finding = {k: v.decode("ascii", "backslashreplace") if isinstance(v, bytes) else v for k, v in finding.items()}
+    findings["pending"].append(json.dumps(finding))
+    if len(findings["pending"]) >= FINDINGS_FLUSH_INTERVAL or time.monotonic() - findings["last_flush"] > FINDINGS_FLUSH_SECONDS:
+        flush_findings()
+
+
+def flush_findings():
+    if len(findings["pending"]) > 0:
+        with open(findings["fname"], "a") as f:
+            f.write("\n".join(findings["pending"]) + "\n")
+        findings["pending"] = []
+    findings["last_flush"] = time.monotonic()
+
+
+# So nothing buffered is lost however we exit
+atexit.register(flush_findings)
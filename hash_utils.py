@@ -1,44 +1,352 @@
 import os
 import time
+import json
+import random
+import multiprocessing
 from tqdm import tqdm
 import numpy as np
 import hashlib
+import sqlite3
+
+# Optional - if xxhash is installed, duplicates are found with xxh128 rather than md5, see CONTENT_HASH.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+MD5_BUFFER_SIZE = 2**17  # (~.12 million) default, for any device we haven't tuned hashing on
+SAMPLE_SIZE = 2**13 # 8kb, size of each of the chunks we hash for a sampled md5
+
+# Hash algorithms we can digest file contents with, by name, each a constructor of a hashlib-style hasher.
+# md5 is only needed to check files against the known hashes, since that's what NSRL has - finding duplicates, within
+# a tomb or across tombs, works with any of them. So that's done with CONTENT_HASH, the fastest one we have,
+# and raiding only computes md5 as well (from the same read) when it's checking against known hashes.
+# On a 4GB/s NVMe md5 is the bottleneck at ~430MB/s on one core, xxh128 does ~6GB/s. blake2b is here in case
+# xxhash can't be installed and a cryptographic hash is wanted, but hashlib's is actually slower than its md5 (~370MB/s),
+# so it isn't the fallback - sha1 beats both (~880MB/s) on CPUs with SHA extensions.
+# Which one each digest is from is recorded in the index, since digests from different algorithms can't be compared.
+HASH_ALGORITHMS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh128"] = xxhash.xxh3_128
+KNOWN_HASH = "md5"
+CONTENT_HASH = "xxh128" if xxhash is not None else KNOWN_HASH
+
+# Persistent cache of digests, so reruns on the same files skip hashing them. Keyed by (device, inode, size, mtime_ns),
+# which all stay the same when a file is renamed / moved on the same filesystem (like raiding does), and change
+# if the file is modified. Stored as sqlite next to filesystem.index, and disabled until open_hash_cache is called.
+HASH_CACHE_FNAME = "filesystem.hashcache"
+HASH_CACHE_COMMIT_INTERVAL = 4096 # Number of new digests to cache before committing them to disk
+hash_cache = {"fpath": None, "conn": None, "pid": None, "pending": 0}
+
+# Best buffer size and number of workers to hash with, found by tune_hashing (scripts/tune_hashing.py) for each device
+# by actually hashing files on it, and saved here. Loaded on first use, so anything hashing a file on a device we've
+# tuned uses its buffer size automatically, and anything else MD5_BUFFER_SIZE.
+HASH_TUNING_FNAME = os.path.join(os.path.expanduser("~"), ".config", "tombraider", "hash_tuning.json")
+hash_tuning = {"fname": HASH_TUNING_FNAME, "devices": None, "by_dev": {}}
+
+# Defaults for tune_hashing - bytes of files hashed for each combination, and buffer sizes tried
+TUNE_SAMPLE_BYTES = 2**27 # 128MB
+TUNE_BUFFER_SIZES = [2**14, 2**16, 2**17, 2**18, 2**20, 2**22]
+
+def mount_of(st_dev):
+    # (source, fstype) of the filesystem on device st_dev, e.g. ("/dev/sdb1", "ext4"), from /proc/self/mountinfo,
+    # or None if we can't tell (not Linux, or it isn't mounted).
+    devno = f"{os.major(st_dev)}:{os.minor(st_dev)}"
+    try:
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields = line.split()
+                if fields[2] == devno and " - " in line:
+                    fstype, source = line.split(" - ", 1)[1].split()[:2]
+                    return source, fstype
+    except OSError:
+        pass
+    return None
+
+def device_key(st_dev):
+    # Key hashing tuning is stored under for the device st_dev, e.g. "/dev/sdb1 (ext4)".
+    mount = mount_of(st_dev)
+    if mount is None:
+        return f"dev {os.major(st_dev)}:{os.minor(st_dev)}"
+    return f"{mount[0]} ({mount[1]})"
+
+def load_hash_tuning(fname=None):
+    # Every device's tuning from the tuning file, {device_key: {"buffer_size": ..., "workers": ..., ...}}.
+    # Empty if there isn't one yet, or it's unreadable - we just use the defaults then.
+    fname = fname or hash_tuning["fname"]
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def device_tuning(st_dev):
+    # Tuning for the device st_dev, or None if it hasn't been tuned. The tuning file is loaded on first use,
+    # and each device looked up once.
+    if hash_tuning["devices"] is None:
+        hash_tuning["devices"] = load_hash_tuning()
+    if st_dev not in hash_tuning["by_dev"]:
+        hash_tuning["by_dev"][st_dev] = hash_tuning["devices"].get(device_key(st_dev))
+    return hash_tuning["by_dev"][st_dev]
+
+def md5_buffer_size(st_dev):
+    # Buffer size to hash files on device st_dev with - its tuned size if it's been tuned, MD5_BUFFER_SIZE otherwise.
+    tuning = device_tuning(st_dev)
+    return tuning["buffer_size"] if tuning is not None else MD5_BUFFER_SIZE
+
+def tuned_workers(path, default):
+    # Number of hashing workers tuned for the device path is on, or default if it hasn't been tuned.
+    try:
+        tuning = device_tuning(os.stat(path).st_dev)
+    except OSError:
+        return default
+    return tuning["workers"] if tuning is not None else default
+
+def save_hash_tuning(key, tuning, fname=None):
+    # Store tuning for the device key in the tuning file, keeping every other device's.
+    fname = fname or hash_tuning["fname"]
+    devices = load_hash_tuning(fname)
+    devices[key] = tuning
+    os.makedirs(os.path.dirname(fname) or ".", exist_ok=True)
+    with open(fname + ".tmp", "w") as f:
+        json.dump(devices, f, indent=4)
+    os.replace(fname + ".tmp", fname)
+    # Look everything up again next time, with this included
+    hash_tuning.update(devices=None, by_dev={})
+
+def evict(fpath):
+    # Drop fpath's contents from the page cache, so the next read of it comes from the device. Only works for
+    # clean pages, which is all a file we've only read has. Doesn't need root, unlike /proc/sys/vm/drop_caches.
+    fd = os.open(fpath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def digest_algorithms(content_hash=CONTENT_HASH, known=True):
+    # Algorithms raiding digests every file with - the content hash first, for finding duplicates, then md5 as well
+    # if it's checking against the known hashes and the content hash isn't md5 already. All from the same read.
+    if known and content_hash != KNOWN_HASH:
+        return [content_hash, KNOWN_HASH]
+    return [content_hash]
+
+def tune_digests(args):
+    # Worker for tune_hashing, digest a file with the given algorithms and buffer size, like raiding does.
+    fpath, algorithms, buffer_size = args
+    file_digests(fpath, algorithms, buffer_size)
+
+def tuning_sample(root, sample_bytes, seed=0):
+    # Random sample of the regular files under root, up to sample_bytes in total, from the first 4x that of the walk
+    # (so tuning a huge volume doesn't mean walking the whole thing first).
+    from filesystem_utils import scan_files, isregular
+    candidates = []
+    total = 0
+    for entry in scan_files(root, filter=isregular):
+        try:
+            size = entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+        if size == 0:
+            continue
+        candidates.append((entry.path, size))
+        total += size
+        if total >= 4*sample_bytes:
+            break
+    random.Random(seed).shuffle(candidates)
+    sample = []
+    total = 0
+    for fpath, size in candidates:
+        if total >= sample_bytes:
+            break
+        sample.append(fpath)
+        total += size
+    return sample, total
+
+def tune_hashing(root, sample_bytes=TUNE_SAMPLE_BYTES, buffer_sizes=TUNE_BUFFER_SIZES, worker_counts=None, algorithms=None, fname=None):
+    """
+    Find the fastest buffer size and number of workers to hash files with on the volume root is on, and save them
+        to the tuning file, so everything that hashes files on that device uses them from then on.
+
+    Times hashing a sample of the real files on the volume with every combination of buffer size and workers,
+        evicting them from the page cache before each run, so we measure reads from the device itself (a spinning
+        disk might want few workers and big buffers, an SSD or RAID many workers) rather than from memory.
+    Workers are a process pool, and files are digested with the same algorithms from the same read, as raiding does -
+        how fast the hashing is decides how many workers it takes to keep up with the device.
+
+    :param root: Directory on the volume to tune for, usually the tomb (or its testdisk / photorec directories)
+    :param sample_bytes: Bytes of files to hash for each combination
+    :param buffer_sizes: Buffer sizes to try
+    :param worker_counts: Numbers of workers to try, 1 to 2x the number of cores (in powers of 2) by default
+    :param algorithms: Hash algorithms to digest each file with, what raiding uses with known hashes by default
+        (see digest_algorithms)
+    :param fname: Tuning file, HASH_TUNING_FNAME by default
+    :return: (key, tuning) - the device key the tuning was saved under, and the tuning itself
+    """
+    if worker_counts is None:
+        worker_counts = [2**i for i in range(0, (2*os.cpu_count()).bit_length())]
+    if algorithms is None:
+        algorithms = digest_algorithms()
+    for algorithm in algorithms:
+        new_hasher(algorithm) # Fail now if we don't have it, rather than in every worker
+    key = device_key(os.stat(root).st_dev)
+    sample, total = tuning_sample(root, sample_bytes)
+    if len(sample) == 0:
+        raise ValueError(f"No files to tune hashing with under {root}")
+    print(f"Tuning hashing with {' and '.join(algorithms)} for {key} with {len(sample):,} files ({total/2**20:,.1f}MB) from {root}")
+
+    results = []
+    for workers in worker_counts:
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        for buffer_size in buffer_sizes:
+            for fpath in sample:
+                evict(fpath)
+            work = [(fpath, algorithms, buffer_size) for fpath in sample]
+            start = time.perf_counter()
+            if pool is None:
+                list(map(tune_digests, work))
+            else:
+                pool.map(tune_digests, work, chunksize=1)
+            elapsed = time.perf_counter() - start
+            results.append((buffer_size, workers, total / 2**20 / elapsed))
+            print(f"{buffer_size:>10,} byte buffer, {workers:>3} workers: {results[-1][2]:>9,.1f} MB/s")
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    buffer_size, workers, mb_per_s = max(results, key=lambda r: r[2])
+    tuning = {"buffer_size": buffer_size, "workers": workers, "mb_per_s": mb_per_s, "tuned": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "root": os.path.abspath(root), "sample_mb": total / 2**20, "algorithms": algorithms, "results": results}
+    save_hash_tuning(key, tuning, fname)
+    return key, tuning
+
+def open_hash_cache(fpath):
+    # Start using the hash cache at fpath (usually root/filesystem.hashcache). Only records where it is - it's
+    # connected to (and created if needed) on first use, in whichever process uses it, so nothing forked after this
+    # inherits an open sqlite connection, which sqlite says can corrupt the database.
+    close_hash_cache()
+    hash_cache["fpath"] = fpath
+
+def get_hash_cache():
+    # Get the connection to the hash cache for this process, or None if it isn't enabled.
+    # sqlite connections can't be shared across a fork, so worker processes each open their own on first use.
+    # Anything that forks workers mustn't have used the cache in the parent yet (see open_hash_cache).
+    if hash_cache["fpath"] is None:
+        return None
+    if hash_cache["pid"] != os.getpid():
+        conn = sqlite3.connect(hash_cache["fpath"], timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL") # so workers can read while another is writing
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+                     "kind TEXT, digest BLOB, PRIMARY KEY (dev, inode, size, mtime_ns, kind)) WITHOUT ROWID")
+        hash_cache.update(conn=conn, pid=os.getpid(), pending=0)
+    return hash_cache["conn"]
+
+def commit_hash_cache():
+    # Write any newly cached digests to disk.
+    conn = get_hash_cache()
+    if conn is not None and hash_cache["pending"] > 0:
+        conn.commit()
+        hash_cache["pending"] = 0
+
+def close_hash_cache():
+    if hash_cache["conn"] is not None and hash_cache["pid"] == os.getpid():
+        commit_hash_cache()
+        hash_cache["conn"].close()
+    hash_cache.update(fpath=None, conn=None, pid=None, pending=0)
+
+def cached_digests(fpath, kinds, compute):
+    # Get the digest of each of kinds for fpath from the hash cache if the file hasn't changed since we cached it,
+    # and any that aren't with compute(missing kinds), which returns their digests in the same order, caching them.
+    # Just computes them all if the cache isn't enabled.
+    conn = get_hash_cache()
+    if conn is None:
+        return compute(kinds)
+    st = os.stat(fpath)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    digests = {}
+    for kind in kinds:
+        row = conn.execute("SELECT digest FROM hashes WHERE dev=? AND inode=? AND size=? AND mtime_ns=? AND kind=?", key + (kind,)).fetchone()
+        if row is not None:
+            digests[kind] = row[0]
+    missing = [kind for kind in kinds if kind not in digests]
+    if len(missing) > 0:
+        for kind, digest in zip(missing, compute(missing)):
+            digests[kind] = digest
+            conn.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", key + (kind, digest))
+        hash_cache["pending"] += len(missing)
+        if hash_cache["pending"] >= HASH_CACHE_COMMIT_INTERVAL:
+            commit_hash_cache()
+    return [digests[kind] for kind in kinds]
+
+def cached_digest(fpath, kind, compute):
+    # cached_digests for a single kind, computed with compute().
+    return cached_digests(fpath, [kind], lambda kinds: [compute()])[0]
+
+def new_hasher(algorithm):
+    # New hasher (update / digest / hexdigest) for algorithm, any of HASH_ALGORITHMS.
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm {algorithm}, can be any of {', '.join(HASH_ALGORITHMS)}" +
+                         (" (xxh128 needs xxhash installed)" if algorithm == "xxh128" else ""))
+    return HASH_ALGORITHMS[algorithm]()
+
+def hash_digests(fpath, algorithms):
+    # Raw digests of the file contents of fpath with each of algorithms, e.g. [CONTENT_HASH, KNOWN_HASH],
+    # all from the same single read of the file (or none at all if they're cached).
+    return cached_digests(fpath, algorithms, lambda missing: file_digests(fpath, missing))
+
+def hash_digest(fpath, algorithm=CONTENT_HASH):
+    # Raw digest of the file contents of fpath with algorithm, the content hash for finding duplicates by default.
+    return hash_digests(fpath, [algorithm])[0]
+
+def md5_digest(fpath):
+    # Quickly get raw 16-byte md5 digest for file contents of fname, for checking against the known hashes.
+    return hash_digest(fpath, KNOWN_HASH)
+
+def file_digests(fpath, algorithms, buffer_size=None):
+    # Actually read and hash the file with each of algorithms, without checking the cache.
+    # Read in chunks of buffer_size, by default whatever hashing is tuned to for the device it's on.
+    hashers = [new_hasher(algorithm) for algorithm in algorithms]
+    with open(fpath, "rb") as f:
+        buffer_size = buffer_size or md5_buffer_size(os.fstat(f.fileno()).st_dev)
+        for chunk in iter(lambda: f.read(buffer_size), b""):
+            for hasher in hashers:
+                hasher.update(chunk)
+    return [hasher.digest() for hasher in hashers]
 
-MD5_BUFFER_SIZE = 2**17  # (~.12 million) default unless we run function to get the optimal value for this sytem
-
-def get_optimal_md5_buffer_size():
-    # Run md5 hash on an arbitrary 500MB file with different buffer sizes
-    # to determine the fastest buffer size for this machine.
-
-    print("Determining System-Wide Optimal MD5 Buffer Size")
-    # 500mb random content file
-    f = open("md5test","wb")
-    f.write(os.urandom(500000000)) #500 million
-    f.close()
-
-    # Time to time from 1024 to 4,194,304
-    sizes = [2**(i) for i in range(10, 22)]
-    times = [0]*len(sizes)
-    for i,size in enumerate(tqdm(sizes)):
-        start = time.time()
-        hash_md5 = hashlib.md5()
-        with open("md5test", "rb") as f:
-            for chunk in iter(lambda: f.read(size), b""):
-                hash_md5.update(chunk)
-        end = time.time()-start
-        times[i] = end
-
-    optimal_buffer_size = sizes[np.argmin(times)]
-    global MD5_BUFFER_SIZE #Update global usevar
-    MD5_BUFFER_SIZE = optimal_buffer_size
-    print(f"Determined {optimal_buffer_size} as Optimal Buffer Size")
-    os.remove("md5test")
-    return optimal_buffer_size
 
 def md5(fpath):
     # Quickly get md5 hash for file contents of fname
-    hash_md5 = hashlib.md5()
+    return md5_digest(fpath).hex()
+
+def sampled_digest(fpath, size=None, algorithm=CONTENT_HASH):
+    # Quickly get a hex digest of a sample of the file contents - the first, middle, and last SAMPLE_SIZE bytes,
+    # along with the file size. This is O(k) rather than O(n), so it's great for ruling out files that aren't
+    # duplicates, but equal sampled digests don't mean equal files, so confirm those with a full digest.
+    # Files small enough that the samples would cover all of them just get their full digest.
+    if size is None:
+        size = os.path.getsize(fpath)
+    if size <= 3*SAMPLE_SIZE:
+        return hash_digest(fpath, algorithm).hex()
+    return cached_digest(fpath, sampled_algorithm(size, algorithm), lambda: file_sampled_digest(fpath, size, algorithm))
+
+def sampled_algorithm(size, algorithm=CONTENT_HASH):
+    # What sampled_digest of a file of size is really a digest of, e.g. "sampled_md5", or just "md5" for small files
+    # which get their full digest. What it's recorded as in the index (and hash cache).
+    return algorithm if size <= 3*SAMPLE_SIZE else "sampled_" + algorithm
+
+def sampled_md5(fpath, size=None):
+    return sampled_digest(fpath, size, KNOWN_HASH)
+
+def file_sampled_digest(fpath, size, algorithm):
+    hasher = new_hasher(algorithm)
+    hasher.update(str(size).encode())
     with open(fpath, "rb") as f:
-        for chunk in iter(lambda: f.read(MD5_BUFFER_SIZE), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        for offset in [0, size//2 - SAMPLE_SIZE//2, size - SAMPLE_SIZE]:
+            f.seek(offset)
+            hasher.update(f.read(SAMPLE_SIZE))
+    return hasher.hexdigest()
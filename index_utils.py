@@ -0,0 +1,131 @@
+"""
+index_utils.py
+
+Utilities for the tomb index - the record of every file in a tomb, with its digest and which subdirectory it was
+    sorted into.
+
+The index used to be a dict of digest: fpath held in memory and written out as "fname, digest" text at the very end,
+    so a crash two days into a raid lost all of it, and anything reading it had to parse the whole text file.
+    Now it's a sqlite database (filesystem.index.db) written to in batches as we go, with indexes on digest, path,
+    and subdir for fast lookups. The text filesystem.index is still exported from it at the end, for compatibility
+    and for reading without having to decompress a whole tomb.
+
+Digests aren't all md5 anymore - duplicates are found with whatever hash_utils.CONTENT_HASH is, and deduplicate
+    indexes files it never fully hashed by a sampled digest - so every entry records the algorithm its digest is from,
+    and digests are only comparable (e.g. across tombs) when their algorithms are the same.
+    The text index has it as a third field, "fname, digest, algorithm".
+"""
+import os
+import sqlite3
+from tqdm import tqdm
+
+INDEX_FNAME = "filesystem.index"
+INDEX_DB_FNAME = "filesystem.index.db"
+
+# What digests in indexes from before we recorded the algorithm are from. Raiding only ever indexed md5s - deduplicate
+# also indexed sampled md5s of files it didn't fully hash, which can't be told apart from them.
+LEGACY_ALGORITHM = "md5"
+
+
+def tomb_subdir(fpath, root):
+    # Subdirectory of the tomb at root that fpath is in, as raiding sorts them - "Filesystem" for anything recovered
+    # with its filesystem, and "Recovered_Files/Images" etc. for anything sorted by type. "" if directly in root.
+    parts = os.path.relpath(fpath, root).split(os.sep)
+    if parts[0] == "Recovered_Files" and len(parts) > 2:
+        return "/".join(parts[:2])
+    return parts[0] if len(parts) > 1 else ""
+
+
+def open_index(root):
+    # Open (creating if needed) the index database for the tomb at root.
+    conn = sqlite3.connect(os.path.join(root, INDEX_DB_FNAME))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL") # Still crash-safe in WAL mode, only a power loss can lose the last commit
+    conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, digest TEXT NOT NULL, subdir TEXT, algorithm TEXT)")
+    # Indexes from before we recorded algorithms get the column, empty for what's already in them (see LEGACY_ALGORITHM)
+    if "algorithm" not in [row[1] for row in conn.execute("PRAGMA table_info(files)")]:
+        conn.execute("ALTER TABLE files ADD COLUMN algorithm TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS files_digest ON files (digest)")
+    conn.execute("CREATE INDEX IF NOT EXISTS files_subdir ON files (subdir)")
+    conn.commit()
+    return conn
+
+
+def add_to_index(conn, entries):
+    # Add a batch of (path, digest, subdir, algorithm) entries to the index and commit them, so they're safe on disk.
+    # Paths already in the index are updated.
+    conn.executemany("INSERT OR REPLACE INTO files (path, digest, subdir, algorithm) VALUES (?, ?, ?, ?)", entries)
+    conn.commit()
+
+
+def clear_index(conn):
+    conn.execute("DELETE FROM files")
+    conn.commit()
+
+
+def index_paths_with_digest(conn, digest):
+    return [row[0] for row in conn.execute("SELECT path FROM files WHERE digest = ?", (digest,))]
+
+
+def index_paths_with_prefix(conn, prefix):
+    # All indexed paths starting with prefix, using the primary key rather than scanning the whole index.
+    if len(prefix) == 0:
+        return [row[0] for row in conn.execute("SELECT path FROM files ORDER BY path")]
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return [row[0] for row in conn.execute("SELECT path FROM files WHERE path >= ? AND path < ? ORDER BY path", (prefix, upper))]
+
+
+def index_paths_in_subdir(conn, subdir):
+    # All indexed paths sorted into subdir, e.g. "Recovered_Files/Images"
+    return [row[0] for row in conn.execute("SELECT path FROM files WHERE subdir = ?", (subdir,))]
+
+
+def index_items(conn, with_algorithm=False):
+    # Iterate (path, digest) for everything in the index, or (path, digest, algorithm) with_algorithm.
+    if with_algorithm:
+        return conn.execute("SELECT path, digest, COALESCE(algorithm, ?) FROM files", (LEGACY_ALGORITHM,))
+    return conn.execute("SELECT path, digest FROM files")
+
+
+def export_index(conn, index_fname):
+    # Write the index to the text format at index_fname, "fname, digest, algorithm" per line.
+    n = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    with open(index_fname, "w") as f:
+        for path, digest, algorithm in tqdm(index_items(conn, with_algorithm=True), total=n):
+            f.write(f"{path}, {digest}, {algorithm}\n")
+
+
+def ishex(s):
+    return len(s) > 0 and all(c in "0123456789abcdef" for c in s)
+
+
+def read_index(root, with_algorithm=False):
+    """
+    Iterate (path, digest) for every file in the index of the tomb at root, or (path, digest, algorithm) with_algorithm.
+
+    Reads the database if there is one, otherwise parses the text index. The text format has no escaping, so we split
+        on the last ", " since digests and algorithms never contain one, and paths with ", " in them still come out right.
+        Text indexes from before we recorded algorithms only have "fname, digest" - we can tell, since a digest is
+        always hex and an algorithm name never is.
+
+    :param root: Root directory of the tomb, containing filesystem.index.db and / or filesystem.index
+    :param with_algorithm: If we should also give the algorithm of each digest, LEGACY_ALGORITHM if it wasn't recorded
+    :return: Yields (path, digest), or (path, digest, algorithm)
+    """
+    if os.path.exists(os.path.join(root, INDEX_DB_FNAME)):
+        conn = open_index(root)
+        yield from index_items(conn, with_algorithm)
+        conn.close()
+        return
+
+    with open(os.path.join(root, INDEX_FNAME), "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if ", " not in line:
+                continue
+            path, digest = line.rsplit(", ", 1)
+            algorithm = LEGACY_ALGORITHM
+            if not ishex(digest) and ", " in path:
+                algorithm = digest
+                path, digest = path.rsplit(", ", 1)
+            yield (path, digest, algorithm) if with_algorithm else (path, digest)
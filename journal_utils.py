@@ -0,0 +1,81 @@
+"""
+journal_utils.py
+
+Write-ahead journal for raiding, so a crash hours (or days) into a raid doesn't mean starting over.
+
+Before the raid acts on a batch of files, every decision for the batch - keep it and move it to dst, or remove it -
+    is appended to the journal and synced to disk. Only then are the files moved / removed. So after a crash:
+    - Every file we'd finished with is already out of testdisk/ and photorec/, so the walk doesn't see it again.
+    - Any decision that was journaled but not carried out (its file is still where it was) can be redone exactly.
+    - The set of digests we've kept is rebuilt from the journal in seconds, rather than rehashing the whole tomb.
+
+Each line is a JSON list of [action, digest, src, dst, subdir], since recovered filenames can contain tabs,
+    commas, newlines, and undecodable bytes, all of which JSON escapes safely.
+"""
+import os
+import json
+
+JOURNAL_FNAME = "raid.journal"
+
+# Actions we journal. Blacklisted files are removed, but their digest still counts as found so copies get removed too.
+KEEP = "keep"
+REMOVE = "remove"
+BLACKLIST = "blacklist"
+
+
+def open_journal(root):
+    # Open the journal to append to, first cutting off anything after its last complete decision - if we crashed
+    # mid-write, the next batch would otherwise be written onto the end of the partial line, and both lost with it.
+    fpath = os.path.join(root, JOURNAL_FNAME)
+    if os.path.exists(fpath):
+        _, end = parse_journal(fpath)
+        if end < os.path.getsize(fpath):
+            os.truncate(fpath, end)
+    return open(fpath, "a")
+
+
+def journal_decisions(journal, decisions):
+    # Append a batch of (action, digest, src, dst, subdir) decisions and make sure they're on disk before returning.
+    journal.write("".join(json.dumps(decision) + "\n" for decision in decisions))
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def parse_journal(fpath):
+    # Every complete decision in the journal at fpath, and the byte offset just past the last of them.
+    # Only lines ending in a newline count - one without was cut off mid-write, even if what's there happens to parse.
+    decisions = []
+    end = 0
+    with open(fpath, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                decisions.append(tuple(json.loads(line)))
+            except ValueError:
+                break
+            end += len(line)
+    return decisions, end
+
+
+def read_journal(root):
+    """
+    Read every decision from the journal of a previous raid on root, if there is one.
+
+    If we crashed mid-write the last line might be incomplete, but then none of its batch was acted on
+        (we only act after the write finishes), so we just stop there. open_journal cuts it off before we append.
+
+    :param root: Filesystem root the raid is writing to
+    :return: List of (action, digest, src, dst, subdir), empty if there's no journal
+    """
+    fpath = os.path.join(root, JOURNAL_FNAME)
+    if not os.path.exists(fpath):
+        return []
+    return parse_journal(fpath)[0]
+
+
+def remove_journal(root):
+    # Once a raid has finished and everything is in the index, the journal isn't needed anymore.
+    fpath = os.path.join(root, JOURNAL_FNAME)
+    if os.path.exists(fpath):
+        os.remove(fpath)
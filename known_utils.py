@@ -0,0 +1,287 @@
+"""
+known_utils.py
+
+Utilities for building, loading, and querying the database of known (NSRL) md5 hashes.
+
+The original database is known.npy, an object array of sorted hex strings, which has to be unpickled in full on
+    every run (~20 seconds and several GB for the NSRL set). Instead we now store each md5 as the 128-bit number it is,
+    split into two uint64 halves, and save it as a (2, n) uint64 .npy file sorted by (hi, lo):
+
+    known[0] = top 8 bytes of every digest (big-endian, so numeric order == byte order)
+    known[1] = bottom 8 bytes of every digest
+
+Row-major means each half is a contiguous column, so we can open it with np.load(..., mmap_mode="r") in milliseconds,
+    binary search on known[0] directly without copying it, and every process that opens it shares the same pages
+    from the page cache.
+
+For the full NSRL set (150M+ hashes) a binary search over the whole column still touches ~27 random pages per lookup
+    on a cold cache, so next to it we can store a prefix table (known.u128.prefix.npy). Entry b of the table is the
+    offset of the first digest whose top PREFIX_BITS bits are >= b, so the digests starting with b are exactly
+    known[:, prefix[b]:prefix[b+1]]. That's a handful of digests, so a lookup touches one page per column.
+"""
+import os
+import numpy as np
+from tqdm import tqdm
+
+# Suffix for the packed known hashes database, e.g. known.npy -> known.u128.npy
+KNOWN_MD5S_SUFFIX = ".u128.npy"
+
+# Suffix for the prefix table stored alongside it, e.g. known.u128.npy -> known.u128.prefix.npy
+KNOWN_PREFIX_SUFFIX = ".prefix.npy"
+
+# Default number of top bits of each digest used for the prefix table. 24 bits gives ~16.7 million buckets,
+# so ~9 digests per bucket for the NSRL set, at 64MB for the table itself.
+PREFIX_BITS = 24
+
+# If a batch of lookups hits buckets wider than this, we search those buckets one at a time instead of gathering
+# every bucket entry at once, so a table with too few bits for its hashset can't blow up memory.
+BUCKET_SCAN_LIMIT = 64
+
+# Number of buckets of a prefix table we check against its digests when loading it, see load_known_prefix.
+PREFIX_CHECK_SAMPLES = 64
+
+# Number of hex digests we convert at once when building from the legacy format, keeps memory use bounded.
+BUILD_CHUNK_SIZE = 2**20
+
+
+def split_digests(digests):
+    # Given an iterable of raw 16-byte digests, return the (hi, lo) uint64 halves of each as two native arrays.
+    buf = b"".join(digests)
+    if len(buf) % 16 != 0:
+        raise ValueError("Digests must all be raw 16-byte md5 digests.")
+    halves = np.frombuffer(buf, dtype=">u8").reshape(-1, 2)
+    return halves[:, 0].astype(np.uint64), halves[:, 1].astype(np.uint64)
+
+
+def is_legacy_known_md5s(fname):
+    # Check the .npy header to see if this is the old object array of hex strings, without loading any of it.
+    with open(fname, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return dtype.hasobject
+
+
+def build_known_md5s(src_fname, dst_fname):
+    """
+    Convert the legacy known.npy (object array of hex strings) into the packed, sorted uint64 format.
+        This is a one-time cost, after which every run opens the result instantly.
+
+    Hex strings may be upper or lowercase (NSRL ships uppercase), since we convert them to the raw bytes.
+
+    :param src_fname: Legacy known.npy file
+    :param dst_fname: Destination file for the packed database, usually known.u128.npy
+    :return: Number of hashes written
+    """
+    print(f"Loading legacy known hashes file {src_fname}. This may take a moment...")
+    known = np.load(src_fname, allow_pickle=True)
+    n = len(known)
+
+    print(f"Converting {n:,} hex digests to uint64 pairs...")
+    hi = np.empty(n, dtype=np.uint64)
+    lo = np.empty(n, dtype=np.uint64)
+    for i in tqdm(range(0, n, BUILD_CHUNK_SIZE)):
+        chunk = known[i:i + BUILD_CHUNK_SIZE]
+        hi[i:i + len(chunk)], lo[i:i + len(chunk)] = split_digests(bytes.fromhex(digest) for digest in chunk)
+    del known
+
+    # Legacy file was sorted by hex string, which isn't the same order once case is normalised, so always re-sort.
+    print("Sorting...")
+    order = np.lexsort((lo, hi))
+
+    print(f"Writing packed known hashes to {dst_fname}")
+    out = np.lib.format.open_memmap(dst_fname, mode="w+", dtype=np.uint64, shape=(2, n))
+    out[0] = hi[order]
+    out[1] = lo[order]
+    out.flush()
+    del out
+    return n
+
+
+def prefix_fname(fname):
+    # Filename of the prefix table that goes with the packed known hashes database at fname.
+    if fname.endswith(".npy"):
+        fname = fname[:-len(".npy")]
+    return fname + KNOWN_PREFIX_SUFFIX
+
+
+def build_known_prefix(digests, prefix_bits=PREFIX_BITS):
+    """
+    Build the prefix table for a sorted (2, n) uint64 array of known digests.
+
+    :param digests: Packed known digests, from load_known_md5s or build_known_md5s
+    :param prefix_bits: Number of top bits of each digest to bucket on. 16-24 is sensible for NSRL-sized sets.
+    :return: Array of 2**prefix_bits + 1 offsets into digests
+    """
+    his = digests[0]
+    n = len(his)
+    shift = np.uint64(64 - prefix_bits)
+    prefix = np.empty(2**prefix_bits + 1, dtype=np.uint32 if n < 2**32 else np.uint64)
+
+    # First digest of each bucket is wherever the smallest value with that prefix would be inserted.
+    prefix[:-1] = np.searchsorted(his, np.arange(2**prefix_bits, dtype=np.uint64) << shift)
+    prefix[-1] = n
+    return prefix
+
+
+def save_known_prefix(fname, prefix_bits=PREFIX_BITS, what="hashes"):
+    # Build the prefix table for the packed array at fname (known hashes, or a balance snapshot - anything sorted by
+    # the same two uint64 halves) and save it next to it. what is what's in it, for the stats we print.
+    print(f"Building {prefix_bits}-bit prefix table for {fname}...")
+    prefix = build_known_prefix(np.load(fname, mmap_mode="r"), prefix_bits)
+    np.save(prefix_fname(fname), prefix)
+    widths = np.diff(prefix)
+    print(f"Wrote prefix table to {prefix_fname(fname)} ({widths.mean():.2f} {what} per bucket on average, {widths.max()} at most)")
+    return prefix
+
+
+def load_known_prefix(fname, packed):
+    """
+    Memory-map the prefix table for the packed array at fname, checking it actually goes with packed.
+
+    A stale table (e.g. left over from a previous hashset) would silently send lookups to the wrong buckets, so known
+        files would be kept and others removed. So we check it has 2**bits + 1 entries, ends at the number of digests,
+        and that a sample of its buckets start where they should - which catches a different hashset of the same size.
+
+    :param fname: Packed array, e.g. known.u128.npy or balances.npy
+    :param packed: The array itself, from np.load(fname, mmap_mode="r")
+    :return: Prefix table, or None if there isn't one
+    """
+    fpath = prefix_fname(fname)
+    if not os.path.exists(fpath):
+        return None
+    prefix = np.load(fpath, mmap_mode="r")
+    rebuild = f"Rebuild it with `python3 scripts/build_known_md5s.py {fname}` (or build_balance_snapshot.py for balances)."
+    prefix_bits = (len(prefix) - 1).bit_length() - 1
+    if len(prefix) < 2 or len(prefix) != 2**prefix_bits + 1:
+        raise ValueError(f"Prefix table {fpath} has {len(prefix)} entries, not 2**bits + 1. {rebuild}")
+    his = packed[0]
+    if prefix[0] != 0 or prefix[-1] != len(his):
+        raise ValueError(f"Prefix table {fpath} is for {prefix[-1]:,} digests, but {fname} has {len(his):,}. {rebuild}")
+    shift = np.uint64(64 - prefix_bits)
+    for b in np.linspace(0, 2**prefix_bits - 1, num=min(PREFIX_CHECK_SAMPLES, 2**prefix_bits), dtype=np.int64):
+        start, end = int(prefix[b]), int(prefix[b + 1])
+        # Every digest in the bucket has its prefix, and the one before it a smaller one
+        if start > end or (start < end and (his[start] >> shift != b or his[end - 1] >> shift != b)) or \
+                (start > 0 and his[start - 1] >> shift >= b):
+            raise ValueError(f"Prefix table {fpath} doesn't match the digests in {fname}. {rebuild}")
+    return prefix
+
+
+def load_known_md5s(fname):
+    """
+    Open the known hashes database at fname for use with isknown.
+
+    The packed format is memory-mapped and loads in milliseconds, along with its prefix table if one has been built.
+        If given a legacy known.npy instead, we still support it by loading and converting it in memory,
+        but this is slow and we tell the user how to fix that.
+
+    :param fname: Packed known.u128.npy file, or legacy known.npy
+    :return: (digests, prefix), with digests the (2, n) uint64 array of sorted known digests,
+        and prefix the prefix table, or None if there isn't one.
+    """
+    if not is_legacy_known_md5s(fname):
+        digests = np.load(fname, mmap_mode="r")
+        prefix = load_known_prefix(fname, digests)
+        if prefix is None:
+            print(f"No prefix table found for {fname}, lookups will use a full binary search.")
+            print(f"Run `python3 scripts/build_known_md5s.py {fname}` to build one.")
+        return digests, prefix
+
+    print(f"{fname} is a legacy hex string database. Converting in memory, this may take a while...")
+    print(f"Run `python3 scripts/build_known_md5s.py {fname}` once to avoid this on future runs.")
+    known = np.load(fname, allow_pickle=True)
+    hi, lo = split_digests(bytes.fromhex(digest) for digest in known)
+    order = np.lexsort((lo, hi))
+    return np.stack((hi[order], lo[order])), None
+
+
+def bucket_bounds(prefix, hi):
+    # Given the prefix table and top halves of digests (scalar or array), return the (start, end) range
+    # of the known digests that could contain each of them.
+    prefix_bits = (len(prefix) - 1).bit_length() - 1
+    b = hi >> np.uint64(64 - prefix_bits)
+    return prefix[b].astype(np.int64), prefix[b + 1].astype(np.int64)
+
+
+def find_digest(packed, prefix, digest):
+    # Index of the raw 16-byte digest in packed, any array sorted by its first two rows of uint64 halves (the known
+    # hashes, or a balance snapshot), or -1 if it isn't in it. prefix is its prefix table, or None for a full search.
+    hi, lo = np.frombuffer(digest, dtype=">u8").astype(np.uint64)
+    his, los = packed[0], packed[1]
+
+    # Only search within our bucket if we have a prefix table, otherwise the whole thing.
+    start, end = 0, len(his)
+    if prefix is not None:
+        start, end = bucket_bounds(prefix, hi)
+    i = start + np.searchsorted(his[start:end], hi)
+
+    # Top halves colliding is astronomically rare, but we check every match so this is exact.
+    while i < end and his[i] == hi:
+        if los[i] == lo:
+            return int(i)
+        i += 1
+    return -1
+
+
+def isknown(known_md5s, digest):
+    # Check if the raw 16-byte md5 digest is in the known hashes database.
+    digests, prefix = known_md5s
+    return find_digest(digests, prefix, digest) != -1
+
+
+def isknown_batch(known_md5s, digests):
+    """
+    Vectorized isknown, checks a whole list of raw 16-byte digests at once instead of paying
+        the python / numpy call overhead once per file.
+
+    With a prefix table, we gather every entry of each digest's bucket and compare them all at once,
+        which only touches the pages those buckets are on. Without one, it's a single searchsorted call.
+
+    :param known_md5s: (digests, prefix) from load_known_md5s
+    :param digests: List of raw 16-byte md5 digests
+    :return: Boolean mask, True where the digest is known
+    """
+    known_digests, prefix = known_md5s
+    his, los = known_digests[0], known_digests[1]
+    n = len(his)
+    if len(digests) == 0 or n == 0:
+        return np.zeros(len(digests), dtype=bool)
+    hi, lo = split_digests(digests)
+
+    if prefix is not None:
+        starts, ends = bucket_bounds(prefix, hi)
+        width = int((ends - starts).max())
+        if width <= BUCKET_SCAN_LIMIT:
+            # (batch, width) matrix of every index in each bucket, padded by repeating the bucket start.
+            idx = starts[:, None] + np.arange(width)
+            valid = idx < ends[:, None]
+            idx = np.where(valid, idx, np.minimum(starts, n - 1)[:, None])
+            match = valid & (his[idx] == hi[:, None]) & (los[idx] == lo[:, None])
+            return match.any(axis=1)
+
+        # Oversized buckets, fall back to checking each on its own.
+        return np.array([isknown(known_md5s, digest) for digest in digests], dtype=bool)
+
+    i = np.searchsorted(his, hi)
+    j = np.minimum(i, n - 1) # so we can index with it, we check i < n anyways
+    hi_match = (i < n) & (his[j] == hi)
+    known = hi_match & (los[j] == lo)
+
+    # Same rare case as isknown, where top halves collide and the match might be further along the run.
+    for k in np.flatnonzero(hi_match & ~known):
+        known[k] = isknown(known_md5s, digests[k])
+    return known
+
+
+def first_occurrence_mask(digests):
+    # Given a list of raw digests (all the same length, e.g. 16 bytes for md5), return a mask which is True only for
+    # the first occurrence of each digest.
+    mask = np.zeros(len(digests), dtype=bool)
+    if len(digests) == 0:
+        return mask
+    _, first = np.unique(np.frombuffer(b"".join(digests), dtype=f"S{len(digests[0])}"), return_index=True)
+    mask[first] = True
+    return mask
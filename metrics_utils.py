@@ -0,0 +1,219 @@
+"""
+metrics_utils.py
+
+Per-stage instrumentation for raiding, deduplicating and salvaging - how much time goes to walking, hashing, isknown,
+    libmagic, moving files, etc. - so when a run is slow we can see where, rather than guessing.
+
+For each stage we keep the number of calls, items and bytes processed, cumulative time, and a histogram of how long
+    each call took. Stages are timed with
+        with timed("hash", nbytes=size):
+            digest = md5_digest(fpath)
+    and every METRICS_INTERVAL seconds (and at exit) the totals so far are appended to a JSON lines file, and written
+    to a Prometheus textfile-collector file (node_exporter --collector.textfile.directory), replacing the last one.
+
+Everything is off unless enable_metrics() is called (the --metrics flag of each script), and while it's off timed()
+    returns a shared do-nothing context, so leaving the calls in costs next to nothing.
+
+Worker processes inherit whether it's on when forked, and start with empty totals. They never write the files
+    themselves - they hand back what they recorded with take_metrics(), for the main process to merge_metrics().
+"""
+import os
+import sys
+import json
+import time
+import bisect
+import atexit
+import threading
+import contextlib
+
+# Default files to write metrics to, in the directory we're run from. The JSON lines are labelled with the script
+# they're from, so can be shared, but each script needs its own Prometheus file, since it's replaced every time.
+METRICS_FNAME = "tomb_metrics.jsonl"
+METRICS_PROM_FNAME = "tomb_metrics_{script}.prom"
+
+# Seconds between writing out the metrics so far
+METRICS_INTERVAL = 10
+
+# Upper bounds of the latency histogram buckets, in seconds - from a cached hash lookup to a huge file
+LATENCY_BUCKETS = [1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1, 10, 100]
+
+metrics = {"enabled": False, "script": "", "pid": None, "fname": METRICS_FNAME, "prom_fname": METRICS_PROM_FNAME,
+           "start": time.time(), "last_emit": time.monotonic(), "stages": {}}
+
+# Stages can be recorded from more than one thread, e.g. the walk feeding a pool in raid_filesystem
+metrics_lock = threading.Lock()
+
+NOT_TIMED = contextlib.nullcontext()
+
+
+def enable_metrics(script=None, fname=METRICS_FNAME, prom_fname=METRICS_PROM_FNAME):
+    # Start recording metrics, writing them to fname and prom_fname from this process.
+    # script labels them, and defaults to the name of the script we're running.
+    script = script or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    metrics.update(enabled=True, pid=os.getpid(), fname=fname, prom_fname=prom_fname.format(script=script),
+                   start=time.time(), last_emit=time.monotonic(), stages={}, script=script)
+
+
+def metrics_enabled():
+    return metrics["enabled"]
+
+
+def new_stage():
+    return {"calls": 0, "items": 0, "bytes": 0, "seconds": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+
+
+def record(stage, seconds, n=1, nbytes=0):
+    # Record one call of stage that took seconds, for n items totalling nbytes.
+    with metrics_lock:
+        s = metrics["stages"].get(stage)
+        if s is None:
+            s = metrics["stages"][stage] = new_stage()
+        s["calls"] += 1
+        s["items"] += n
+        s["bytes"] += nbytes
+        s["seconds"] += seconds
+        s["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    if time.monotonic() - metrics["last_emit"] > METRICS_INTERVAL:
+        emit_metrics()
+
+
+@contextlib.contextmanager
+def timing(stage, n, nbytes):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, n, nbytes)
+
+
+def timed(stage, n=1, nbytes=0):
+    # Context to time a call of stage, for n items totalling nbytes. Does nothing if metrics aren't enabled.
+    if not metrics["enabled"]:
+        return NOT_TIMED
+    return timing(stage, n, nbytes)
+
+
+def timed_iter(iterable, stage):
+    # Pass through iterable, timing how long getting each item takes as stage, e.g. for a directory walk.
+    if not metrics["enabled"]:
+        return iterable
+    def timed_items():
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            record(stage, time.perf_counter() - start)
+            yield item
+    return timed_items()
+
+
+def take_metrics():
+    # Everything recorded in this process since the last take, clearing it. For workers to hand back with their results.
+    # None if metrics aren't enabled, so there's nothing to send.
+    if not metrics["enabled"]:
+        return None
+    with metrics_lock:
+        stages, metrics["stages"] = metrics["stages"], {}
+    return stages
+
+
+def merge_metrics(stages):
+    # Add stages from take_metrics (in a worker) to this process's totals.
+    if not stages:
+        return
+    with metrics_lock:
+        for stage, theirs in stages.items():
+            s = metrics["stages"].get(stage)
+            if s is None:
+                s = metrics["stages"][stage] = new_stage()
+            for key in ("calls", "items", "bytes", "seconds"):
+                s[key] += theirs[key]
+            s["buckets"] = [a + b for a, b in zip(s["buckets"], theirs["buckets"])]
+
+
+def stage_summary(s):
+    # Stage totals with their throughput, for the JSON lines.
+    return {**s, "items_per_s": s["items"] / s["seconds"] if s["seconds"] > 0 else 0.0,
+            "mb_per_s": s["bytes"] / 2**20 / s["seconds"] if s["seconds"] > 0 else 0.0,
+            "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], s["buckets"]))}
+
+
+def prometheus_text(script, stages):
+    # Stage totals in the Prometheus text exposition format.
+    lines = []
+    for name, kind, key, help in [
+        ("tombraider_stage_seconds_total", "counter", "seconds", "Cumulative time spent in each stage."),
+        ("tombraider_stage_calls_total", "counter", "calls", "Number of times each stage was timed."),
+        ("tombraider_stage_items_total", "counter", "items", "Number of items (usually files) each stage processed."),
+        ("tombraider_stage_bytes_total", "counter", "bytes", "Number of bytes each stage processed."),
+    ]:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for stage, s in sorted(stages.items()):
+            lines.append(f'{name}{{script="{script}",stage="{stage}"}} {s[key]}')
+
+    name = "tombraider_stage_latency_seconds"
+    lines.append(f"# HELP {name} How long each call of each stage took.")
+    lines.append(f"# TYPE {name} histogram")
+    for stage, s in sorted(stages.items()):
+        labels = f'script="{script}",stage="{stage}"'
+        cumulative = 0
+        for le, count in zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], s["buckets"]):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {s['seconds']}")
+        lines.append(f"{name}_count{{{labels}}} {s['calls']}")
+    return "\n".join(lines) + "\n"
+
+
+def emit_metrics():
+    # Write the totals so far - a line appended to the JSON lines file, and the whole Prometheus file replaced.
+    # Only from the process that enabled metrics, workers hand theirs back instead.
+    if not metrics["enabled"] or metrics["pid"] != os.getpid():
+        return
+    metrics["last_emit"] = time.monotonic()
+    with metrics_lock:
+        stages = {stage: dict(s, buckets=list(s["buckets"])) for stage, s in metrics["stages"].items()}
+
+    line = {"time": time.time(), "elapsed": time.time() - metrics["start"], "script": metrics["script"],
+            "stages": {stage: stage_summary(s) for stage, s in stages.items()}}
+    with open(metrics["fname"], "a") as f:
+        f.write(json.dumps(line) + "\n")
+
+    # Written to a temporary file and renamed, so the collector never reads half of one
+    tmp_fname = metrics["prom_fname"] + ".tmp"
+    with open(tmp_fname, "w") as f:
+        f.write(prometheus_text(metrics["script"], stages))
+    os.replace(tmp_fname, metrics["prom_fname"])
+
+
+def print_metrics():
+    # Table of every stage's totals, slowest first.
+    if not metrics["enabled"] or metrics["pid"] != os.getpid() or len(metrics["stages"]) == 0:
+        return
+    print(f"{'STAGE'.ljust(20)} | {'CALLS':>10} | {'ITEMS':>10} | {'SECONDS':>9} | {'ITEMS/S':>11} | {'MB/S':>9}")
+    for stage, s in sorted(metrics["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        s = stage_summary(s)
+        print(f"{stage.ljust(20)} | {s['calls']:>10,} | {s['items']:>10,} | {s['seconds']:>9.2f} | {s['items_per_s']:>11,.1f} | {s['mb_per_s']:>9,.1f}")
+
+
+def finish_metrics():
+    emit_metrics()
+    print_metrics()
+
+
+def reset_after_fork():
+    # Forked workers start with nothing recorded, so they only hand back their own. And a new lock, in case another
+    # thread was holding it when we forked.
+    global metrics_lock
+    metrics_lock = threading.Lock()
+    metrics["stages"] = {}
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+# So the last of them are written however we exit
+atexit.register(finish_metrics)
@@ -5,17 +5,56 @@ from utils.filesystem_utils import *
 #from tqdm import tqdm
 from utils.filter_utils import *
 from utils.hash_utils import *
+from utils.known_utils import *
+from utils.index_utils import *
+from utils.journal_utils import *
+from utils.scan_utils import *
+from utils.metrics_utils import *
 import numpy as np
 from collections import defaultdict
+from functools import partial
+import multiprocessing
 
+# Number of files each worker hashes and classifies before handing them back to be checked and moved in one go.
+# Small enough that work is spread evenly between workers, big enough that the vectorized checks are worth it.
+RAID_BATCH_SIZE = 1024
 
-def get_filetype_subdir(fname):
+# Default number of worker processes for hashing and classifying, one per core.
+RAID_WORKERS = os.cpu_count()
+
+# Known hashes database for worker processes, None if we aren't checking against known hashes.
+# Handed to each worker by init_raid_worker when the pool starts - when forked (the default on Linux) that's without
+# copying it, and since it's memory-mapped they all share the same pages rather than each loading their own.
+KNOWN_MD5S = None
+
+# Hash algorithms every file is digested with, handed to the workers like KNOWN_MD5S. The first is the content
+# hash duplicates are found (and files indexed) by, then md5 if we're checking known hashes and that isn't already it,
+# all computed from the same read of the file (see hash_utils.HASH_ALGORITHMS).
+DIGEST_ALGORITHMS = [CONTENT_HASH]
+
+
+def init_raid_worker(known_md5s, digest_algorithms, hash_cache_fpath):
+    # Pool initializer, so workers get everything raid_batch needs however they're started - with spawn or forkserver
+    # (the default on macOS, and on Linux from Python 3.14) they don't inherit the parent's globals, and would
+    # silently check nothing against the known hashes.
+    global KNOWN_MD5S, DIGEST_ALGORITHMS
+    KNOWN_MD5S = known_md5s
+    DIGEST_ALGORITHMS = digest_algorithms
+    if hash_cache_fpath is not None:
+        open_hash_cache(hash_cache_fpath)
+
+
+def get_filetype_subdir(fname, info=None):
     # Determine it's type, so we can know if its in blacklist and should be deleted.
     # Determine Ext class
     ext_class = filetype_from_ext(fname)
 
     # Determine Info class
-    info_class = filetype_from_info(fname)
+    # libmagic is by far the slowest part of this, so we probe the file once (if we weren't given its info already)
+    # and use that same info string for everything below, rather than probing again to check for plaintext.
+    if info is None:
+        info = safe_magic(fname)
+    info_class = filetype_from_infostr(info)
 
     # We now have ext class and info class.
     # We now sort them - if the classes agree, they go in that class. If they don't, then we have a lot
@@ -30,7 +69,7 @@ def get_filetype_subdir(fname):
 
     elif known(ext_class) and unsupported(info_class):
         # We know the ext but data is something else
-        if plaintext(fname):
+        if plaintext_info(info):
             # Some type of text file, trust the extension in this case
             subdir = ext_class
         else:
@@ -55,7 +94,7 @@ def get_filetype_subdir(fname):
 
     elif unknown(ext_class) and unsupported(info_class):
         # No extension, filedata is something unsupported
-        if plaintext(fname):
+        if plaintext_info(info):
             # Some type of text file, store in special directory
             subdir = "Unsupported_Text"
         else:
@@ -72,10 +111,135 @@ def get_filetype_subdir(fname):
     return subdir
 
 
-def process(testdisk_root, photorec_root, filesystem_root, known_md5s_fname, blacklist_fname=None):
+def batches(iterable, batch_size=RAID_BATCH_SIZE):
+    # Yield lists of up to batch_size items from iterable.
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def hash_file(fpath, classify=False):
+    # Raw digests of fpath with each of DIGEST_ALGORITHMS, and if we're going to classify it, the header libmagic needs,
+    # all from the same single read. If the digests are already in the hash cache we don't read the file at all,
+    # and header is None.
+    if not classify:
+        return hash_digests(fpath, DIGEST_ALGORITHMS), None
+    header = []
+    def compute(algorithms):
+        *digests, header_ = scan_file(fpath, [digest_consumer(algorithm) for algorithm in algorithms] + [header_consumer()])
+        header.append(header_)
+        return digests
+    digests = cached_digests(fpath, DIGEST_ALGORITHMS, compute)
+    return digests, header[0] if len(header) > 0 else None
+
+
+def raid_batch(batch, classify=False):
+    """
+    Worker stage of the raid pipeline. Does everything for a batch of files that doesn't depend on any other file,
+        so it can happen in parallel: hashing, checking against known hashes, and (optionally) classifying with
+        libmagic. Files which are known aren't classified, since they're going to be deleted anyways.
+
+    Each file is read once - its digests (the content hash, and the md5 for checking known hashes) and the header
+        libmagic classifies it by all come from the same read (see scan_utils), so libmagic only reads the file itself
+        if we got the digests from the hash cache.
+
+    Any files we can't read are skipped, as they were before.
+
+    :param batch: List of filepaths
+    :param classify: If we should also get the filetype subdirectory for each file (only needed for photorec)
+    :return: (results, metrics) - results being a list of (fpath, digest, isknown, subdir) for each readable file,
+        in the same order, digest being its content hash (DIGEST_ALGORITHMS[0]), subdir None if not classified, and metrics what this worker recorded (see metrics_utils),
+        None if metrics aren't enabled.
+    """
+    hashed = []
+    for fpath in batch:
+        try:
+            with timed("hash", nbytes=safesize(fpath) if metrics_enabled() else 0):
+                hashed.append((fpath, *hash_file(fpath, classify)))
+        except: continue
 
-    # Get optimal hashing buffer size to maximize speed for it
-    #get_optimal_md5_buffer_size()
+    commit_hash_cache()
+
+    known = [False] * len(hashed)
+    if KNOWN_MD5S is not None:
+        md5_i = DIGEST_ALGORITHMS.index(KNOWN_HASH)
+        with timed("isknown", n=len(hashed)):
+            known = isknown_batch(KNOWN_MD5S, [digests[md5_i] for _, digests, _ in hashed])
+    results = []
+    for (fpath, digests, header), isknown_ in zip(hashed, known):
+        subdir = None
+        if classify and not isknown_:
+            with timed("libmagic"):
+                subdir = get_filetype_subdir(fpath, safe_magic_buffer(header) if header is not None else None)
+        results.append((fpath, digests[0], bool(isknown_), subdir))
+    return results, take_metrics()
+
+
+def raid_batches(pool, fpath_iter, classify=False):
+    # Run raid_batch over fpath_iter with the pool, yielding each batch's results in order as they finish,
+    # so the writer makes the same decisions (first copy found wins) no matter how the work was split up.
+    # Metrics the workers recorded are added to ours as their batches come back.
+    work = partial(raid_batch, classify=classify)
+    batch_results = map(work, batches(fpath_iter)) if pool is None else pool.imap(work, batches(fpath_iter))
+    for results, worker_metrics in batch_results:
+        merge_metrics(worker_metrics)
+        yield results
+
+
+def new_digest_mask(digests, known, found_digests):
+    # Given a batch of digests and which are known, return a mask which is True only for those we haven't seen
+    # before - not known, not already found in a previous batch, and not a duplicate of an earlier file in this batch.
+    # In-batch checks are vectorized, found is a set so each check is already O(1).
+    new = ~np.asarray(known, dtype=bool) & first_occurrence_mask(digests)
+    for i in np.flatnonzero(new):
+        new[i] = digests[i] not in found_digests
+    return new
+
+
+def apply_decisions(journal, index, decisions):
+    """
+    Carry out a batch of decisions from the writer - (action, digest, src, dst, subdir) - journaling them first,
+        then moving / removing each file, then adding the ones we kept to the index.
+
+    Also used to replay the journal of a crashed raid, with journal=None so nothing is journaled twice.
+        Any decision whose src is already gone was carried out before the crash, so it's only (re-)indexed.
+
+    :param journal: Open journal file from open_journal, or None if replaying
+    :param index: Open index connection
+    :param decisions: List of (action, digest, src, dst, subdir), digest as hex, dst and subdir None unless kept
+    :return: Nothing, decisions are applied and indexed, with digests from the content hash (DIGEST_ALGORITHMS[0]).
+    """
+    if journal is not None:
+        with timed("journal", n=len(decisions)):
+            journal_decisions(journal, decisions)
+
+    indexed = []
+    for action, digest, src, dst, subdir in decisions:
+        if os.path.lexists(src):
+            if action == KEEP:
+                with timed("move"):
+                    # Testdisk files keep their directories, which may not be in the tomb yet
+                    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+                    dst = safemv(src, dst) or dst
+            else:
+                with timed("remove"):
+                    os.remove(src)
+        if action == KEEP:
+            indexed.append((dst, digest, subdir, DIGEST_ALGORITHMS[0]))
+    with timed("index", n=len(indexed)):
+        add_to_index(index, indexed)
+
+
+def process(testdisk_root, photorec_root, filesystem_root, known_md5s_fname, blacklist_fname=None, workers=RAID_WORKERS, content_hash=CONTENT_HASH):
+    # known_md5s_fname can be None to not check against known hashes, only remove duplicates.
+    # content_hash is the algorithm duplicates are found by, see DIGEST_ALGORITHMS.
+
+    # Hashing uses whatever buffer size was tuned for this device (scripts/tune_hashing.py), if it's been tuned
 
     # Counts of what files we find
     subdir_counts = defaultdict(lambda:1) # Default values to 1
@@ -89,106 +253,153 @@ def process(testdisk_root, photorec_root, filesystem_root, known_md5s_fname, bla
                 entry = line.strip()
                 blacklist.add(entry)
 
+    # Digests from any previous runs on these files, so we don't hash them again. Only its path is set here,
+    # each worker connects to it on its own the first time it hashes something.
+    open_hash_cache(filesystem_root + "/" + HASH_CACHE_FNAME)
+
     # Load all hashes
     # We tried many tests to find the fastest way to load this data (since it was taking max. two minutes originally)
     # We tried chunking the file and parallelizing the operations, as well as making each parallel process create
     # a subset that got added together into the final set - this got it down to one minute max.
-    # However, we found that using .npy files from numpy was the most feasible and also fastest method, giving us
-    # around 20 seconds for the loads, even with an 'object' class object. If numpy supported uint128 objects like
-    # the md5 hashes are in, this could be saved as a numpy binary file, however they don't support that datatype
-    # yet and I didn't bother to get into the math of converting them into numbers and back again.
-    # POSSIBLE UPGRADE: Could use some hash that gets it as 64 bits, to convert it to uint64, or could just
-    # split the 128 hash into two uint64s and keep them in pairs. For now though this gets around the annoying limit
-    # I was encountering on loading these 4gb files.
-    # Also it requires we use a nparray to store them and then use it's `searchsorted` function on it, which is about
-    # 4x slower than set contains, however they're both so damn fast that on 600,000 lookups searchsorted took a TOTAL
+    # We then used .npy files from numpy of 'object' hex strings, giving us around 20 seconds for the loads.
+    # Now the md5s are stored as their actual 128 bits, split into two sorted uint64 columns (see known_utils),
+    # so the file is memory-mapped rather than loaded and opening it is near-instant, no matter how many hashes.
+    # It still uses `searchsorted` rather than set contains, however on 600,000 lookups searchsorted took a TOTAL
     # of 2 seconds compared to set.contains .5 seconds. So we good to go.
-    print(f"Loading known hashes file {known_md5s_fname}. This may take a moment...")
-    known_md5s = np.load(known_md5s_fname, allow_pickle=True)
-    n = len(known_md5s)
-    def isknown(digest):
-        # Wish they could just have a contains method but oh heckin well
-        i = np.searchsorted(known_md5s, digest)
-        return i != 0 and i != n and known_md5s[i] == digest
+    global KNOWN_MD5S, DIGEST_ALGORITHMS
+    if known_md5s_fname is not None:
+        print(f"Loading known hashes file {known_md5s_fname}.")
+        KNOWN_MD5S = load_known_md5s(known_md5s_fname)
+    # Both digests from the same read if we need md5 for the known hashes and it isn't the content hash already.
+    DIGEST_ALGORITHMS = digest_algorithms(content_hash, known=KNOWN_MD5S is not None)
+    print(f"Hashing with {' and '.join(DIGEST_ALGORITHMS)}.")
+
+    # Workers are started before this process opens the index or anything else in sqlite, so none of them inherit an
+    # open connection - sqlite connections carried across a fork can corrupt the database.
+    print(f"Raiding Testdisk and Photorec Recovered Filesystems and Creating Tomb Filesystem with {workers} workers")
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_raid_worker,
+                                    initargs=(KNOWN_MD5S, DIGEST_ALGORITHMS, filesystem_root + "/" + HASH_CACHE_FNAME))
 
     # Since inserting into a numpy array would copy the array and is therefore way too costly,
     # we have a separate set for any new digests we find to compare for duplicates.
-    found_md5s = set({})
-    def isfound(digest):
-        return digest in found_md5s
+    # Holds the raw digests of the content hash rather than hex strings, since they're smaller.
+    found_digests = set({})
 
     # Do one pass, eliminating as many files as possible if we don't need them as we go.
     # This, I've found, is the best way to maximize speed and minimize disk space used.
-    index = {}
+    # Each batch of files we keep is committed to the index as soon as it's moved, so a crash doesn't lose it.
+    index = open_index(filesystem_root)
+
+    # If a previous raid crashed, pick up where it stopped. Everything it finished is already out of testdisk / photorec,
+    # so the walks below skip it, and the journal gives us back what we'd found without rehashing the tomb.
+    # Anything journaled but not yet done is finished first, exactly as it was decided.
+    # Its digests are whatever content hash it used, so resume with the same one (the default, unless given --hash).
+    decisions = read_journal(filesystem_root)
+    if len(decisions) > 0:
+        print(f"Resuming previous raid from its journal of {len(decisions)} files.")
+        for action, digest, src, dst, subdir in decisions:
+            if action != REMOVE:
+                found_digests.add(bytes.fromhex(digest))
+            if subdir is not None and subdir.startswith("Recovered_Files"):
+                subdir_counts[subdir] += 1
+        apply_decisions(None, index, decisions)
+    journal = open_journal(filesystem_root)
 
     # Iterate through testdisk first, since we only keep a photorec file if it's got new content
     # because testdisk will have the file metadata such as location and name.
-    print(f"Raiding Testdisk and Photorec Recovered Filesystems and Creating Tomb Filesystem")
-    # TODO rewrite this to be parallelized (will require running testdisk before photorec as a separate section)
-    # since this should be relatively easy to parallelize and should push the bottleneck back to the disk.
-
+    # This is a pipeline - the pool of workers hashes, checks known hashes, and classifies files in parallel,
+    # while this process is the only writer, deciding on duplicates, moving files, and updating the index
+    # as the batches come back in order. That way the cores are kept busy and the bottleneck is pushed back to the disk.
 
     filesystem_dir = "Filesystem/"
     if not os.path.exists(filesystem_dir):
         os.makedirs(filesystem_dir)
-    for fpath in tqdm(fpaths(testdisk_root)):
+    # Files are streamed straight from the walk into the pool, so we start raiding immediately
+    # rather than waiting to list millions of files first.
+    pbar = tqdm(unit=" files")
+    for results in raid_batches(pool, (entry.path for entry in timed_iter(scan_files(testdisk_root), "walk"))):
+        pbar.update(len(results))
         # HASH CHECKS
         # First check if we can delete it
-        # This will check both our list of knowns, and the one we've accumulated since the program started
-        try:
-            digest = md5(fpath)
-        except: continue
-        if isknown(digest) or isfound(digest):
-            os.remove(fpath)
-            continue
-        # Else add to our list of founds.
-        found_md5s.add(digest)
-
-        tomb_fpath = fpath
-        if "tomb/testdisk" in tomb_fpath:
-            tomb_fpath = re.sub('testdisk\/', filesystem_dir, tomb_fpath, count=1)
-
-        tomb_fpath = sanitize(tomb_fpath, sanitize_dirs=False)
-        # print(tomb_fpath, filesystem_dir)
-        # print(os.path.join(filesystem_dir, tomb_fpath))
-        safemv(fpath, tomb_fpath)
-        # print(os.path.join(filesystem_dir, tomb_fpath))
-        index[digest] = tomb_fpath
+        # This will check both our list of knowns, and the one we've accumulated since the program started,
+        # for the whole batch at once.
+        # Decisions for the whole batch are made first, then journaled and carried out together.
+        new = new_digest_mask([digest for _, digest, _, _ in results], [known for _, _, known, _ in results], found_digests)
+        decisions = []
+        reserved = set()
+        for (fpath, digest, _, _), isnew in zip(results, new):
+            if not isnew:
+                decisions.append((REMOVE, digest.hex(), fpath, None, None))
+                continue
+            # Else add to our list of founds.
+            found_digests.add(digest)
+
+            tomb_fpath = fpath
+            if "tomb/testdisk" in tomb_fpath:
+                tomb_fpath = re.sub('testdisk\/', filesystem_dir, tomb_fpath, count=1)
+
+            tomb_fpath = sanitize(tomb_fpath, sanitize_dirs=False)
+            # print(tomb_fpath, filesystem_dir)
+            # print(os.path.join(filesystem_dir, tomb_fpath))
+            # Pick the final name now, so the journal has exactly where it's going.
+            tomb_fpath = available_path(tomb_fpath, reserved)
+            reserved.add(tomb_fpath)
+            # print(os.path.join(filesystem_dir, tomb_fpath))
+            decisions.append((KEEP, digest.hex(), fpath, tomb_fpath, filesystem_dir.strip("/")))
+        apply_decisions(journal, index, decisions)
+
+    pbar.close()
 
     recovered_dir = "Recovered_Files"
     if not os.path.exists(recovered_dir):
         os.makedirs(recovered_dir)
-    for fpath in tqdm(fpaths(photorec_root)):
-        try:
-            digest = md5(fpath)
-        except:
-            continue
-        if isknown(digest) or isfound(digest):
-            os.remove(fpath)
-            continue
-        # Else add to our list of founds.
-        found_md5s.add(digest)
-
-        # Get filetype
-        subdir = os.path.join(recovered_dir, get_filetype_subdir(fpath))
-        subdir_counts[subdir] += 1
-
-        if subdir in blacklist:
-            os.remove(fpath)
-            continue
-
-        # Finally we know it's a keeper, so we condense it's filename and add it to the index.
-        subdir = filesystem_root + "/" + subdir
-        if not os.path.isdir(subdir):
-            os.mkdir(subdir)
-        # # Store in index
-        # condensed_fpath= subdir + "/" + sanitize(localize(fpath, filesystem_root, tombroot=True))
-        condensed_fpath= subdir + "/" + sanitize(localize(fpath, filesystem_root, tombroot=True))
-        safemv(fpath, condensed_fpath)
-        index[digest] = condensed_fpath
-
-    # Write Index
-    write_index(index, filesystem_root + "/" + "filesystem.index")
+    pbar = tqdm(unit=" files")
+    for results in raid_batches(pool, (entry.path for entry in timed_iter(scan_files(photorec_root), "walk")), classify=True):
+        pbar.update(len(results))
+        new = new_digest_mask([digest for _, digest, _, _ in results], [known for _, _, known, _ in results], found_digests)
+        decisions = []
+        reserved = set()
+        for (fpath, digest, _, subdir), isnew in zip(results, new):
+            if not isnew:
+                decisions.append((REMOVE, digest.hex(), fpath, None, None))
+                continue
+            # Else add to our list of founds.
+            found_digests.add(digest)
+
+            # Filetype was already determined by the worker
+            subdir = os.path.join(recovered_dir, subdir)
+            subdir_counts[subdir] += 1
+
+            if subdir in blacklist:
+                decisions.append((BLACKLIST, digest.hex(), fpath, None, subdir))
+                continue
+
+            # Finally we know it's a keeper, so we condense it's filename and add it to the index.
+            subdir_path = filesystem_root + "/" + subdir
+            if not os.path.isdir(subdir_path):
+                os.makedirs(subdir_path)
+            # # Store in index
+            # condensed_fpath= subdir + "/" + sanitize(localize(fpath, filesystem_root, tombroot=True))
+            condensed_fpath= subdir_path + "/" + sanitize(localize(fpath, filesystem_root, tombroot=True))
+            condensed_fpath = available_path(condensed_fpath, reserved)
+            reserved.add(condensed_fpath)
+            decisions.append((KEEP, digest.hex(), fpath, condensed_fpath, subdir))
+        apply_decisions(journal, index, decisions)
+    pbar.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    close_hash_cache()
+
+    # Export Index to the text format as well
+    export_index(index, filesystem_root + "/" + INDEX_FNAME)
+    index.close()
+
+    # Everything's done and indexed, so there's nothing left to resume.
+    journal.close()
+    remove_journal(filesystem_root)
     # Remove any remaining directories if they are empty
     print("Removing Leftover Testdisk and PhotoRec files")
     remove_leftover_dirs(testdisk_root)
@@ -196,37 +407,43 @@ def process(testdisk_root, photorec_root, filesystem_root, known_md5s_fname, bla
 
 
 if __name__ == "__main__":
+    # Optional number of workers, anywhere in the args
+    workers = None
+    for flag in ["-w", "--workers"]:
+        if flag in sys.argv:
+            i = sys.argv.index(flag)
+            workers = int(sys.argv[i+1])
+            del sys.argv[i:i+2]
+
+    # Optional content hash to find duplicates by, any of HASH_ALGORITHMS
+    content_hash = CONTENT_HASH
+    if "--hash" in sys.argv:
+        i = sys.argv.index("--hash")
+        content_hash = sys.argv[i+1]
+        del sys.argv[i:i+2]
+        new_hasher(content_hash) # Fail now if we don't have it, rather than in every worker
+
+    # Optional per-stage metrics (see metrics_utils), enabled before the pool starts so the workers record them too
+    if "--metrics" in sys.argv:
+        sys.argv.remove("--metrics")
+        enable_metrics()
+
     if len(sys.argv) != 5 and len(sys.argv) != 6:
-        print("Usage: python3 raid_filesystem.py testdisk_root/ photorec_root/ filesystem_root/ sorted_known.md5s [blacklist]")
+        print("Usage: python3 raid_filesystem.py testdisk_root/ photorec_root/ filesystem_root/ known.u128.npy|none [blacklist] [-w workers] [--hash algorithm] [--metrics]")
 
     testdisk_root = sys.argv[1]
     photorec_root = sys.argv[2]
     filesystem_root = sys.argv[3]
-    known_md5s_fname = sys.argv[4]
+    # "none" to not check against known hashes at all
+    known_md5s_fname = sys.argv[4] if sys.argv[4].lower() != "none" else None
     testdisk_root = addslash(testdisk_root)
     photorec_root = addslash(photorec_root)
     filesystem_root = addslash(filesystem_root)
+    # Without -w, however many hashing was tuned for on this device, or RAID_WORKERS if it hasn't been
+    if workers is None:
+        workers = tuned_workers(testdisk_root, RAID_WORKERS)
     if len(sys.argv) == 6:
         blacklist = sys.argv[5]
-        process(testdisk_root, photorec_root, filesystem_root, known_md5s_fname, blacklist_fname=blacklist)
+        process(testdisk_root, photorec_root, filesystem_root, known_md5s_fname, blacklist_fname=blacklist, workers=workers, content_hash=content_hash)
     else:
-        process(testdisk_root, photorec_root, filesystem_root, known_md5s_fname)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        process(testdisk_root, photorec_root, filesystem_root, known_md5s_fname, workers=workers, content_hash=content_hash)
@@ -8,6 +8,7 @@ from utils.filesystem_utils import *
 #from tqdm import tqdm
 from utils.filter_utils import *
 from utils.hash_utils import *
+from utils.index_utils import *
 import numpy as np
 from collections import defaultdict
 
@@ -17,8 +18,9 @@ def get_filetype_subdir(fname):
     # Determine Ext class
     ext_class = filetype_from_ext(fname)
 
-    # Determine Info class
-    info_class = filetype_from_info(fname)
+    # Determine Info class, probing the file once and reusing its info for the plaintext checks
+    info = safe_magic(fname)
+    info_class = filetype_from_infostr(info)
 
     # We now have ext class and info class.
     # We now sort them - if the classes agree, they go in that class. If they don't, then we have a lot
@@ -33,7 +35,7 @@ def get_filetype_subdir(fname):
 
     elif known(ext_class) and unsupported(info_class):
         # We know the ext but data is something else
-        if plaintext(fname):
+        if plaintext_info(info):
             # Some type of text file, trust the extension in this case
             subdir = ext_class
         else:
@@ -58,7 +60,7 @@ def get_filetype_subdir(fname):
 
     elif unknown(ext_class) and unsupported(info_class):
         # No extension, filedata is something unsupported
-        if plaintext(fname):
+        if plaintext_info(info):
             # Some type of text file, store in special directory
             subdir = "Unsupported_Text"
         else:
@@ -88,13 +90,10 @@ def process(tomb_root):
     recovered_dir = "Recovered_Files/"
     if not os.path.exists(filesystem_dir):
         os.makedirs(filesystem_dir)
-    with open(os.path.join(tomb_root, "filesystem.index"), "r") as f:
-        # Iterate directly through it and check filenames line by line.
-        index = {}
-        for line in f.readlines():
-            # Get the filename and the hash
-            fpath, digest = line.strip().split(", ")
-            index[digest] = fpath
+    # Get the filename and the hash of everything in the old index
+    index = {}
+    for fpath, digest in read_index(tomb_root):
+        index[digest] = fpath
 
     for fpath in tqdm(fpaths(tomb_root)):
 
@@ -0,0 +1,106 @@
+"""
+scan_utils.py
+
+Read-once scanning of files - each file is read a single time, sequentially, into one reused buffer, and every chunk
+    is handed to each of a list of consumers, rather than every stage that needs the contents (the content hash, md5,
+    libmagic) opening and reading the whole file again on its own.
+
+A consumer is a pair of functions (update, finish): update(chunk) is called with each chunk in order, and finish()
+    returns whatever the consumer computed once the file is done. Chunks are memoryviews into the shared buffer,
+    so they're only valid during the update call - anything a consumer wants to keep it has to copy.
+
+e.g. md5 and the header for libmagic in one read:
+    digest, header = scan_file(fpath, [digest_consumer("md5"), header_consumer()])
+
+Salvaging scans contents for crypto rules with mmap_windows instead, since it needs to search them in place.
+"""
+import os
+import mmap
+import hash_utils
+from tqdm import tqdm
+
+# How much of the start of a file we keep for libmagic to identify it by (with magic.from_buffer). libmagic itself
+# reads up to 1MB, but almost every test it does is within the first few KB - out of ~7,400 files checked, only 3
+# were sorted differently from only the first 64KB (gettext catalogs, only by their trailing metadata).
+# Kept small since raiding holds a header for every file in a batch until they're classified.
+HEADER_SIZE = 2**16
+
+# Size of the windows mmap_windows scans files in. Only bounds how much is looked at (and copied, if needed) at once,
+# since the file itself is memory-mapped rather than read.
+WINDOW_SIZE = 2**22 # 4MB
+
+
+def scan_file(fpath, consumers, buffer_size=None):
+    """
+    Read fpath once, passing each chunk to every consumer in turn.
+
+    :param fpath: File to read
+    :param consumers: List of (update, finish) consumers, e.g. from digest_consumer() and header_consumer()
+    :param buffer_size: Size of the chunks to read, by default whatever hashing is tuned to for the device fpath
+        is on (see hash_utils.md5_buffer_size)
+    :return: List of what each consumer's finish() returned, in the same order as consumers
+    """
+    with open(fpath, "rb", buffering=0) as f:
+        buf = bytearray(buffer_size or hash_utils.md5_buffer_size(os.fstat(f.fileno()).st_dev))
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            chunk = view[:n]
+            for update, _ in consumers:
+                update(chunk)
+    return [finish() for _, finish in consumers]
+
+
+def digest_consumer(algorithm):
+    # Raw digest of the whole file with algorithm, any of hash_utils.HASH_ALGORITHMS - so e.g. both the md5 for
+    # checking known hashes and the content hash for finding duplicates can come from the same read.
+    hasher = hash_utils.new_hasher(algorithm)
+    return hasher.update, hasher.digest
+
+
+def header_consumer(size=HEADER_SIZE):
+    # The first size bytes of the file.
+    header = bytearray()
+    def update(chunk):
+        if len(header) < size:
+            header.extend(chunk[:size - len(header)])
+    return update, lambda: bytes(header)
+
+
+def mmap_windows(fpath, window_size=WINDOW_SIZE, overlap=0, large_file_size=None):
+    """
+    Memory-map fpath and yield it in windows of window_size bytes, each extended overlap bytes into the next,
+        so anything up to overlap bytes long is entirely inside at least one window, no matter where it is.
+    Unlike splitting into lines, memory used is bounded by the window size, whatever is (or isn't) in the file.
+
+    Windows are given as offsets into the map rather than copies, so they can be searched in place,
+        e.g. pattern.search(mm, start, end). Matches starting at or after limit are also in the next window,
+        so they should be skipped to count each exactly once.
+
+    :param fpath: File to scan
+    :param window_size: Bytes each window advances by
+    :param overlap: Bytes each window extends into the next, the longest thing we're looking for
+    :param large_file_size: If given, show a progress bar for files larger than this (Bytes)
+    :return: Yields (mm, start, end, limit) for each window, nothing for an empty file
+    """
+    with open(fpath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        # Not closed explicitly, since anything still holding a match on it would make that raise - it's unmapped
+        # as soon as nothing references it anymore.
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mm, "madvise"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+
+    pbar = tqdm(total=size/2**20, unit="MB") if large_file_size is not None and size > large_file_size else None
+    for start in range(0, size, window_size):
+        end = min(start + window_size + overlap, size)
+        limit = start + window_size if start + window_size < size else size
+        yield mm, start, end, limit
+        if pbar is not None:
+            pbar.update((limit - start)/2**20)
+    if pbar is not None:
+        pbar.close()
@@ -68,7 +68,8 @@ def analyse(tombs_root):
     nums = defaultdict(lambda:0) # num of files, default to 0
     sizes = defaultdict(lambda:0) # total size of files, default to 0
 
-    for fpath in tqdm(fpaths(tombs_root)):
+    for entry in tqdm(scan_files(tombs_root)):
+        fpath = entry.path
         # Only check if it's in a tomb
         if "/tomb/" not in fpath:
             continue
@@ -77,6 +78,9 @@ def analyse(tombs_root):
         # put there by TR.
         subdirs = fpath.split("/")
         i = subdirs.index("tomb")+1
+        # Raiding now sorts them into tomb/Recovered_Files/{subdir} rather than tomb/{subdir}
+        if i < len(subdirs)-1 and subdirs[i] == "Recovered_Files":
+            i += 1
         if i > len(subdirs)-1 or subdirs[i] not in TOMB_SUBDIRS:
             # not in a subdir or not in one of ours, skip
             continue
@@ -87,7 +91,7 @@ def analyse(tombs_root):
         # Get ext and size of file
         ext = os.path.splitext(fpath)[-1].lower()
         try:
-            size = os.path.getsize(fpath)
+            size = entry.stat().st_size
         except OSError:
             continue
 
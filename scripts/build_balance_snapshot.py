@@ -0,0 +1,28 @@
+"""
+Tool to build a local balance snapshot (see balance_utils) from a text dump of addresses and their balances,
+    so crypto_salvager.py can check key candidates offline with --balances instead of calling a block explorer API.
+    Also builds the prefix table (balances.prefix.npy) next to it.
+
+The dump should have one "address balance" per line (tab, comma, semicolon, or space separated), balance in satoshis,
+    e.g. a TSV of all addresses with a balance, or a UTXO dump with one line per unspent output.
+    Only needs to be rebuilt when you want a more recent snapshot.
+run:
+python3 build_balance_snapshot.py addresses.tsv [balances.npy] [prefix_bits]
+"""
+import sys
+from balance_utils import *
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print("Usage: python3 build_balance_snapshot.py addresses.tsv [balances.npy] [prefix_bits]")
+        sys.exit(1)
+
+    dump_fname = sys.argv[1]
+    dst_fname = sys.argv[2] if len(sys.argv) >= 3 else "balances.npy"
+    prefix_bits = int(sys.argv[3]) if len(sys.argv) == 4 else PREFIX_BITS
+
+    n = build_balance_snapshot(dump_fname, dst_fname)
+    print(f"Wrote {n:,} addresses to {dst_fname}")
+
+    save_known_prefix(dst_fname, prefix_bits, what="addresses")
@@ -0,0 +1,33 @@
+"""
+Tool to convert the legacy known.npy hashset (object array of hex md5 strings) into the packed known.u128.npy
+    format, which raid_filesystem.py memory-maps instead of spending ~20 seconds unpickling on every run.
+    Also builds the prefix table (known.u128.prefix.npy) next to it, so each lookup only touches a page or two.
+
+Only needs to be run once per hashset, or whenever a new NSRL release is converted to known.npy.
+If given an already packed known.u128.npy, will just (re)build its prefix table.
+run:
+python3 build_known_md5s.py known.npy [known.u128.npy] [prefix_bits]
+"""
+import sys
+from known_utils import *
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print("Usage: python3 build_known_md5s.py known.npy [known.u128.npy] [prefix_bits]")
+        sys.exit(1)
+
+    src_fname = sys.argv[1]
+    if len(sys.argv) >= 3:
+        dst_fname = sys.argv[2]
+    elif not is_legacy_known_md5s(src_fname):
+        dst_fname = src_fname
+    else:
+        dst_fname = src_fname[:-len(".npy")] + KNOWN_MD5S_SUFFIX if src_fname.endswith(".npy") else src_fname + KNOWN_MD5S_SUFFIX
+    prefix_bits = int(sys.argv[3]) if len(sys.argv) == 4 else PREFIX_BITS
+
+    if is_legacy_known_md5s(src_fname):
+        n = build_known_md5s(src_fname, dst_fname)
+        print(f"Wrote {n:,} known hashes to {dst_fname}")
+
+    save_known_prefix(dst_fname, prefix_bits)
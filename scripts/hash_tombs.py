@@ -2,10 +2,10 @@
 Tool to go through all tombs and print stats on storage space saved by creating hashsets across all tombs.
     Does this to maximize speed since it otherwise takes forever, and uses only filesize to check files for equality
 
-USE ONLY FOR ESTIMATION, NOT FOR A FULL ANALYSIS. Change the digest computation to md5 for that.
+USE ONLY FOR ESTIMATION, NOT FOR A FULL ANALYSIS. Change the digest computation to hash_digest for that
+    (the content hash, xxh128 if xxhash is installed, much faster than md5 for this).
 """
 from filesystem_utils import *
-from hash_utils import *
 from reprint import output
 
 # All possible subdirectories from tomb raider results.
@@ -60,8 +60,10 @@ def hash(tombs_root):
     dupe_n = 0
     dupe_size = 0
     found_md5s = set({})
+
     with output(initial_len=4, interval=10) as out:
-        for fpath in fpaths(tombs_root):
+        for entry in scan_files(tombs_root):
+            fpath = entry.path
             # Only check if it's in a tomb
             if "/tomb/" not in fpath:
                 continue
@@ -75,10 +77,13 @@ def hash(tombs_root):
                 continue
 
             # Get hash and size of file
-            #digest = md5(fpath)
+            #digest = hash_digest(fpath)
             #digest = fasthash(fpath)
             #digest = md5(fpath)
-            size = safesize(fpath)
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                size = 0
             #digest = fasthash(fpath, size)
             digest = size
 
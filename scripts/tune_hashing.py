@@ -0,0 +1,43 @@
+"""
+Tool to tune hashing for a volume - finds the fastest buffer size and number of workers to hash files on it with,
+    by hashing a sample of the actual files on it straight from the device (evicted from the page cache before each
+    run), and saves them to the tuning file (~/.config/tombraider/hash_tuning.json by default) under that device.
+
+From then on, hashing any file on that device (raiding, deduplicating, hash_tombs.py) uses the tuned buffer size
+    automatically, and raid_filesystem.py uses the tuned number of workers unless given -w.
+    Only needs to be rerun if the hardware changes. Run it on a directory of real tomb files, e.g. a tomb's
+    testdisk or photorec directory, since the sizes of the files matter as much as the device.
+Files are digested the way raiding does - with the content hash and md5 from the same read, or with --hash to tune
+    for raiding with another content hash, and --no-known for raiding without known hashes (so no md5).
+run:
+python3 tune_hashing.py /path/on/volume/ [--sample-mb MB] [--hash algorithm] [--no-known] [--fname hash_tuning.json]
+"""
+import sys
+from hash_utils import *
+
+
+if __name__ == "__main__":
+    sample_bytes = TUNE_SAMPLE_BYTES
+    if "--sample-mb" in sys.argv:
+        i = sys.argv.index("--sample-mb")
+        sample_bytes = int(float(sys.argv[i+1]) * 2**20)
+        del sys.argv[i:i+2]
+    content_hash = CONTENT_HASH
+    if "--hash" in sys.argv:
+        i = sys.argv.index("--hash")
+        content_hash = sys.argv[i+1]
+        del sys.argv[i:i+2]
+    known = "--no-known" not in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg != "--no-known"]
+    fname = HASH_TUNING_FNAME
+    if "--fname" in sys.argv:
+        i = sys.argv.index("--fname")
+        fname = sys.argv[i+1]
+        del sys.argv[i:i+2]
+    if len(sys.argv) != 2:
+        print("Usage: python3 tune_hashing.py /path/on/volume/ [--sample-mb MB] [--hash algorithm] [--no-known] [--fname hash_tuning.json]")
+        sys.exit(1)
+
+    key, tuning = tune_hashing(sys.argv[1], sample_bytes, algorithms=digest_algorithms(content_hash, known), fname=fname)
+    print(f"Fastest for {key}: {tuning['buffer_size']:,} byte buffer with {tuning['workers']} workers, {tuning['mb_per_s']:,.1f} MB/s")
+    print(f"Saved to {fname}")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The utils are imported flat (import journal_utils), as the scripts do with utils/ on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
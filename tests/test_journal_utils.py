@@ -0,0 +1,48 @@
+import os
+import json
+from journal_utils import *
+
+
+def crash_mid_write(root, decision):
+    # Write the first half of decision's line to the journal, as if we crashed partway through writing it.
+    line = json.dumps(decision) + "\n"
+    with open(os.path.join(root, JOURNAL_FNAME), "a") as f:
+        f.write(line[:len(line) // 2])
+
+
+def test_resume_after_repeated_crashes(tmp_path):
+    root = str(tmp_path)
+    first = [(KEEP, "aa" * 16, "testdisk/a", "Filesystem/a", "Filesystem"), (REMOVE, "bb" * 16, "testdisk/b", None, None)]
+    second = [(KEEP, "cc" * 16, "photorec/c", "Recovered_Files/Images/c", "Recovered_Files/Images")]
+    third = [(BLACKLIST, "dd" * 16, "photorec/d", None, "Recovered_Files/Misc")]
+
+    # Raid, then crash partway through journaling a batch
+    journal = open_journal(root)
+    journal_decisions(journal, first)
+    journal.close()
+    crash_mid_write(root, (KEEP, "ee" * 16, "testdisk/e", "Filesystem/e", "Filesystem"))
+
+    # Resume - only the complete batch is there - then crash mid-write again
+    assert read_journal(root) == first
+    journal = open_journal(root)
+    journal_decisions(journal, second)
+    journal.close()
+    crash_mid_write(root, (REMOVE, "ff" * 16, "photorec/f", None, None))
+
+    # Resume again, nothing journaled after the first crash is lost
+    assert read_journal(root) == first + second
+    journal = open_journal(root)
+    journal_decisions(journal, third)
+    journal.close()
+    assert read_journal(root) == first + second + third
+
+
+def test_unterminated_line_is_dropped(tmp_path):
+    # A last line cut off right before its newline parses, but its batch was never acted on.
+    root = str(tmp_path)
+    decision = (KEEP, "aa" * 16, "testdisk/a", "Filesystem/a", "Filesystem")
+    with open(os.path.join(root, JOURNAL_FNAME), "w") as f:
+        f.write(json.dumps(decision))
+    assert read_journal(root) == []
+    open_journal(root).close()
+    assert os.path.getsize(os.path.join(root, JOURNAL_FNAME)) == 0
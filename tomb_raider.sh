@@ -3,9 +3,7 @@
 #set -x
 : '
 TODO
-make sure there is option for no known hashes
 option for never remove anything
-cache the optimal md5 buffer size once we compute it once
 save the .npy file once its obtained
 add an option to save all found files for future hashing
 
@@ -152,7 +150,16 @@ original_dir=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd
 safecopy_dir="$output_dir/safecopy"
 testdisk_dir="$output_dir/testdisk"
 photorec_dir="$output_dir/photorec"
-known_md5s="$original_dir/known.npy"
+known_md5s="$original_dir/known.u128.npy"
+if [[ ! -f $known_md5s ]]; then
+  # Packed hashset not built yet, fall back to the (much slower to load) legacy one.
+  # Build it once with: python3 scripts/build_known_md5s.py known.npy
+  known_md5s="$original_dir/known.npy"
+fi
+if [[ ! -f $known_md5s ]]; then
+  # No known hashes at all, so only remove duplicates (and hash with just the content hash, no md5)
+  known_md5s="none"
+fi
 
 # Always make these
 mkdir -p $output_dir